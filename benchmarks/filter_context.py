@@ -0,0 +1,126 @@
+"""Compare filtered search latency with filters in filter vs scoring context.
+
+Runs the same filtered queries against Elasticsearch twice: once with the DSL
+`build_dsl` produces (visibility and exact-match filters in `bool.filter`) and
+once with those filters moved back into `bool.must`, where they are scored
+and not cached. Prints one JSON line per variant.
+
+Searches Elasticsearch on DATAHUB_ELASTICSEARCH_ADDRESS, or the in-process
+backend named by `--backend`, which starts out empty and so has to be seeded.
+
+    DATAHUB_ELASTICSEARCH_ADDRESS=http://localhost:9200 \\
+        python benchmarks/filter_context.py --seed 20000 --rounds 200
+    python benchmarks/filter_context.py --backend memory --seed 2000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from metastore import backends, models  # noqa: E402
+
+BENCH_INDEX = 'metastore-bench'
+OWNERS = ['core', 'owner1', 'owner2', 'owner3']
+WORDS = ['gdp', 'population', 'co2', 'country', 'codes', 'finance',
+         'energy', 'climate', 'health', 'trade']
+
+QUERIES = [
+    ('owner1', {'datahub.ownerid': ['"owner2"']}),
+    (None, {'datahub.findability': ['"published"']}),
+    ('owner1', {'q': ['"country codes"'], 'datahub.ownerid': ['"core"']}),
+    (None, {'q': ['"gdp"'], 'datahub.owner': ['"core"', '"owner3"']}),
+]
+
+
+def seed(es, amount):
+    if es.indices.exists(BENCH_INDEX):
+        es.indices.delete(BENCH_INDEX)
+    es.indices.create(BENCH_INDEX)
+    for i in range(amount):
+        owner = random.choice(OWNERS)
+        es.index(BENCH_INDEX, 'dataset', {
+            'name': 'dataset-%d' % i,
+            'title': ' '.join(random.sample(WORDS, 3)),
+            'datahub': {
+                'owner': owner,
+                'ownerid': owner,
+                'findability': random.choice(['published', 'unlisted']),
+                'stats': {'bytes': random.randint(1, 10 ** 6)},
+            },
+            'datapackage': {'readme': ' '.join(random.sample(WORDS, 6))},
+        })
+    es.indices.refresh(BENCH_INDEX)
+
+
+def scoring_context(body):
+    """Move `bool.filter` clauses back to `bool.must`, as they used to be.
+    """
+    body = json.loads(json.dumps(body))
+    query = body['query']['bool']
+    query.setdefault('must', []).extend(query.pop('filter', []))
+    return body
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(es, kind_params, variant, rounds):
+    took, wall = [], []
+    for _ in range(rounds):
+        for userid, params in QUERIES:
+            body = models.build_dsl(
+                kind_params, userid, dict(params), kind='dataset')
+            if variant == 'must':
+                body = scoring_context(body)
+            start = time.perf_counter()
+            ret = es.search(index=kind_params['index'],
+                            doc_type=kind_params['doc_type'],
+                            body=body, size=50,
+                            search_type='dfs_query_then_fetch')
+            wall.append((time.perf_counter() - start) * 1000)
+            took.append(ret['took'])
+    return {
+        'benchmark': 'filter_context',
+        'variant': variant,
+        'queries': len(wall),
+        'took_ms_p50': percentile(took, 50),
+        'took_ms_p95': percentile(took, 95),
+        'wall_ms_p50': round(percentile(wall, 50), 3),
+        'wall_ms_p95': round(percentile(wall, 95), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, default=0,
+                        help='index this many synthetic datasets into %s '
+                             'and benchmark against it' % BENCH_INDEX)
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--backend', help='in-process search backend to '
+                                          'benchmark [default elasticsearch]')
+    args = parser.parse_args()
+    if args.backend and not args.seed:
+        parser.error('--backend needs --seed, its indices start out empty')
+
+    es = backends.create(args.backend) if args.backend \
+        else models._get_engine()
+    kind_params = dict(models.ENABLED_SEARCHES['dataset'])
+    if args.seed:
+        seed(es, args.seed)
+        kind_params['index'] = BENCH_INDEX
+
+    # Warm up both variants before measuring
+    for variant in ('filter', 'must'):
+        run(es, kind_params, variant, 5)
+    for variant in ('must', 'filter'):
+        print(json.dumps(run(es, kind_params, variant, args.rounds)))
+
+
+if __name__ == '__main__':
+    main()
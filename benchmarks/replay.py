@@ -0,0 +1,229 @@
+"""Replay recorded search requests and report latency percentiles.
+
+Reads a JSONL file of requests, one object per line with a `path`, its query
+`args` (values may be lists) and an optional `token`:
+
+    {"path": "/metastore/search/dataset", "args": {"q": "\\"gdp\\""}}
+
+and sends them at `--concurrency` and, optionally, at most `--rate` requests
+per second. With a rate, latency is measured from when each request was due,
+so that queueing behind slow requests is counted. Prints a JSON report with
+throughput, error rate, p50/p95/p99 latency and the result cache hit rate
+(from /metastore/metrics) overall and per kind.
+
+Requests go to the app from `metastore.create()` in-process, searching
+synthetic documents (see search.py) or the backend named by `--backend`, or
+to a running server with `--url`. In-process, tokens only resolve to a user
+if they were signed with this process' PRIVATE_KEY.
+
+    python benchmarks/replay.py requests.jsonl --concurrency 8 --rate 200
+    python benchmarks/replay.py requests.jsonl --url http://localhost:5000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from metastore import backends, create, models  # noqa: E402
+from search import StubEngine, percentile  # noqa: E402
+
+METRICS_PATH = '/metastore/metrics'
+CACHE_METRIC = 'metastore_cache_requests_total'
+
+
+def read_requests(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            args = record.get('args') or {}
+            record['args'] = [(k, v) for k, values in sorted(args.items())
+                              for v in (values if isinstance(values, list)
+                                        else [values])]
+            records.append(record)
+    return records
+
+
+def request_kind(path):
+    path = path.split('?')[0].rstrip('/')
+    if '/search/' in path:
+        return path.rsplit('/', 1)[1]
+    return 'dataset' if path.endswith('/search') else path
+
+
+class LocalClient(object):
+    """Sends requests to an in-process app, with a test client per thread.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def get(self, path, args=(), token=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        headers = {'Auth-Token': token} if token else {}
+        res = client.get(path, query_string=list(args), headers=headers)
+        return res.status_code, res.get_data(as_text=True)
+
+
+class RemoteClient(object):
+    """Sends requests to a running server, with a session per thread.
+    """
+
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+        self._local = threading.local()
+
+    def get(self, path, args=(), token=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+        headers = {'Auth-Token': token} if token else {}
+        res = session.get(self.url + path, params=list(args),
+                          headers=headers)
+        return res.status_code, res.text
+
+
+def cache_requests(client):
+    """Return {(kind, result): count} from the metrics endpoint.
+    """
+    status, text = client.get(METRICS_PATH)
+    if status != 200:
+        return {}
+    counts = {}
+    for line in text.splitlines():
+        if not line.startswith(CACHE_METRIC + '{'):
+            continue
+        labels, value = line[len(CACHE_METRIC) + 1:].rsplit('} ', 1)
+        labels = dict(item.split('=', 1) for item in labels.split(','))
+        counts[(labels['kind'].strip('"'), labels['result'].strip('"'))] = \
+            float(value)
+    return counts
+
+
+def replay(client, records, concurrency, rate=None):
+    """Send `records`, returning [(kind, ok, latency)] and the wall time.
+    """
+    results = []
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def send(record, due):
+        try:
+            start = due if due is not None else time.perf_counter()
+            try:
+                status, _ = client.get(record['path'], record['args'],
+                                       record.get('token'))
+                ok = status < 400
+            except Exception:
+                ok = False
+            latency = time.perf_counter() - start
+            with lock:
+                results.append((request_kind(record['path']), ok, latency))
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i, record in enumerate(records):
+            due = None
+            if rate:
+                due = start + i / rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            pool.submit(send, record, due)
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall, hits=0, misses=0):
+    latencies = sorted(latency for _, _, latency in results)
+    errors = sum(1 for _, ok, _ in results if not ok)
+    summary = {
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4),
+        'throughput': round(len(results) / wall, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'cache_hit_rate': None,
+    }
+    if hits + misses:
+        summary['cache_hit_rate'] = round(hits / (hits + misses), 4)
+    return summary
+
+
+def report(results, wall, before, after):
+    kinds = defaultdict(list)
+    for result in results:
+        kinds[result[0]].append(result)
+    cache = defaultdict(lambda: [0, 0])
+    for (kind, result), value in after.items():
+        change = value - before.get((kind, result), 0)
+        cache[kind][0 if result == 'hit' else 1] += change
+    return {
+        'overall': summarize(results, wall,
+                             sum(c[0] for c in cache.values()),
+                             sum(c[1] for c in cache.values())),
+        'kinds': dict((kind, summarize(kind_results, wall, *cache[kind]))
+                      for kind, kind_results in sorted(kinds.items())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('requests', help='JSONL file of recorded requests')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float,
+                        help='max requests per second [default unlimited]')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='replay the requests this many times')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='base url of a running server')
+    target.add_argument('--backend', help='search backend of the in-process '
+                                          'app [default synthetic stub]')
+    parser.add_argument('--docs', type=int, default=10000,
+                        help='synthetic documents per kind of the stub')
+    parser.add_argument('--output', help='write the report to this file')
+    args = parser.parse_args()
+
+    records = read_requests(args.requests) * args.repeat
+    if args.url:
+        client = RemoteClient(args.url)
+    else:
+        models._engine = backends.create(args.backend) if args.backend \
+            else StubEngine(args.docs)
+        client = LocalClient(create())
+
+    before = cache_requests(client)
+    results, wall = replay(client, records, args.concurrency, args.rate)
+    ret = report(results, wall, before, cache_requests(client))
+    ret['meta'] = {
+        'target': args.url or args.backend or 'stub',
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+    }
+    output = json.dumps(ret, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""Benchmark the search path, from DSL construction to WSGI responses.
+
+Times `build_dsl`, body serialization, result extraction, `models.query`
+and full requests to the app from `metastore.create()`, against synthetic
+datasets and events. Prints a JSON report; with `--compare`, each result also
+gets its change from the same result in an earlier report.
+
+The `stub` engine answers every search with a page of synthetic documents,
+decoded from JSON as the elasticsearch client would, so only metastore's own
+cost is measured and any corpus size is cheap. The `memory` engine indexes
+the documents in the in-memory backend and also measures searching them
+(practical up to about 100k documents).
+
+    python benchmarks/search.py --docs 10000 1000000 --output base.json
+    python benchmarks/search.py --docs 10000 1000000 --compare base.json
+    python benchmarks/search.py --engine memory --docs 10000 50000
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from metastore import blueprint, create, models  # noqa: E402
+from metastore.admission import AdmissionController  # noqa: E402
+from metastore.backends.base import Backend, index_stats  # noqa: E402
+from metastore.backends.memory import MemoryBackend  # noqa: E402
+from metastore.cache import ResultCache  # noqa: E402
+
+OWNERS = ['core', 'owner1', 'owner2', 'owner3']
+WORDS = ['gdp', 'population', 'co2', 'country', 'codes', 'finance',
+         'energy', 'climate', 'health', 'trade', 'prices', 'world',
+         'annual', 'index', 'exchange', 'rates', 'bank', 'ocean']
+
+# (name, kind, userid, params) of the benchmarked queries
+QUERIES = [
+    ('browse', 'dataset', None, {}),
+    ('q', 'dataset', None, {'q': ['"gdp country"']}),
+    ('q_filter_owner', 'dataset', 'owner1',
+     {'q': ['"energy prices"'], 'datahub.ownerid': ['"core"']}),
+    ('events_filter', 'events', 'owner1',
+     {'event_action': ['"finished"'], 'sort': ['"desc"']}),
+]
+
+MAPPINGS = {
+    'dataset': {
+        'name': {'type': 'string', 'analyzer': 'keyword'},
+        'title': {'type': 'string', 'analyzer': 'english'},
+        'datahub': {'type': 'object', 'properties': {
+            'owner': {'type': 'string', 'index': 'not_analyzed'},
+            'ownerid': {'type': 'string', 'index': 'not_analyzed'},
+            'findability': {'type': 'string', 'index': 'not_analyzed'},
+        }},
+        'datapackage': {'type': 'object', 'properties': {
+            'readme': {'type': 'string', 'analyzer': 'english'},
+        }},
+    },
+    'events': {
+        'timestamp': {'type': 'date'},
+        'owner': {'type': 'string', 'analyzer': 'keyword'},
+        'ownerid': {'type': 'string', 'analyzer': 'keyword'},
+        'findability': {'type': 'string', 'analyzer': 'keyword'},
+        'event_action': {'type': 'string', 'analyzer': 'keyword'},
+    },
+}
+
+
+def dataset(i):
+    rnd = random.Random(i)
+    owner = OWNERS[i % len(OWNERS)]
+    return {
+        'name': 'dataset-%d' % i,
+        'title': ' '.join(rnd.sample(WORDS, 4)).capitalize(),
+        'datahub': {
+            'owner': owner,
+            'ownerid': owner,
+            'findability': 'published' if i % 5 else 'unlisted',
+            'flowid': '%s/dataset-%d/1' % (owner, i),
+            'stats': {'bytes': rnd.randint(1, 10 ** 8),
+                      'rowcount': rnd.randint(1, 10 ** 6)},
+        },
+        'datapackage': {
+            'readme': ' '.join(rnd.choice(WORDS) for _ in range(60)),
+        },
+    }
+
+
+def event(i):
+    owner = OWNERS[i % len(OWNERS)]
+    timestamp = datetime.datetime(2018, 1, 1) + datetime.timedelta(minutes=i)
+    return {
+        'timestamp': timestamp.isoformat(),
+        'event_entity': 'flow' if i % 3 else 'login',
+        'event_action': 'finished' if i % 4 else 'deleted',
+        'owner': owner,
+        'ownerid': owner,
+        'dataset': 'dataset-%d' % (i // 10),
+        'status': 'OK',
+        'messsage': '',
+        'findability': 'published',
+        'payload': {'flow-id': '%s/dataset-%d' % (owner, i // 10)},
+    }
+
+
+DOCUMENTS = {'dataset': dataset, 'events': event}
+
+
+class StubEngine(Backend):
+    """Search backend answering with a page of synthetic documents.
+
+    Each response claims `docs` matching documents per kind. Responses are
+    serialized once per page size and decoded on every call.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self._responses = {}
+        self.indices = _StubIndices(docs)
+
+    def search(self, index=None, doc_type=None, body=None, size=10,
+               **params):
+        kind = 'dataset' if doc_type == 'dataset' else 'events'
+        key = (kind, int(size))
+        if key not in self._responses:
+            step = max(1, self.docs // max(1, int(size)))
+            ids = list(range(0, self.docs, step))[:int(size)]
+            hits = [{
+                '_index': index,
+                '_type': doc_type,
+                '_id': str(i),
+                '_score': 1.0,
+                '_source': DOCUMENTS[kind](i),
+            } for i in ids]
+            if kind == 'events':
+                for hit in hits:
+                    hit['sort'] = [hit['_source']['timestamp'],
+                                   '%s#%s' % (doc_type, hit['_id'])]
+            self._responses[key] = json.dumps({
+                'took': 1,
+                'timed_out': False,
+                'hits': {'total': self.docs, 'max_score': 1.0, 'hits': hits},
+                'aggregations': {'total_bytes': {'value': 12345.0}},
+            })
+        return json.loads(self._responses[key])
+
+    def ping(self, **params):
+        return True
+
+
+class _StubIndices(object):
+    """Indices of `StubEngine`, which never change.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def stats(self, index=None, metric=None, **params):
+        return index_stats(index, self.docs, self.docs)
+
+
+def memory_engine(docs):
+    engine = MemoryBackend()
+    for kind, make in DOCUMENTS.items():
+        kind_params = models.ENABLED_SEARCHES[kind]
+        engine.indices.create(kind_params['index'])
+        engine.indices.put_mapping(
+            doc_type=kind_params['doc_type'], index=kind_params['index'],
+            body={kind_params['doc_type']: {'properties': MAPPINGS[kind]}})
+        for i in range(docs):
+            engine.index(kind_params['index'], kind_params['doc_type'],
+                         make(i), id=str(i))
+    return engine
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def stats(latencies, wall):
+    latencies = sorted(latencies)
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': round(len(latencies) / wall, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 4),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+    }
+
+
+def measure(fn, seconds, min_calls=20):
+    """Call `fn` repeatedly for `seconds`, returning its latency stats.
+    """
+    latencies = []
+    start = end = time.perf_counter()
+    while end - start < seconds or len(latencies) < min_calls:
+        call = time.perf_counter()
+        fn()
+        end = time.perf_counter()
+        latencies.append(end - call)
+    return stats(latencies, end - start)
+
+
+def measure_concurrent(fn, seconds, concurrency):
+    """Call `fn` from `concurrency` threads for `seconds`.
+    """
+    def worker(deadline):
+        latencies = []
+        while time.perf_counter() < deadline:
+            call = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - call)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [pool.submit(worker, start + seconds)
+                   for _ in range(concurrency)]
+        latencies = [l for f in futures for l in f.result()]
+    return stats(latencies, time.perf_counter() - start)
+
+
+def get(client, url):
+    """Request `url`, failing on anything but a 200: rejected or failed
+    requests would otherwise be timed as successful.
+    """
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError('%s: HTTP %d' % (url, response.status_code))
+    return response
+
+
+def query(kind, userid, params):
+    """`models.query`, failing on error results.
+    """
+    ret = models.query(kind, userid, **dict(params))
+    if 'error' in ret:
+        raise RuntimeError('%s query: %s' % (kind, ret['error']))
+    return ret
+
+
+def search_url(kind, params):
+    args = [(k, v) for k, values in sorted(params.items()) for v in values]
+    return '/metastore/search/%s?%s' % (kind, urlencode(args))
+
+
+def run_unit(seconds):
+    """Benchmarks that don't depend on the documents.
+    """
+    results = []
+    for name, kind, userid, params in QUERIES:
+        kind_params = models.ENABLED_SEARCHES[kind]
+        results.append(dict(benchmark='build_dsl', case=name, **measure(
+            lambda: models.build_dsl(kind_params, userid, dict(params),
+                                     kind=kind), seconds)))
+        body = models.build_dsl(kind_params, userid, dict(params), kind=kind)
+        results.append(dict(benchmark='serialize', case=name, **measure(
+            lambda: json.dumps(body, sort_keys=True), seconds)))
+        results.append(dict(benchmark='prepare', case=name, **measure(
+            lambda: models._prepare(kind_params, userid, 50, dict(params),
+                                    kind=kind), seconds)))
+    return results
+
+
+def run_docs(engine, docs, seconds, concurrency):
+    """Benchmarks that search the engine.
+    """
+    results = []
+    models._engine = engine
+    cache = models._cache
+    # Concurrent requests are measured, not rejected
+    admission = blueprint._admission
+    blueprint._admission = AdmissionController(limit=0)
+    app = create()
+    client = app.test_client()
+    try:
+        for name, kind, userid, params in QUERIES:
+            kind_params = models.ENABLED_SEARCHES[kind]
+            api_params = models._prepare(kind_params, userid, 50,
+                                         dict(params), kind=kind)
+            ret = engine.search(**api_params)
+            results.append(dict(benchmark='extract', case=name, docs=docs,
+                                **measure(lambda: models._extract(
+                                    kind_params, ret, 50), seconds)))
+
+            models._cache = ResultCache(maxsize=0)
+            results.append(dict(benchmark='query', case=name, docs=docs,
+                                **measure(lambda: query(
+                                    kind, userid, params), seconds)))
+            models._cache = ResultCache()
+            results.append(dict(benchmark='query_cached', case=name,
+                                docs=docs, **measure(lambda: query(
+                                    kind, userid, params), seconds)))
+
+            # Requests are anonymous; the userid comes from a token
+            models._cache = ResultCache(maxsize=0)
+            url = search_url(kind, params)
+            for threads in concurrency:
+                if threads == 1:
+                    result = measure(lambda: get(client, url), seconds)
+                else:
+                    result = measure_concurrent(
+                        lambda: get(app.test_client(), url), seconds,
+                        threads)
+                results.append(dict(benchmark='wsgi', case=name, docs=docs,
+                                    concurrency=threads, **result))
+    finally:
+        models._cache = cache
+        models._engine = None
+        blueprint._admission = admission
+    return results
+
+
+def result_key(result):
+    return (result['benchmark'], result['case'], result.get('docs'),
+            result.get('concurrency'))
+
+
+def compare(results, baseline):
+    """Add each result's change from the baseline report.
+    """
+    previous = dict((result_key(r), r) for r in baseline['results'])
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is not None:
+            result['baseline_p50_ms'] = before['p50_ms']
+            result['baseline_ops_per_sec'] = before['ops_per_sec']
+            result['change_ops_per_sec'] = round(
+                result['ops_per_sec'] / before['ops_per_sec'] - 1, 4)
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs', type=int, nargs='+', default=[10000],
+                        help='synthetic documents per kind, one run each')
+    parser.add_argument('--engine', choices=['stub', 'memory'],
+                        default='stub')
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='time spent on each benchmark')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4],
+                        help='threads sending WSGI requests')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--compare', help='earlier report to compare with')
+    args = parser.parse_args()
+
+    results = run_unit(args.seconds)
+    for docs in args.docs:
+        engine = StubEngine(docs) if args.engine == 'stub' \
+            else memory_engine(docs)
+        results.extend(run_docs(engine, docs, args.seconds,
+                                args.concurrency))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    report = {
+        'meta': {
+            'commit': commit(),
+            'engine': args.engine,
+            'python': platform.python_version(),
+            'host': socket.gethostname(),
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Gunicorn settings for production, configured from the environment.
+
+    gunicorn -c gunicorn.conf.py server:app
+"""
+import os
+import multiprocessing
+
+bind = '0.0.0.0:%s' % (os.environ.get('PORT') or 5000)
+
+# Worker processes, each serving requests from a pool of threads
+workers = int(os.environ.get('METASTORE_WORKERS',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('METASTORE_THREADS', 4))
+worker_class = os.environ.get('METASTORE_WORKER_CLASS', 'gthread')
+
+timeout = int(os.environ.get('METASTORE_WORKER_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('METASTORE_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('METASTORE_KEEPALIVE', 5))
+
+# Recycle workers after this many requests (0 never does)
+max_requests = int(os.environ.get('METASTORE_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# The app is imported once, before forking; each worker creates its own
+# search engine client when warming up
+preload_app = True
+
+accesslog = os.environ.get('METASTORE_ACCESS_LOG', '-')
+
+
+def post_worker_init(worker):
+    if 'aiohttp' in worker.cfg.worker_class_str:
+        # The asyncio app warms up when it starts
+        return
+    from metastore import models
+    if not models.warm_up():
+        worker.log.warning('Search engine not reachable, worker not ready')
@@ -1,5 +1,8 @@
+import os
 from flask import Flask
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from . import blueprint
 from .blueprint import create as search
 
 def create():
@@ -8,7 +11,12 @@ def create():
 
     # Create application
     app = Flask('service', static_folder=None)
-    app.config['DEBUG'] = True
+    app.config['DEBUG'] = os.environ.get('METASTORE_DEBUG', '').lower() \
+        in ('1', 'true', 'yes')
+
+    # Client addresses, from the proxies in front of the app
+    if blueprint.PROXY_COUNT:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=blueprint.PROXY_COUNT)
 
     # CORS support
     CORS(app, supports_credentials=True)
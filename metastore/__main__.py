@@ -0,0 +1,117 @@
+"""Command line tools.
+
+    python -m metastore queries --url http://localhost:5000/metastore/admin/queries
+    python -m metastore queries --log metastore.log --order max
+    python -m metastore import-sqlite --db metastore.db --kind dataset dump.json
+"""
+import os
+import json
+import argparse
+
+from . import querylog
+from .models import ENABLED_SEARCHES
+
+
+def queries(args):
+    """Report the slowest or most frequent query shapes.
+    """
+    if args.url:
+        import requests
+        headers = {'X-Admin-Token': args.token} if args.token else {}
+        res = requests.get(args.url, headers=headers,
+                           params={'top': args.top, 'order': args.order})
+        res.raise_for_status()
+        entries = res.json()['queries']
+    else:
+        entries = querylog.read_log(args.log).top(args.top, args.order)
+
+    print('%-16s %-8s %8s %6s %10s %10s %10s  %s' % (
+        'fingerprint', 'kind', 'count', 'slow', 'total_ms', 'mean_ms',
+        'max_ms', 'shape'))
+    for e in entries:
+        print('%-16s %-8s %8d %6d %10.1f %10.1f %10.1f  %s' % (
+            e['fingerprint'], e['kind'], e['count'], e['slow'], e['total'],
+            e['mean'], e['max'], e['shape'] or ''))
+
+
+def _documents(item):
+    if isinstance(item, dict) and 'hits' in item:
+        item = item['hits']['hits']
+    for doc in item if isinstance(item, list) else [item]:
+        if '_source' in doc:
+            yield doc.get('_id'), doc['_source']
+        else:
+            yield None, doc
+
+
+def read_documents(f):
+    """Yield the (id, source) of the documents of an elasticsearch dump.
+
+    Reads newline delimited documents or hits (as written by elasticdump),
+    a line at a time, or a whole search response.
+    """
+    for line in f:
+        if line.strip():
+            break
+    else:
+        return
+    try:
+        first = json.loads(line)
+    except ValueError:
+        # Not a document per line: a single (pretty printed) document
+        for doc in _documents(json.loads(line + f.read())):
+            yield doc
+        return
+    for doc in _documents(first):
+        yield doc
+    for line in f:
+        if line.strip():
+            for doc in _documents(json.loads(line)):
+                yield doc
+
+
+def import_sqlite(args):
+    """Load documents of a kind into a SQLite search database.
+    """
+    from .backends.sqlite import SqliteBackend
+    kind_params = ENABLED_SEARCHES[args.kind]
+    backend = SqliteBackend(args.db)
+    with open(args.file) as f:
+        count = backend.load(kind_params['index'], kind_params['doc_type'],
+                             read_documents(f))
+    print('Loaded %d %s documents into %s' % (count, args.kind, args.db))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m metastore')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parser_queries = commands.add_parser('queries', help=queries.__doc__)
+    source = parser_queries.add_mutually_exclusive_group(required=True)
+    source.add_argument('--url', help='admin queries endpoint of a running '
+                                      'server')
+    source.add_argument('--log', help='file of metastore.query log lines')
+    parser_queries.add_argument('--top', type=int, default=10)
+    parser_queries.add_argument('--order', default='total',
+                                choices=querylog.QueryStats.ORDERS)
+    parser_queries.add_argument('--token', default=os.environ.get(
+        'METASTORE_ADMIN_TOKEN'), help='admin token for --url')
+    parser_queries.set_defaults(func=queries)
+
+    parser_import = commands.add_parser('import-sqlite',
+                                        help=import_sqlite.__doc__)
+    parser_import.add_argument('--db', default=os.environ.get(
+        'METASTORE_SQLITE_PATH', 'metastore.db'))
+    parser_import.add_argument('--kind', required=True,
+                               choices=sorted(ENABLED_SEARCHES))
+    parser_import.add_argument('file', help='NDJSON documents or hits, or a '
+                                            'search response')
+    parser_import.set_defaults(func=import_sqlite)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from . import metrics
+
+
+def options(threads=None):
+    """Admission control options, from the environment.
+
+    A process serving requests from a pool of `threads` threads never has
+    more requests in flight than threads: the limit defaults to (and is
+    capped at) the number of threads, the other limits to shares of it, and
+    requests are not queued, as a waiting request would hold a thread.
+    """
+    if threads is None:
+        defaults = {'limit': 32, 'per_client': 4, 'reserved': 8, 'queue': 32}
+    else:
+        threads = int(threads)
+        defaults = {
+            'limit': threads,
+            'per_client': max(1, threads // 4),
+            'reserved': max(1, threads // 4),
+            'queue': 0,
+        }
+    ret = {
+        'limit': int(os.environ.get('METASTORE_MAX_CONCURRENCY',
+                                    defaults['limit'])),
+        'per_client': int(os.environ.get('METASTORE_MAX_CLIENT_CONCURRENCY',
+                                         defaults['per_client'])),
+        'reserved': int(os.environ.get('METASTORE_RESERVED_CONCURRENCY',
+                                       defaults['reserved'])),
+        'queue': int(os.environ.get('METASTORE_ADMISSION_QUEUE',
+                                    defaults['queue'])),
+        'wait': float(os.environ.get('METASTORE_ADMISSION_WAIT', 0.5)),
+    }
+    if threads is not None and ret['limit'] > threads:
+        ret['limit'] = threads
+    return ret
+
+
+def proxy_count():
+    """Number of proxies in front of the app, each adding the address it
+    got a request from to `X-Forwarded-For` (`METASTORE_PROXY_COUNT`).
+
+    Returns None if it is not set: the address a request comes from may then
+    be a proxy's, shared by all of its clients.
+    """
+    count = os.environ.get('METASTORE_PROXY_COUNT', '')
+    return int(count) if count.strip() else None
+
+
+class Rejected(Exception):
+    """Raised for a request that is not admitted; retry after
+    `retry_after` seconds.
+    """
+
+    def __init__(self, reason, retry_after=1):
+        super(Rejected, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Admission(object):
+
+    def __init__(self, limit=32, per_client=4, reserved=8, queue=32,
+                 wait=0.5, retry_after=1):
+        self.limit = int(limit)
+        self.per_client = int(per_client)
+        self.reserved = int(reserved)
+        self.queue = int(queue)
+        self.wait = float(wait)
+        self.retry_after = int(retry_after)
+        self.active = 0
+        self.waiting = 0
+        self._anonymous = 0
+        self._clients = {}
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def _can_enter(self, client, authenticated):
+        if self.active >= self.limit:
+            return False
+        # Anonymous requests leave the reserved slots to authenticated ones
+        if not authenticated and \
+                self._anonymous >= self.limit - self.reserved:
+            return False
+        # Requests of unknown clients are only limited in total
+        return client is None or self.per_client <= 0 or \
+            self._clients.get(client, 0) < self.per_client
+
+    def _enter(self, client, authenticated):
+        self.active += 1
+        if not authenticated:
+            self._anonymous += 1
+        if client is not None:
+            self._clients[client] = self._clients.get(client, 0) + 1
+
+    def _leave(self, client, authenticated):
+        self.active -= 1
+        if not authenticated:
+            self._anonymous -= 1
+        if client is None:
+            return
+        self._clients[client] -= 1
+        if not self._clients[client]:
+            del self._clients[client]
+
+    def _reject(self, reason):
+        metrics.ADMISSIONS.inc(result=reason)
+        return Rejected(reason, self.retry_after)
+
+
+class AdmissionController(_Admission):
+    """Bound the number of requests searching concurrently.
+
+    At most `limit` requests are admitted at a time, and at most
+    `per_client` of them from the same client (a userid or an address).
+    Anonymous requests may only take `limit - reserved` slots, so that they
+    can't starve authenticated users. A request that can't be admitted
+    waits, up to `wait` seconds, in a queue of at most `queue` requests;
+    when the queue is full, or the wait is over, `Rejected` is raised.
+
+    A `limit` of 0 admits every request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AdmissionController, self).__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def acquire(self, client, authenticated=False):
+        if not self.enabled:
+            return
+        with self._cond:
+            if not self._can_enter(client, authenticated):
+                if self.waiting >= self.queue:
+                    raise self._reject('queue_full')
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.wait
+                    while not self._can_enter(client, authenticated):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._reject('timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self._enter(client, authenticated)
+        metrics.ADMISSIONS.inc(result='admitted')
+
+    @contextmanager
+    def admit(self, client, authenticated=False):
+        self.acquire(client, authenticated)
+        try:
+            yield
+        finally:
+            self.release(client, authenticated)
+
+    def release(self, client, authenticated=False):
+        if not self.enabled:
+            return
+        with self._cond:
+            self._leave(client, authenticated)
+            self._cond.notify_all()
+
+
+class AsyncAdmissionController(_Admission):
+    """`AdmissionController` for coroutines sharing an event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncAdmissionController, self).__init__(*args, **kwargs)
+        self._cond = None
+
+    async def acquire(self, client, authenticated=False):
+        if not self.enabled:
+            return
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        if not self._can_enter(client, authenticated):
+            if self.waiting >= self.queue:
+                raise self._reject('queue_full')
+            self.waiting += 1
+            try:
+                async with self._cond:
+                    await asyncio.wait_for(self._cond.wait_for(
+                        lambda: self._can_enter(client, authenticated)),
+                        self.wait)
+            except asyncio.TimeoutError:
+                raise self._reject('timeout')
+            finally:
+                self.waiting -= 1
+        self._enter(client, authenticated)
+        metrics.ADMISSIONS.inc(result='admitted')
+
+    async def release(self, client, authenticated=False):
+        if not self.enabled:
+            return
+        self._leave(client, authenticated)
+        if self._cond is not None:
+            async with self._cond:
+                self._cond.notify_all()
@@ -0,0 +1,657 @@
+"""Asyncio search service.
+
+An aiohttp application serving the same routes as `blueprint.create`. Searches
+go to elasticsearch over a pooled asynchronous HTTP transport, so thousands
+of concurrent searches can share one event loop and a few connections.
+Queries are built, cached and extracted by `models`, as in the WSGI app.
+
+Needs the `async` extra (aiohttp):
+
+    gunicorn 'metastore.aio:create()' -c gunicorn.conf.py \\
+        --worker-class aiohttp.GunicornWebWorker
+    python -m metastore.aio
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import itertools
+from urllib.parse import quote
+
+import aiohttp
+import elasticsearch
+from aiohttp import web
+
+from . import (admission, backends, controllers, metrics, models, querylog,
+               serialize)
+from .admission import AsyncAdmissionController, Rejected
+from .auth import TokenCache, is_admin
+from .backends import elastic
+from .models import ENABLED_SEARCHES
+from .singleflight import AsyncSingleFlight
+
+PRIVATE_KEY = os.environ.get('PRIVATE_KEY')
+
+# Admin endpoints require it in the `X-Admin-Token` header, and are closed
+# when it is not set
+ADMIN_TOKEN = os.environ.get('METASTORE_ADMIN_TOKEN')
+
+# Request parameters that are not query filters: JSONP callback, jQuery's
+# cache buster and token
+RESERVED_PARAMS = ('callback', '_', 'jwt')
+
+# Seconds shared caches (e.g. a CDN) may serve anonymous search results for
+MAX_AGE = int(os.environ.get('METASTORE_HTTP_MAX_AGE', 5))
+
+# Max connections to elasticsearch per process, and seconds per request
+POOL_SIZE = int(os.environ.get('METASTORE_ASYNC_POOL_SIZE', 100))
+TIMEOUT = float(os.environ.get('METASTORE_ASYNC_TIMEOUT', 10))
+
+_tokens = TokenCache(
+    maxsize=os.environ.get('METASTORE_TOKEN_CACHE_SIZE', 10000),
+    ttl=os.environ.get('METASTORE_TOKEN_CACHE_TTL', 300))
+
+_flight = AsyncSingleFlight()
+
+# Proxies in front of the app (None if unknown, see `admission.proxy_count`)
+PROXY_COUNT = admission.proxy_count()
+
+# Bounds the requests searching concurrently in this process
+_admission = AsyncAdmissionController(**admission.options())
+
+# Application keys (typed keys need aiohttp 3.9)
+_AppKey = getattr(web, 'AppKey', lambda name, t: name)
+ENGINE = _AppKey('engine', object)
+READY = _AppKey('ready', bool)
+
+
+class AsyncElasticsearch(object):
+    """Elasticsearch client over a pooled aiohttp session.
+
+    Implements the calls metastore makes, with the arguments and responses of
+    the synchronous client, and raises the same exceptions. Requests go to
+    each of `hosts` in turn; those that fail to connect or time out are
+    retried on the next host, as the synchronous client is configured to.
+    """
+
+    def __init__(self, hosts=None, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        if hosts is None:
+            hosts = elastic.hosts()
+        elif isinstance(hosts, str):
+            hosts = [hosts]
+        self.hosts = [(h if '://' in h else 'http://' + h).rstrip('/')
+                      for h in hosts]
+        self.pool_size = pool_size
+        self.timeout = timeout
+        options = elastic.client_options()
+        self.max_retries = options['max_retries']
+        self.retry_on_timeout = options['retry_on_timeout']
+        self._next = itertools.cycle(self.hosts)
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use, inside the event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, path, params=None, body=None,
+                      content_type='application/json', timeout=None):
+        if body is not None and not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        params = dict((k, str(v)) for k, v in (params or {}).items()
+                      if v is not None)
+        headers = {'Content-Type': content_type} if body is not None else {}
+        options = {'timeout': timeout} if timeout is not None else {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.session.request(
+                        method, next(self._next) + path, params=params,
+                        data=body, headers=headers, **options) as res:
+                    status, text = res.status, await res.text()
+                break
+            except asyncio.TimeoutError as e:
+                if not self.retry_on_timeout or attempt == self.max_retries:
+                    raise elasticsearch.exceptions.ConnectionTimeout(
+                        'TIMEOUT', str(e), e)
+            except aiohttp.ClientError as e:
+                if attempt == self.max_retries:
+                    raise elasticsearch.exceptions.ConnectionError(
+                        'N/A', str(e), e)
+        if status >= 400:
+            error, info = text, None
+            try:
+                info = json.loads(text)
+                error = info.get('error', error)
+                if isinstance(error, dict) and 'type' in error:
+                    error = error['type']
+            except (ValueError, AttributeError):
+                pass
+            raise elasticsearch.exceptions.HTTP_EXCEPTIONS.get(
+                status, elasticsearch.exceptions.TransportError)(
+                    status, error, info)
+        return json.loads(text) if text else {}
+
+    @staticmethod
+    def _path(index, doc_type, endpoint):
+        return '/' + '/'.join(quote(part, safe=',') for part in
+                              (index, doc_type) if part) + endpoint
+
+    async def search(self, index=None, doc_type=None, body=None, from_=None,
+                     **params):
+        params['from'] = from_
+        timeout = params.pop('request_timeout', None)
+        if timeout is not None:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+        return await self.request('POST',
+                                  self._path(index, doc_type, '/_search'),
+                                  params, body, timeout=timeout)
+
+    async def msearch(self, body, **params):
+        return await self.request('POST', '/_msearch', params, body,
+                                  content_type='application/x-ndjson')
+
+    async def scan(self, query=None, index=None, doc_type=None,
+                   scroll='5m', size=1000, **params):
+        """Iterate over every hit of a query with the scroll API.
+        """
+        query = dict(query or {})
+        query.setdefault('sort', '_doc')
+        ret = await self.request('POST',
+                                 self._path(index, doc_type, '/_search'),
+                                 {'scroll': scroll, 'size': size}, query)
+        scroll_id = ret.get('_scroll_id')
+        try:
+            while ret['hits']['hits']:
+                for hit in ret['hits']['hits']:
+                    yield hit
+                if scroll_id is None:
+                    break
+                ret = await self.request('POST', '/_search/scroll', body={
+                    'scroll': scroll, 'scroll_id': scroll_id})
+                scroll_id = ret.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    await self.request('DELETE', '/_search/scroll',
+                                       body={'scroll_id': [scroll_id]})
+                except elasticsearch.exceptions.TransportError:
+                    pass
+
+    async def index_stats(self, index, metric=None):
+        return await self.request('GET', self._path(index, None, '/_stats') +
+                                  ('/' + metric if metric else ''))
+
+    async def ping(self, **params):
+        try:
+            await self.request('HEAD', '/')
+            return True
+        except elasticsearch.exceptions.TransportError:
+            return False
+
+
+class ThreadedBackend(object):
+    """Runs the calls of a synchronous backend in the loop's executor.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(fn, *args, **kwargs))
+
+    async def close(self):
+        pass
+
+    async def search(self, **params):
+        return await self._run(self.backend.search, **params)
+
+    async def msearch(self, body, **params):
+        return await self._run(self.backend.msearch, body, **params)
+
+    async def scan(self, **params):
+        hits = iter(self.backend.scan(**params))
+
+        def batch():
+            return [hit for _, hit in zip(range(models.EXPORT_BATCH_SIZE),
+                                          hits)]
+        while True:
+            hits_batch = await self._run(batch)
+            if not hits_batch:
+                break
+            for hit in hits_batch:
+                yield hit
+
+    async def index_stats(self, index, metric=None):
+        return await self._run(self.backend.indices.stats, index=index,
+                               metric=metric)
+
+    async def ping(self, **params):
+        return await self._run(self.backend.ping, **params)
+
+
+def create_engine(name=None):
+    """Create the asynchronous engine for the search backend named `name`.
+
+    Elasticsearch is searched over `AsyncElasticsearch`; other backends run
+    in a thread pool.
+    """
+    if name is None:
+        name = os.environ.get('METASTORE_BACKEND', 'elasticsearch')
+    if name == 'elasticsearch':
+        return AsyncElasticsearch()
+    return ThreadedBackend(backends.create(name))
+
+
+# Searches
+
+
+async def _call(fn, *args, **kwargs):
+    # `models._breaker.call`, for coroutines
+    models._breaker.acquire()
+    try:
+        ret = await fn(*args, **kwargs)
+    except Exception as e:
+        models._breaker.record(e)
+        raise
+    models._breaker.record()
+    return ret
+
+
+async def query(engine, kind, userid, size=50, **kw):
+    """`models.query`, searching `engine`.
+    """
+    try:
+        prepared = models.prepare(kind, userid, size, **kw)
+    except ValueError as e:
+        logging.error("query: %r", e)
+        return models._error(e)
+    return await query_prepared(engine, prepared)
+
+
+async def query_prepared(engine, prepared):
+    """`models.query_prepared`, searching `engine`.
+    """
+    kind, kind_params, summary, api_params, key = prepared
+    try:
+        use_cache, cached = models._lookup(prepared)
+        if cached is not None:
+            return models._summarize(cached, summary)
+        search_params, aggs_key, aggs = models._search_params(
+            kind, api_params, use_cache)
+        start = time.perf_counter()
+        try:
+            # Searches leaving out cached aggregations are not shared with
+            # those that need them
+            ret = await _flight.do((key, search_params['body']), _call,
+                                   engine.search, **search_params)
+        except elasticsearch.exceptions.ElasticsearchException as e:
+            res = models._fallback(kind, key, e)
+            if res is None:
+                raise
+            return models._summarize(res, summary)
+        ret = models._merge_aggs(ret, aggs_key, aggs)
+        return models._summarize(
+            models._complete(kind, kind_params, api_params, key, use_cache,
+                             ret, time.perf_counter() - start), summary)
+    except (elasticsearch.exceptions.NotFoundError,
+            json.decoder.JSONDecodeError, ValueError) as e:
+        logging.error("query: %r", e)
+        return models._error(e)
+
+
+async def index_version(engine, index):
+    """`models.index_version`, from `engine`.
+    """
+    version = models._versions.get(index)
+    if version is None:
+        try:
+            stats = await _call(engine.index_stats, index,
+                                metric='indexing,refresh')
+            version = models._version_marker(stats)
+        except (elasticsearch.exceptions.ElasticsearchException,
+                KeyError) as e:
+            logging.error("index_version: %r", e)
+            return None
+        models._observe_version(index, version)
+    return version
+
+
+async def etag(engine, prepared):
+    """`models.etag_prepared`, from `engine`.
+    """
+    version = await index_version(engine, prepared.kind_params['index'])
+    if version is None:
+        return None
+    return models._etag(prepared, version)
+
+
+async def search(engine, kind, userid, args={}, prepared=None):
+    """`controllers.search`, searching `engine`.
+    """
+    if kind not in ENABLED_SEARCHES:
+        return None
+    try:
+        if prepared is not None:
+            res = await query_prepared(engine, prepared)
+        else:
+            res = await query(engine, kind, userid, **args)
+        if 'error' in res:
+            metrics.SEARCH_ERRORS.inc(kind=kind)
+        else:
+            metrics.RESULTS.observe(len(res['results']), kind=kind)
+        return res
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        metrics.SEARCH_ERRORS.inc(kind=kind)
+        return {
+            'total': 0,
+            'results': [],
+            'error': str(e)
+        }
+
+
+async def multi_search(engine, userid, queries):
+    """`controllers.multi_search`, searching `engine`.
+    """
+    parsed = controllers.parse_multi_search(queries)
+    if parsed is None:
+        return None
+    try:
+        responses, pending, body = models._plan_multi(userid, parsed)
+        if body is None:
+            return responses
+        start = time.perf_counter()
+        try:
+            ret = await _call(engine.msearch, body=body)
+        except elasticsearch.exceptions.ElasticsearchException as e:
+            logging.error("multi_search: %r", e)
+            return models._fail_multi(responses, pending, e)
+        return models._complete_multi(responses, pending, ret,
+                                      time.perf_counter() - start)
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        return [{
+            'total': 0,
+            'results': [],
+            'error': str(e)
+        } for _ in parsed]
+
+
+# Application
+
+
+def _json_response(request, data, status=200):
+    """JSON response, wrapped in the `callback` parameter if given (JSONP),
+    and compressed if the client accepts it.
+    """
+    body, content_type = serialize.jsonp(data, request.query.get('callback'))
+    body, encoding = serialize.compress(
+        body, request.headers.get('Accept-Encoding'))
+    response = web.Response(body=body, status=status,
+                            content_type=content_type)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _not_modified(request, etag):
+    tags = [tag.strip() for tag in
+            request.headers.get('If-None-Match', '').split(',')]
+    return '*' in tags or '"%s"' % etag in [
+        tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def _cacheable(response, etag, userid):
+    # Anonymous results are the same for everyone, others are private
+    response.headers['ETag'] = 'W/"%s"' % etag
+    if userid is None:
+        response.headers['Cache-Control'] = 'public, max-age=%d' % MAX_AGE
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    # CORS headers echo the request's Origin
+    vary = [v.strip() for v in response.headers.get('Vary', '').split(',')
+            if v.strip()]
+    for header in ('Auth-Token', 'Origin'):
+        if header.lower() not in [v.lower() for v in vary]:
+            vary.append(header)
+    response.headers['Vary'] = ', '.join(vary)
+    return response
+
+
+def _args(request):
+    args = {}
+    for k, v in request.query.items():
+        if k not in RESERVED_PARAMS:
+            args.setdefault(k, []).append(v)
+    return args
+
+
+def _remote(request):
+    # The address the first of `PROXY_COUNT` proxies got the request from,
+    # as werkzeug's ProxyFix does
+    if PROXY_COUNT:
+        forwarded = [a.strip() for a in
+                     request.headers.get('X-Forwarded-For', '').split(',')
+                     if a.strip()]
+        if len(forwarded) >= PROXY_COUNT:
+            return forwarded[-PROXY_COUNT]
+    return request.remote
+
+
+def _get_userid(request):
+    token = request.headers.get('auth-token') or request.query.get('jwt')
+    if token is None:
+        return None
+    return _tokens.get_userid(token, PRIVATE_KEY)
+
+
+def _admitted(view):
+    """Admit requests to `view` (see `AsyncAdmissionController`), until
+    its response is sent.
+    """
+    @functools.wraps(view)
+    async def wrapper(request):
+        userid = _get_userid(request)
+        # Authenticated users are limited per userid, others per address,
+        # once addresses are known to be the clients'
+        if userid is not None:
+            client = ('user:%s' % userid, True)
+        elif PROXY_COUNT is None:
+            client = (None, False)
+        else:
+            client = ('addr:%s' % _remote(request), False)
+        try:
+            await _admission.acquire(*client)
+        except Rejected as e:
+            response = _json_response(
+                request, {'error': 'Too many concurrent requests'}, 429)
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        try:
+            return await view(request)
+        finally:
+            await _admission.release(*client)
+    return wrapper
+
+
+@_admitted
+async def search_view(request):
+    kind = request.match_info.get('kind', 'dataset')
+    if kind not in ENABLED_SEARCHES:
+        raise web.HTTPBadRequest()
+    with metrics.REQUEST_SECONDS.time(kind=kind):
+        with metrics.STAGE_SECONDS.time(kind=kind, stage='token'):
+            userid = _get_userid(request)
+        args = _args(request)
+        # The query is built once, for its ETag and its search
+        prepared = controllers.prepare(kind, userid, args)
+        # Unchanged results are neither searched for nor serialized
+        tag = None
+        if prepared is not None:
+            with metrics.STAGE_SECONDS.time(kind=kind, stage='etag'):
+                tag = await etag(request.app[ENGINE], prepared)
+        if tag is not None and _not_modified(request, tag):
+            metrics.NOT_MODIFIED.inc(kind=kind)
+            return _cacheable(web.Response(status=304), tag, userid)
+        ret = await search(request.app[ENGINE], kind, userid, args,
+                           prepared)
+        if ret is None:
+            raise web.HTTPBadRequest()
+        with metrics.STAGE_SECONDS.time(kind=kind, stage='serialize'):
+            response = _json_response(request, ret)
+        if tag is not None and 'error' not in ret and not ret.get('stale'):
+            _cacheable(response, tag, userid)
+        metrics.RESPONSE_BYTES.observe(response.content_length or 0,
+                                       kind=kind)
+    return response
+
+
+@_admitted
+async def multi_search_view(request):
+    try:
+        queries = await request.json()
+    except ValueError:
+        queries = None
+    ret = await multi_search(request.app[ENGINE], _get_userid(request),
+                             queries)
+    if ret is None:
+        raise web.HTTPBadRequest()
+    return _json_response(request, {'responses': ret})
+
+
+@_admitted
+async def export_view(request):
+    kind = request.match_info.get('kind', 'dataset')
+    if kind not in ENABLED_SEARCHES:
+        raise web.HTTPBadRequest()
+    try:
+        kind_params, body = models._export_query(
+            kind, _get_userid(request), _args(request))
+    except (ValueError, TypeError):
+        raise web.HTTPBadRequest()
+    response = web.StreamResponse(
+        headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    try:
+        async for hit in request.app[ENGINE].scan(
+                query=body, index=kind_params['index'],
+                doc_type=kind_params['doc_type'],
+                scroll=models.EXPORT_SCROLL, size=models.EXPORT_BATCH_SIZE):
+            await response.write(serialize.dumps(hit['_source']) + b'\n')
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        # The 200 is already sent: end with an error record, so that clients
+        # can tell a failed export from a complete one
+        logging.error("export: %r", e)
+        await response.write(serialize.dumps({'error': str(e)}) + b'\n')
+    await response.write_eof()
+    return response
+
+
+async def metrics_view(request):
+    return web.Response(body=metrics.render().encode('utf8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def queries_view(request):
+    if not is_admin(request.headers.get('X-Admin-Token'), ADMIN_TOKEN):
+        raise web.HTTPForbidden()
+    try:
+        entries = querylog.stats.top(int(request.query.get('top', 10)),
+                                     request.query.get('order', 'total'))
+    except ValueError:
+        raise web.HTTPBadRequest()
+    return _json_response(request, {'queries': entries})
+
+
+async def live_view(request):
+    return _json_response(request, {'status': 'ok'})
+
+
+async def ready_view(request):
+    if not request.app[READY]:
+        await warm_up(request.app)
+    if not request.app[READY]:
+        return _json_response(request, {'status': 'warming up'}, 503)
+    return _json_response(request, {'status': 'ok'})
+
+
+async def warm_up(app):
+    """Create the engine, build a query of every kind and ping the engine.
+    """
+    if app.get(ENGINE) is None:
+        app[ENGINE] = create_engine()
+    for kind, kind_params in ENABLED_SEARCHES.items():
+        models._prepare(kind_params, None, 50, {}, kind=kind)
+    try:
+        app[READY] = bool(await app[ENGINE].ping())
+    except Exception as e:
+        logging.error("warm_up: %r", e)
+        app[READY] = False
+
+
+@web.middleware
+async def _preflight(request, handler):
+    if request.method == 'OPTIONS' and \
+            'Access-Control-Request-Method' in request.headers:
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = \
+            request.headers['Access-Control-Request-Method']
+        if 'Access-Control-Request-Headers' in request.headers:
+            response.headers['Access-Control-Allow-Headers'] = \
+                request.headers['Access-Control-Request-Headers']
+        return response
+    return await handler(request)
+
+
+async def _cors(request, response):
+    # As flask-cors does with supports_credentials
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+
+
+async def _close(app):
+    if app.get(ENGINE) is not None:
+        await app[ENGINE].close()
+
+
+def create(engine=None):
+    """Create application.
+
+    `engine` defaults to the one `create_engine` makes when the app starts.
+    """
+    app = web.Application(middlewares=[_preflight])
+    app[ENGINE] = engine
+    app[READY] = False
+    app.on_startup.append(warm_up)
+    app.on_response_prepare.append(_cors)
+    app.on_cleanup.append(_close)
+
+    # Same routes as `blueprint.create`, under /metastore/
+    prefix = '/metastore/'
+    app.router.add_get(prefix + 'search', search_view)
+    app.router.add_get(prefix + 'search/{kind}', search_view)
+    app.router.add_get(prefix + 'metrics', metrics_view)
+    app.router.add_get(prefix + 'admin/queries', queries_view)
+    app.router.add_post(prefix + 'msearch', multi_search_view)
+    app.router.add_get(prefix + 'export', export_view)
+    app.router.add_get(prefix + 'export/{kind}', export_view)
+    app.router.add_get(prefix + 'health/live', live_view)
+    app.router.add_get(prefix + 'health/ready', ready_view)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create(), port=int(os.environ.get('PORT') or 5000))
@@ -0,0 +1,72 @@
+import hmac
+import time
+import hashlib
+
+import jwt
+
+from .cache import ResultCache
+
+_MISSING = object()
+
+
+def is_admin(token, admin_token):
+    """Return whether `token` is the admin token.
+
+    Nobody is an admin when no admin token is set. The tokens are compared
+    as bytes in constant time, as `hmac.compare_digest` rejects non-ASCII
+    strings.
+    """
+    if not admin_token or token is None:
+        return False
+    return hmac.compare_digest(token.encode('utf8', 'surrogateescape'),
+                               admin_token.encode('utf8'))
+
+
+class TokenCache(object):
+    """Cache of verified JWTs, mapping a token digest to its userid.
+
+    Valid tokens are kept until their `exp` claim passes (or for at most
+    `ttl` seconds). Invalid tokens are cached as anonymous for `negative_ttl`
+    seconds, so resending a bad token does not cost a verification each
+    time. Everything is dropped when the verification key changes.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, negative_ttl=30):
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self._cache = ResultCache(maxsize=maxsize, ttl=ttl)
+        self._key = None
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def get_userid(self, token, key):
+        """Return the userid of a token, or None if it is invalid.
+        """
+        if key != self._key:
+            self.clear()
+            self._key = key
+        digest = hashlib.sha256(token.encode('utf8')).hexdigest()
+        userid = self._cache.get(digest, _MISSING)
+        if userid is not _MISSING:
+            return userid
+        try:
+            payload = jwt.decode(token, key)
+        except jwt.InvalidTokenError:
+            self._cache.set(digest, None, ttl=self.negative_ttl)
+            return None
+        userid = payload.get('userid')
+        ttl = self.ttl
+        if payload.get('exp') is not None:
+            ttl = min(ttl, float(payload['exp']) - time.time())
+        if ttl > 0:
+            self._cache.set(digest, userid, ttl=ttl)
+        return userid
+
+    def clear(self):
+        self._cache.clear()
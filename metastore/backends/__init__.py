@@ -0,0 +1,23 @@
+import os
+from importlib import import_module
+
+# Backend name -> class, imported on use
+BACKENDS = {
+    'elasticsearch': 'metastore.backends.elastic:ElasticsearchBackend',
+    'memory': 'metastore.backends.memory:MemoryBackend',
+    'sqlite': 'metastore.backends.sqlite:SqliteBackend',
+}
+
+
+def create(name=None):
+    """Create the search backend named `name`.
+
+    Defaults to the `METASTORE_BACKEND` environment variable, and to
+    elasticsearch when that is not set.
+    """
+    if name is None:
+        name = os.environ.get('METASTORE_BACKEND', 'elasticsearch')
+    if name not in BACKENDS:
+        raise ValueError('Unknown search backend %r' % name)
+    module, cls = BACKENDS[name].split(':')
+    return getattr(import_module(module), cls)()
@@ -0,0 +1,240 @@
+"""Text analysis matching the elasticsearch analyzers metastore relies on.
+
+Only the `standard`, `english` and `keyword` analyzers are implemented, and
+`standard` tokenization is an approximation of unicode word segmentation.
+"""
+import re
+
+# Elasticsearch's `_english_` stop words
+ENGLISH_STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if',
+    'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that',
+    'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was',
+    'will', 'with',
+])
+
+_TOKEN = re.compile(r"\w+(?:[.'’]\w+)*", re.UNICODE)
+
+
+def tokenize(text):
+    """Split text in lowercase words, like the `standard` analyzer.
+    """
+    return [t.lower() for t in _TOKEN.findall(text)]
+
+
+class PorterStemmer(object):
+    """The Porter stemming algorithm, as used by the `english` analyzer.
+    """
+
+    def __init__(self):
+        self.b = ''
+        self.k = 0
+        self.j = 0
+
+    def cons(self, i):
+        ch = self.b[i]
+        if ch in 'aeiou':
+            return False
+        if ch == 'y':
+            return i == 0 or not self.cons(i - 1)
+        return True
+
+    def m(self):
+        """Number of consonant sequences in b[0:j+1].
+        """
+        n = 0
+        i = 0
+        while True:
+            if i > self.j:
+                return n
+            if not self.cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > self.j:
+                    return n
+                if self.cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > self.j:
+                    return n
+                if not self.cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def vowelinstem(self):
+        return any(not self.cons(i) for i in range(self.j + 1))
+
+    def doublec(self, j):
+        return j >= 1 and self.b[j] == self.b[j - 1] and self.cons(j)
+
+    def cvc(self, i):
+        if i < 2 or not self.cons(i) or self.cons(i - 1) or \
+                not self.cons(i - 2):
+            return False
+        return self.b[i] not in 'wxy'
+
+    def ends(self, s):
+        length = len(s)
+        if length > self.k + 1 or self.b[self.k - length + 1:self.k + 1] != s:
+            return False
+        self.j = self.k - length
+        return True
+
+    def setto(self, s):
+        self.b = self.b[:self.j + 1] + s + self.b[self.k + 1:]
+        self.k = self.j + len(s)
+
+    def r(self, s):
+        if self.m() > 0:
+            self.setto(s)
+
+    def step1ab(self):
+        if self.b[self.k] == 's':
+            if self.ends('sses'):
+                self.k -= 2
+            elif self.ends('ies'):
+                self.setto('i')
+            elif self.b[self.k - 1] != 's':
+                self.k -= 1
+        if self.ends('eed'):
+            if self.m() > 0:
+                self.k -= 1
+        elif (self.ends('ed') or self.ends('ing')) and self.vowelinstem():
+            self.k = self.j
+            if self.ends('at'):
+                self.setto('ate')
+            elif self.ends('bl'):
+                self.setto('ble')
+            elif self.ends('iz'):
+                self.setto('ize')
+            elif self.doublec(self.k):
+                self.k -= 1
+                if self.b[self.k] in 'lsz':
+                    self.k += 1
+            else:
+                self.j = self.k
+                if self.m() == 1 and self.cvc(self.k):
+                    self.setto('e')
+
+    def step1c(self):
+        if self.ends('y') and self.vowelinstem():
+            self.b = self.b[:self.k] + 'i' + self.b[self.k + 1:]
+
+    STEP2 = {
+        'a': [('ational', 'ate'), ('tional', 'tion')],
+        'c': [('enci', 'ence'), ('anci', 'ance')],
+        'e': [('izer', 'ize')],
+        'l': [('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+              ('ousli', 'ous')],
+        'o': [('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')],
+        's': [('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'),
+              ('ousness', 'ous')],
+        't': [('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')],
+        'g': [('logi', 'log')],
+    }
+
+    STEP3 = {
+        'e': [('icate', 'ic'), ('ative', ''), ('alize', 'al')],
+        'i': [('iciti', 'ic')],
+        'l': [('ical', 'ic'), ('ful', '')],
+        's': [('ness', '')],
+    }
+
+    STEP4 = {
+        'a': ['al'],
+        'c': ['ance', 'ence'],
+        'e': ['er'],
+        'i': ['ic'],
+        'l': ['able', 'ible'],
+        'n': ['ant', 'ement', 'ment', 'ent'],
+        'o': ['ion', 'ou'],
+        's': ['ism'],
+        't': ['ate', 'iti'],
+        'u': ['ous'],
+        'v': ['ive'],
+        'z': ['ize'],
+    }
+
+    def step23(self, table, at):
+        for suffix, replacement in table.get(self.b[at], []):
+            if self.ends(suffix):
+                self.r(replacement)
+                return
+
+    def step4(self):
+        for suffix in self.STEP4.get(self.b[self.k - 1], []):
+            if self.ends(suffix):
+                if suffix == 'ion' and \
+                        (self.j < 0 or self.b[self.j] not in 'st'):
+                    return
+                if self.m() > 1:
+                    self.k = self.j
+                return
+
+    def step5(self):
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            a = self.m()
+            if a > 1 or (a == 1 and not self.cvc(self.k - 1)):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self.doublec(self.k):
+            self.j = self.k
+            if self.m() > 1:
+                self.k -= 1
+
+    def stem(self, word):
+        if len(word) <= 2:
+            return word
+        self.b = word
+        self.k = len(word) - 1
+        self.j = 0
+        self.step1ab()
+        if self.k > 0:
+            self.step1c()
+            self.step23(self.STEP2, self.k - 1)
+            self.step23(self.STEP3, self.k)
+            self.step4()
+            self.step5()
+        return self.b[:self.k + 1]
+
+
+def english(text):
+    """Analyze text like the `english` analyzer.
+    """
+    stemmer = PorterStemmer()
+    tokens = []
+    for token in tokenize(text):
+        if token.endswith("'s") or token.endswith('’s'):
+            token = token[:-2]
+        if token in ENGLISH_STOP_WORDS:
+            continue
+        tokens.append(stemmer.stem(token))
+    return tokens
+
+
+def standard(text):
+    return tokenize(text)
+
+
+def keyword(text):
+    return [text]
+
+
+ANALYZERS = {
+    'standard': standard,
+    'english': english,
+    'keyword': keyword,
+}
+
+
+def analyze(analyzer, value):
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    return ANALYZERS[analyzer](str(value))
@@ -0,0 +1,162 @@
+import json
+import fnmatch
+
+from elasticsearch.exceptions import TransportError
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _path_matches(pattern, path):
+    return fnmatch.fnmatchcase(path, pattern) or \
+        path.startswith(pattern + '.')
+
+
+def filter_source(source, includes, excludes, prefix=''):
+    """Filter a document source like elasticsearch `_source` filtering.
+    """
+    ret = {}
+    for key, value in source.items():
+        path = prefix + key
+        if any(_path_matches(p, path) for p in excludes):
+            continue
+        included = not includes or \
+            any(_path_matches(p, path) for p in includes)
+        if isinstance(value, dict) or (
+                isinstance(value, list) and value and
+                all(isinstance(v, dict) for v in value)):
+            sub_includes = [] if included else includes
+            if isinstance(value, dict):
+                value = filter_source(value, sub_includes, excludes,
+                                      path + '.')
+            else:
+                value = [filter_source(v, sub_includes, excludes, path + '.')
+                         for v in value]
+                value = [v for v in value if v]
+            if value or included:
+                ret[key] = value
+        elif included:
+            ret[key] = value
+    return ret
+
+
+def source_filter(spec):
+    """Return (includes, excludes) of a `_source` request option.
+    """
+    if spec is None or spec is True:
+        return [], []
+    if spec is False:
+        return None, None
+    if isinstance(spec, (str, list)):
+        return as_list(spec), []
+    return (as_list(spec.get('includes', spec.get('include'))),
+            as_list(spec.get('excludes', spec.get('exclude'))))
+
+
+def field_spec(mapping):
+    """Return the (type, analyzer) of an elasticsearch field mapping.
+    """
+    ftype = mapping.get('type', 'object')
+    if ftype == 'string':
+        if mapping.get('index') == 'not_analyzed':
+            return ('keyword', None)
+        return ('text', mapping.get('analyzer', 'standard'))
+    if ftype == 'text':
+        return ('text', mapping.get('analyzer', 'standard'))
+    if ftype in ('integer', 'long', 'short', 'byte'):
+        return ('long', None)
+    if ftype in ('float', 'double', 'half_float', 'scaled_float'):
+        return ('double', None)
+    return (ftype, None)
+
+
+def flatten_mapping(properties, prefix=''):
+    for name, mapping in properties.items():
+        path = prefix + name
+        if 'properties' in mapping:
+            for item in flatten_mapping(mapping['properties'], path + '.'):
+                yield item
+        else:
+            yield path, field_spec(mapping)
+
+
+def index_stats(index, docs, index_total, delete_total=0):
+    """Return an `indices.stats` response for a single shard index.
+    """
+    stats = {
+        'docs': {'count': docs, 'deleted': 0},
+        'indexing': {'index_total': index_total,
+                     'delete_total': delete_total},
+        'refresh': {'total': 0},
+    }
+    shard = {'primaries': stats, 'total': stats}
+    return {
+        '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+        '_all': shard,
+        'indices': {index: shard},
+    }
+
+
+class Backend(object):
+    """Search backend interface.
+
+    Backends implement the subset of the elasticsearch client API metastore
+    uses, with the same arguments and the same request and response
+    structures, so `models` does not depend on where documents are stored.
+    They also provide an `indices` object with `create`, `delete`,
+    `exists`, `put_mapping`, `refresh`, `flush` and `stats`.
+
+    A backend has to answer the query shapes `models.build_dsl` produces:
+    `bool` (`must`/`filter`/`should`/`must_not`), `match`, `term`, `terms`,
+    `multi_match` with field boosts, sorting on a field with `search_after`,
+    `_source` filtering and the `sum` aggregation.
+    """
+
+    indices = None
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        """Run a search request and return the response.
+        """
+        raise NotImplementedError()
+
+    def msearch(self, body, **params):
+        """Run several searches (newline delimited header/body pairs).
+
+        Searches run one after the other; a failing search gets an error
+        response without affecting the others.
+        """
+        if isinstance(body, (str, bytes)):
+            if isinstance(body, bytes):
+                body = body.decode('utf8')
+            body = [json.loads(line) for line in body.splitlines()
+                    if line.strip()]
+        responses = []
+        for header, request in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(
+                    index=header.get('index'), doc_type=header.get('type'),
+                    body=request))
+            except TransportError as e:
+                responses.append({
+                    'error': {'type': e.error, 'reason': str(e.info)},
+                    'status': e.status_code,
+                })
+        return {'responses': responses}
+
+    def scan(self, query=None, index=None, doc_type=None, **params):
+        """Iterate over every hit of a query, in no particular order.
+        """
+        raise NotImplementedError()
+
+    def index(self, index, doc_type, body, id=None, **params):
+        """Add or replace a document.
+        """
+        raise NotImplementedError()
+
+    def ping(self, **params):
+        """Return True if the backend is reachable.
+        """
+        raise NotImplementedError()
@@ -0,0 +1,85 @@
+import os
+
+from elasticsearch import Elasticsearch, helpers
+
+from .base import Backend
+
+
+def _flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+def hosts():
+    """Elasticsearch nodes, from the comma separated
+    `DATAHUB_ELASTICSEARCH_ADDRESS`.
+    """
+    return [host.strip() for host in
+            os.environ['DATAHUB_ELASTICSEARCH_ADDRESS'].split(',')
+            if host.strip()]
+
+
+def client_options():
+    """Elasticsearch client options, from the environment.
+    """
+    options = {
+        # Connections kept open to each node; one per worker thread avoids
+        # waiting for a connection
+        'maxsize': int(os.environ.get('METASTORE_ES_POOL_SIZE', 10)),
+        'timeout': float(os.environ.get('METASTORE_ES_TIMEOUT', 10)),
+        'max_retries': int(os.environ.get('METASTORE_ES_MAX_RETRIES', 3)),
+        # A timed out search is retried on another node
+        'retry_on_timeout': _flag('METASTORE_ES_RETRY_ON_TIMEOUT', 'true'),
+    }
+    if _flag('METASTORE_ES_SNIFF', 'false'):
+        # Discover the cluster's nodes, and rediscover them periodically and
+        # when one fails
+        options.update({
+            'sniff_on_start': True,
+            'sniff_on_connection_fail': True,
+            'sniffer_timeout': float(
+                os.environ.get('METASTORE_ES_SNIFF_INTERVAL', 60)),
+        })
+    return options
+
+
+class ElasticsearchBackend(Backend):
+    """Backend delegating to an elasticsearch cluster.
+
+    Without a `client`, one is created on first use from the environment
+    (see `hosts` and `client_options`), and created again in a forked
+    process, so that workers never share connections with their parent.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._pid = os.getpid() if client is not None else None
+        self._owned = client is None
+
+    @property
+    def client(self):
+        if self._client is None or \
+                (self._owned and self._pid != os.getpid()):
+            self._client = Elasticsearch(hosts(), **client_options())
+            self._pid = os.getpid()
+        return self._client
+
+    @property
+    def indices(self):
+        return self.client.indices
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        return self.client.search(index=index, doc_type=doc_type, body=body,
+                                  **params)
+
+    def msearch(self, body, **params):
+        return self.client.msearch(body=body, **params)
+
+    def scan(self, query=None, index=None, doc_type=None, **params):
+        return helpers.scan(self.client, query=query, index=index,
+                            doc_type=doc_type, **params)
+
+    def index(self, index, doc_type, body, id=None, **params):
+        return self.client.index(index, doc_type, body, id=id, **params)
+
+    def ping(self, **params):
+        return self.client.ping(**params)
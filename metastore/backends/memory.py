@@ -0,0 +1,671 @@
+import re
+import json
+import math
+import time
+import calendar
+import datetime
+import functools
+import threading
+
+from elasticsearch.exceptions import NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+
+from .analysis import analyze
+from .base import (Backend, as_list, filter_source, flatten_mapping,
+                   index_stats, source_filter)
+
+# BM25 parameters (elasticsearch defaults)
+K1 = 1.2
+B = 0.75
+
+DEFAULT_SIZE = 10
+
+_DATE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+_serializer = JSONSerializer()
+
+
+def _parse_date(value):
+    """Return the epoch milliseconds of an ISO 8601 date, or None.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _DATE.match(str(value))
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    try:
+        dt = datetime.datetime(int(year), int(month), int(day),
+                               int(hour or 0), int(minute or 0),
+                               int(second or 0))
+    except ValueError:
+        return None
+    ms = calendar.timegm(dt.timetuple()) * 1000
+    if fraction:
+        ms += int(fraction[:3].ljust(3, '0'))
+    if tz and tz != 'Z':
+        offset = tz[1:].replace(':', '')
+        offset = (int(offset[:2]) * 60 + int(offset[2:])) * 60000
+        ms -= offset if tz[0] == '+' else -offset
+    return ms
+
+
+def _dynamic_spec(value):
+    """Return the (type, analyzer) elasticsearch would map a new field to.
+    """
+    if isinstance(value, bool):
+        return ('boolean', None)
+    if isinstance(value, int):
+        return ('long', None)
+    if isinstance(value, float):
+        return ('double', None)
+    if _parse_date(value) is not None:
+        return ('date', None)
+    return ('text', 'standard')
+
+
+def _exact(ftype, value):
+    """Normalize a value to the term it is indexed as in a non-text field.
+
+    Returns None if the value can not be converted to the field's type.
+    """
+    try:
+        if ftype == 'boolean':
+            if isinstance(value, str):
+                return value if value in ('true', 'false') else None
+            return 'true' if value else 'false'
+        if ftype == 'long':
+            return int(float(value))
+        if ftype == 'double':
+            return float(value)
+        if ftype == 'date':
+            return _parse_date(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _flatten(source, prefix=''):
+    for key, value in source.items():
+        path = prefix + key
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            if isinstance(value, dict):
+                for item in _flatten(value, path + '.'):
+                    yield item
+            elif value is not None:
+                yield path, value
+
+
+def _compare(a, b, orders):
+    for x, y, order in zip(a, b, orders):
+        if x == y:
+            continue
+        # Missing values sort last in either order
+        if x is None:
+            return 1
+        if y is None:
+            return -1
+        c = (x > y) - (x < y)
+        return c if order == 'asc' else -c
+    return 0
+
+
+def _bad_request(reason):
+    return RequestError(400, 'parsing_exception', {'error': {
+        'type': 'parsing_exception', 'reason': reason}})
+
+
+class _Index(object):
+    """Documents of an index, with an inverted index per field.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.mappings = {}     # path -> (type, analyzer)
+        self.subfields = {}    # path -> dynamic `.keyword` subfield
+        self.docs = {}         # docid -> (doc_type, id, source)
+        self.ids = {}          # (doc_type, id) -> docid
+        self.postings = {}     # path -> term -> {docid: term frequency}
+        self.lengths = {}      # path -> {docid: number of terms}
+        self.total_lengths = {}
+        self.values = {}       # path -> {docid: [values]}
+        self.version = 0
+        self._next_docid = 0
+
+    def put_mapping(self, properties):
+        for path, spec in flatten_mapping(properties):
+            self.mappings.setdefault(path, spec)
+
+    def add(self, doc_type, id, source):
+        if (doc_type, id) in self.ids:
+            self.remove(self.ids[(doc_type, id)])
+        docid = self._next_docid
+        self._next_docid += 1
+        self.docs[docid] = (doc_type, id, source)
+        self.ids[(doc_type, id)] = docid
+        for path, value in _flatten(source):
+            spec = self.mappings.get(path)
+            if spec is None:
+                spec = self.mappings[path] = _dynamic_spec(value)
+                if spec[0] == 'text':
+                    keyword = self.subfields[path] = path + '.keyword'
+                    self.mappings[keyword] = ('keyword', None)
+            self._add_value(docid, path, spec, value)
+            if path in self.subfields:
+                self._add_value(docid, self.subfields[path],
+                                ('keyword', None), value)
+        self.version += 1
+        return docid
+
+    def _add_value(self, docid, path, spec, value):
+        ftype, analyzer = spec
+        if ftype == 'text':
+            terms = analyze(analyzer, value)
+            exact = value
+        else:
+            exact = _exact(ftype, value)
+            if exact is None:
+                raise RequestError(400, 'mapper_parsing_exception', {
+                    'error': {'reason': 'failed to parse [%s]' % path}})
+            terms = [exact]
+        postings = self.postings.setdefault(path, {})
+        for term in terms:
+            docs = postings.setdefault(term, {})
+            docs[docid] = docs.get(docid, 0) + 1
+        lengths = self.lengths.setdefault(path, {})
+        lengths[docid] = lengths.get(docid, 0) + len(terms)
+        self.total_lengths[path] = \
+            self.total_lengths.get(path, 0) + len(terms)
+        self.values.setdefault(path, {}).setdefault(docid, []).append(exact)
+
+    def remove(self, docid):
+        doc_type, id, _ = self.docs.pop(docid)
+        del self.ids[(doc_type, id)]
+        for path, postings in self.postings.items():
+            for term in list(postings):
+                postings[term].pop(docid, None)
+                if not postings[term]:
+                    del postings[term]
+            length = self.lengths[path].pop(docid, 0)
+            self.total_lengths[path] -= length
+            self.values[path].pop(docid, None)
+        self.version += 1
+
+
+class _Searcher(object):
+    """Evaluates query DSL against an index.
+
+    Queries evaluate to a mapping of matching docids to their score.
+    """
+
+    def __init__(self, index, docids):
+        self.index = index
+        self.docids = docids
+
+    def evaluate(self, query):
+        if not isinstance(query, dict) or len(query) != 1:
+            raise _bad_request('query malformed, expected a single clause')
+        (name, params), = query.items()
+        handler = getattr(self, '_q_' + name, None)
+        if handler is None:
+            raise _bad_request('no [query] registered for [%s]' % name)
+        return handler(params)
+
+    # Helpers
+
+    def _spec(self, field):
+        return self.index.mappings.get(field)
+
+    def _term_scores(self, field, term, boost=1.0):
+        docs = self.index.postings.get(field, {}).get(term)
+        if not docs:
+            return {}
+        lengths = self.index.lengths[field]
+        count = len(lengths)
+        idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+        norms = self._spec(field)[0] == 'text'
+        average = float(self.index.total_lengths[field]) / count
+        scores = {}
+        for docid, tf in docs.items():
+            if docid not in self.docids:
+                continue
+            norm = K1
+            if norms and average:
+                norm = K1 * (1 - B + B * lengths[docid] / average)
+            scores[docid] = boost * idf * tf * (K1 + 1) / (tf + norm)
+        return scores
+
+    def _query_terms(self, field, value):
+        spec = self._spec(field)
+        if spec is None:
+            return []
+        ftype, analyzer = spec
+        if ftype == 'text':
+            return analyze(analyzer, value)
+        term = _exact(ftype, value)
+        return [] if term is None else [term]
+
+    def _field_match(self, field, value, boost=1.0, operator='or'):
+        scores = {}
+        terms = self._query_terms(field, value)
+        for i, term in enumerate(terms):
+            term_scores = self._term_scores(field, term, boost)
+            if operator == 'and' and i > 0:
+                scores = dict((d, s + term_scores[d])
+                              for d, s in scores.items() if d in term_scores)
+            else:
+                for docid, score in term_scores.items():
+                    scores[docid] = scores.get(docid, 0) + score
+            if operator == 'and' and not scores:
+                break
+        return scores
+
+    @staticmethod
+    def _single_field(params):
+        params = dict(params)
+        boost = params.pop('boost', 1.0)
+        if len(params) != 1:
+            raise _bad_request('query malformed, expected a single field')
+        (field, value), = params.items()
+        return field, value, boost
+
+    # Queries
+
+    def _q_match_all(self, params):
+        boost = params.get('boost', 1.0)
+        return dict((d, boost) for d in self.docids)
+
+    def _q_match(self, params):
+        field, value, _ = self._single_field(params)
+        boost, operator = 1.0, 'or'
+        if isinstance(value, dict):
+            boost = value.get('boost', 1.0)
+            operator = value.get('operator', 'or').lower()
+            value = value['query']
+        return self._field_match(field, value, boost, operator)
+
+    def _q_term(self, params):
+        field, value, boost = self._single_field(params)
+        if isinstance(value, dict):
+            boost = value.get('boost', boost)
+            value = value['value']
+        spec = self._spec(field)
+        if spec is None:
+            return {}
+        term = value if spec[0] == 'text' else _exact(spec[0], value)
+        return self._term_scores(field, term, boost)
+
+    def _q_terms(self, params):
+        field, values, boost = self._single_field(params)
+        scores = {}
+        for value in values:
+            for docid in self._q_term({field: value}):
+                scores[docid] = boost
+        return scores
+
+    def _q_exists(self, params):
+        values = self.index.values.get(params['field'], {})
+        return dict((d, 1.0) for d in values if d in self.docids)
+
+    def _q_range(self, params):
+        field, bounds, _ = self._single_field(params)
+        spec = self._spec(field)
+        if spec is None:
+            return {}
+        bounds = dict((op, _exact(spec[0], v)) for op, v in bounds.items()
+                      if op in ('gt', 'gte', 'lt', 'lte'))
+        checks = {
+            'gt': lambda v, b: v > b, 'gte': lambda v, b: v >= b,
+            'lt': lambda v, b: v < b, 'lte': lambda v, b: v <= b,
+        }
+        scores = {}
+        for docid, values in self.index.values.get(field, {}).items():
+            if docid in self.docids and any(
+                    all(checks[op](v, b) for op, b in bounds.items())
+                    for v in values):
+                scores[docid] = 1.0
+        return scores
+
+    def _q_multi_match(self, params):
+        fields = params.get('fields') or [
+            path for path, spec in self.index.mappings.items()
+            if spec[0] == 'text']
+        mode = params.get('type', 'best_fields')
+        if mode not in ('best_fields', 'most_fields'):
+            raise _bad_request('multi_match type [%s] not supported' % mode)
+        per_field = []
+        for field in fields:
+            boost = 1.0
+            if '^' in field:
+                field, boost = field.split('^', 1)
+                boost = float(boost)
+            per_field.append(self._field_match(
+                field, params['query'], boost,
+                params.get('operator', 'or').lower()))
+        scores = {}
+        tie_breaker = params.get('tie_breaker', 0.0)
+        for docid in set().union(*per_field) if per_field else ():
+            matched = [s[docid] for s in per_field if docid in s]
+            if mode == 'most_fields':
+                scores[docid] = sum(matched)
+            else:
+                best = max(matched)
+                scores[docid] = best + tie_breaker * (sum(matched) - best)
+        return scores
+
+    def _q_bool(self, params):
+        must = [self.evaluate(q) for q in as_list(params.get('must'))]
+        filters = [self.evaluate(q) for q in as_list(params.get('filter'))]
+        must_not = [self.evaluate(q)
+                    for q in as_list(params.get('must_not'))]
+        should = [self.evaluate(q) for q in as_list(params.get('should'))]
+
+        minimum = params.get('minimum_should_match')
+        if minimum is None:
+            minimum = 0 if must or filters or not should else 1
+        try:
+            minimum = int(minimum)
+        except ValueError:
+            raise _bad_request('minimum_should_match [%s] not supported' %
+                               minimum)
+
+        candidates = None
+        for clause in must + filters:
+            candidates = set(clause) if candidates is None \
+                else candidates.intersection(clause)
+        if minimum > 0:
+            counts = {}
+            for clause in should:
+                for docid in clause:
+                    counts[docid] = counts.get(docid, 0) + 1
+            matched = set(d for d, c in counts.items() if c >= minimum)
+            candidates = matched if candidates is None \
+                else candidates.intersection(matched)
+        if candidates is None:
+            candidates = set(self.docids)
+        for clause in must_not:
+            candidates.difference_update(clause)
+
+        boost = params.get('boost', 1.0)
+        scores = {}
+        for docid in candidates:
+            score = sum(clause[docid] for clause in must)
+            score += sum(clause[docid] for clause in should
+                         if docid in clause)
+            scores[docid] = boost * score
+        return scores
+
+    # Sorting
+
+    def sort_spec(self, sort):
+        spec = []
+        for item in as_list(sort):
+            if isinstance(item, str):
+                field = item
+                order = 'desc' if field == '_score' else 'asc'
+            else:
+                (field, options), = item.items()
+                if isinstance(options, dict):
+                    order = options.get('order', 'asc')
+                else:
+                    order = options
+            spec.append((field, order))
+        return spec
+
+    def sort_values(self, docid, score, spec):
+        values = []
+        for field, order in spec:
+            if field == '_score':
+                values.append(score)
+            elif field == '_doc':
+                values.append(docid)
+            elif field == '_uid':
+                doc_type, id, _ = self.index.docs[docid]
+                values.append('%s#%s' % (doc_type, id))
+            else:
+                field_values = self.index.values.get(field, {}).get(docid)
+                if not field_values:
+                    values.append(None)
+                elif order == 'desc':
+                    values.append(max(field_values))
+                else:
+                    values.append(min(field_values))
+        return values
+
+    # Aggregations
+
+    def aggregate(self, aggs, docids):
+        ret = {}
+        for name, agg in aggs.items():
+            if 'sum' in agg:
+                values = self.index.values.get(agg['sum']['field'], {})
+                total = 0.0
+                for docid in docids:
+                    for value in values.get(docid, ()):
+                        if isinstance(value, (int, float)) and \
+                                not isinstance(value, bool):
+                            total += value
+                ret[name] = {'value': total}
+            elif 'terms' in agg:
+                ret[name] = self._terms(agg['terms'], docids)
+            elif 'filter' in agg:
+                matching = self.evaluate(agg['filter'])
+                sub_docids = [docid for docid in docids
+                              if docid in matching]
+                ret[name] = self.aggregate(agg.get('aggs', {}), sub_docids)
+                ret[name]['doc_count'] = len(sub_docids)
+            else:
+                raise _bad_request('aggregation [%s] not supported' % name)
+        return ret
+
+    def _terms(self, params, docids):
+        spec = self._spec(params['field'])
+        if spec is not None and spec[0] == 'text':
+            raise _bad_request(
+                'Fielddata is disabled on text fields by default [%s]' %
+                params['field'])
+        values = self.index.values.get(params['field'], {})
+        counts = {}
+        for docid in docids:
+            for value in set(values.get(docid, ())):
+                counts[value] = counts.get(value, 0) + 1
+        # Most frequent first, then by value
+        ranked = sorted(counts.items(),
+                        key=lambda item: (-item[1], str(item[0])))
+        size = int(params.get('size', 10))
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(n for _, n in ranked[size:]),
+            'buckets': [{'key': value, 'doc_count': count}
+                        for value, count in ranked[:size]],
+        }
+
+
+class _Indices(object):
+    """Index management, mirroring `elasticsearch.client.IndicesClient`.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, index, body=None, **params):
+        with self.backend._lock:
+            if index in self.backend._indices:
+                raise RequestError(400, 'index_already_exists_exception', {
+                    'error': {'reason': 'index [%s] already exists' % index}})
+            idx = self.backend._indices[index] = _Index(index)
+            for mapping in (body or {}).get('mappings', {}).values():
+                idx.put_mapping(mapping.get('properties', {}))
+        return {'acknowledged': True}
+
+    def delete(self, index, **params):
+        with self.backend._lock:
+            self.backend._get_index(index)
+            del self.backend._indices[index]
+        return {'acknowledged': True}
+
+    def exists(self, index, **params):
+        return index in self.backend._indices
+
+    def put_mapping(self, doc_type=None, body=None, index=None, **params):
+        with self.backend._lock:
+            idx = self.backend._get_index(index)
+            body = body or {}
+            mapping = body.get(doc_type, body)
+            idx.put_mapping(mapping.get('properties', {}))
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    flush = refresh
+
+    def stats(self, index=None, metric=None, **params):
+        with self.backend._lock:
+            idx = self.backend._get_index(index)
+            return index_stats(index, len(idx.docs), idx.version)
+
+
+class MemoryBackend(Backend):
+    """Pure python, in-process search backend.
+
+    Documents are kept in memory with an inverted index per field and
+    searched with BM25 scoring, like elasticsearch does. Meant for tests,
+    development and small deployments; nothing is persisted.
+    """
+
+    def __init__(self):
+        self._indices = {}
+        self._lock = threading.RLock()
+        self.indices = _Indices(self)
+
+    def _get_index(self, index):
+        idx = self._indices.get(index)
+        if idx is None:
+            raise NotFoundError(404, 'index_not_found_exception', {
+                'error': {'reason': 'no such index', 'index': index}})
+        return idx
+
+    def index(self, index, doc_type, body, id=None, **params):
+        # Store the source as elasticsearch would return it
+        source = json.loads(_serializer.dumps(body))
+        with self._lock:
+            idx = self._indices.get(index)
+            if idx is None:
+                idx = self._indices[index] = _Index(index)
+            if id is None:
+                id = 'doc%d' % idx._next_docid
+            created = (doc_type, str(id)) not in idx.ids
+            idx.add(doc_type, str(id), source)
+        return {
+            '_index': index,
+            '_type': doc_type,
+            '_id': str(id),
+            'created': created,
+            'result': 'created' if created else 'updated',
+        }
+
+    def _matches(self, idx, doc_type, query):
+        docids = set(docid for docid, (dtype, _, _) in idx.docs.items()
+                     if doc_type is None or dtype == doc_type)
+        searcher = _Searcher(idx, docids)
+        return searcher, searcher.evaluate(query or {'match_all': {}})
+
+    def _hit(self, idx, docid, score, includes, excludes):
+        doc_type, id, source = idx.docs[docid]
+        hit = {
+            '_index': idx.name,
+            '_type': doc_type,
+            '_id': id,
+            '_score': score,
+        }
+        if includes is not None:
+            hit['_source'] = filter_source(source, includes, excludes)
+        return hit
+
+    def search(self, index=None, doc_type=None, body=None, size=None,
+               from_=None, **params):
+        start = time.time()
+        if isinstance(body, (str, bytes)):
+            body = json.loads(body)
+        body = body or {}
+        size = int(size if size is not None else body.get('size', DEFAULT_SIZE))
+        from_ = int(from_ if from_ is not None else body.get('from', 0))
+
+        with self._lock:
+            idx = self._get_index(index)
+            searcher, scores = self._matches(idx, doc_type, body.get('query'))
+            aggregations = None
+            if body.get('aggs') or body.get('aggregations'):
+                aggregations = searcher.aggregate(
+                    body.get('aggs') or body.get('aggregations'), scores)
+            if 'post_filter' in body:
+                post_filter = searcher.evaluate(body['post_filter'])
+                scores = dict((d, s) for d, s in scores.items()
+                              if d in post_filter)
+
+            spec = searcher.sort_spec(body.get('sort')) or \
+                [('_score', 'desc'), ('_doc', 'asc')]
+            orders = [order for _, order in spec]
+            keyed = [(searcher.sort_values(d, s, spec), d, s)
+                     for d, s in scores.items()]
+            keyed.sort(key=functools.cmp_to_key(
+                lambda a, b: _compare(a[0], b[0], orders)))
+            if body.get('search_after') is not None:
+                after = body['search_after']
+                keyed = [k for k in keyed if _compare(k[0], after, orders) > 0]
+
+            includes, excludes = source_filter(body.get('_source'))
+            field_sort = bool(body.get('sort'))
+            hits = []
+            for values, docid, score in keyed[from_:from_ + size]:
+                hit = self._hit(idx, docid, None if field_sort else score,
+                                includes, excludes)
+                if field_sort:
+                    hit['sort'] = values
+                if body.get('explain'):
+                    # Only the total, not how each clause contributed
+                    hit['_explanation'] = {
+                        'value': score,
+                        'description': 'sum of the matching clause scores',
+                        'details': []}
+                hits.append(hit)
+
+        ret = {
+            'took': int((time.time() - start) * 1000),
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(scores),
+                'max_score': max(scores.values()) if scores else None,
+                'hits': hits,
+            },
+        }
+        if aggregations is not None:
+            ret['aggregations'] = aggregations
+        return ret
+
+    def scan(self, query=None, index=None, doc_type=None, **params):
+        query = dict(query or {})
+        slice_ = query.get('slice')
+        with self._lock:
+            idx = self._get_index(index)
+            _, scores = self._matches(idx, doc_type, query.get('query'))
+            includes, excludes = source_filter(query.get('_source'))
+            hits = []
+            for docid in sorted(scores):
+                if slice_ and docid % slice_['max'] != slice_['id']:
+                    continue
+                hits.append(self._hit(idx, docid, None, includes, excludes))
+        return iter(hits)
+
+    def ping(self, **params):
+        return True
@@ -0,0 +1,746 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import threading
+
+from elasticsearch.exceptions import NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+
+from .analysis import ENGLISH_STOP_WORDS, tokenize
+from .base import (Backend, as_list, filter_source, flatten_mapping,
+                   index_stats, source_filter)
+
+DEFAULT_SIZE = 10
+
+# Column holding all text of a document, for indices without `q_fields`
+ALL_FIELD = '_all'
+
+_SAFE_PATH = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$')
+
+_serializer = JSONSerializer()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS indices (
+    name TEXT PRIMARY KEY,
+    fields TEXT NOT NULL,
+    keywords TEXT NOT NULL DEFAULT '[]',
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    idx TEXT NOT NULL,
+    doc_type TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    UNIQUE (idx, doc_type, doc_id)
+);
+'''
+
+
+def _bad_request(reason):
+    return RequestError(400, 'parsing_exception', {'error': {
+        'type': 'parsing_exception', 'reason': reason}})
+
+
+def _column(field):
+    return field.replace('.', '__')
+
+
+def _fts_table(index):
+    return 'fts_' + re.sub(r'[^A-Za-z0-9_]', '_', index)
+
+
+def _json_value(value):
+    # json_extract returns booleans as integers
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _text(value):
+    if isinstance(value, dict):
+        return ' '.join(_text(v) for v in value.values())
+    if isinstance(value, list):
+        return ' '.join(_text(v) for v in value)
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _get_path(source, field):
+    for part in field.split('.'):
+        if isinstance(source, dict):
+            source = source.get(part)
+        else:
+            return None
+    return source
+
+
+def _fts_query(text, columns):
+    """Build an FTS5 query matching any non stop word of a text.
+    """
+    terms = [t for t in tokenize(str(text)) if t not in ENGLISH_STOP_WORDS]
+    if not terms:
+        return None
+    terms = ' OR '.join('"%s"' % t.replace('"', '""') for t in terms)
+    return '{%s} : (%s)' % (' '.join(columns), terms)
+
+
+class _Clause(object):
+    """A compiled query clause: a SQL condition, with an optional score.
+    """
+
+    def __init__(self, where, params=(), score=None, score_params=()):
+        self.where = where
+        self.params = list(params)
+        self.score = score
+        self.score_params = list(score_params)
+
+
+class _Compiler(object):
+    """Compiles query DSL to SQL over the `docs` table.
+
+    The first scored full text query is joined as `ft`, so that its BM25
+    rank can be used in the score; other full text queries only filter.
+    """
+
+    def __init__(self, backend, index, doc_type):
+        self.backend = backend
+        self.index = index
+        self.doc_type = doc_type
+        self.fields, self.keywords = backend._mapping(index)
+        self.join = None
+        self.join_params = []
+
+    def compile(self, query, scored=True):
+        if not isinstance(query, dict) or len(query) != 1:
+            raise _bad_request('query malformed, expected a single clause')
+        (name, params), = query.items()
+        handler = getattr(self, '_q_' + name, None)
+        if handler is None:
+            raise _bad_request('no [query] registered for [%s]' % name)
+        return handler(params, scored)
+
+    # Helpers
+
+    def path(self, field, params):
+        """SQL expression extracting a field, appending its parameters.
+        """
+        if _SAFE_PATH.match(field):
+            # Inlined, so that expression indexes can be used
+            return "json_extract(source, '$.%s')" % field
+        params.append('$."%s"' % field.replace('"', ''))
+        return 'json_extract(source, ?)'
+
+    def _idf(self, field, value):
+        """BM25 idf of an exact value, as elasticsearch scores keywords.
+        """
+        params = []
+        path = self.path(field, params)
+        total, matching = self.backend._conn().execute(
+            'SELECT COUNT(%s), SUM(%s = ?) FROM docs '
+            'WHERE idx = ? AND doc_type = ?' % (path, path),
+            params + params[:] + [_json_value(value), self.index,
+                                  self.doc_type]).fetchone()
+        matching = matching or 0
+        if not matching:
+            return 0.0
+        return math.log(1 + (total - matching + 0.5) / (matching + 0.5))
+
+    @staticmethod
+    def _any(clauses, scored):
+        """Clause matching any of `clauses`, scored with their sum.
+        """
+        if len(clauses) == 1:
+            return clauses[0]
+        where, params, score, score_params = [], [], [], []
+        for clause in clauses:
+            where.append('(%s)' % clause.where)
+            params.extend(clause.params)
+            if scored:
+                score.append('CASE WHEN (%s) THEN %s ELSE 0 END' % (
+                    clause.where, clause.score))
+                score_params.extend(clause.params + clause.score_params)
+        return _Clause(' OR '.join(where) or '0', params,
+                       ' + '.join(score) or None, score_params)
+
+    def _fts(self, text, fields, boost, scored, mode='best_fields'):
+        # Keyword fields are not in the FTS table, and match whole values
+        clauses = [self._equals(f, text, float(boost) * b, scored)
+                   for f, b in fields if f in self.keywords]
+        weights = dict((_column(f), b) for f, b in fields
+                       if f not in self.keywords)
+        columns = [c for c in self.fields if c in weights]
+        match = _fts_query(text, columns) if columns else None
+        table = _fts_table(self.index)
+        if match is None:
+            pass
+        elif scored and self.join is None:
+            # One BM25 per field, summed (most_fields) or the best one
+            ranks = ['-bm25(%s, %s)' % (table, ', '.join(
+                str(float(weights[c]) if c == column else 0.0)
+                for c in self.fields)) for column in columns]
+            rank = ' + '.join(ranks) if mode == 'most_fields' or \
+                len(ranks) == 1 else 'max(%s)' % ', '.join(ranks)
+            self.join = ('LEFT JOIN (SELECT rowid, %s AS rank '
+                         'FROM %s WHERE %s MATCH ?) AS ft '
+                         'ON ft.rowid = docs.id' % (rank, table, table))
+            self.join_params = [match]
+            clauses.insert(0, _Clause(
+                'ft.rowid IS NOT NULL', (),
+                'COALESCE(ft.rank, 0) * %r' % float(boost)))
+        else:
+            clauses.insert(0, _Clause(
+                'docs.id IN (SELECT rowid FROM %s WHERE %s MATCH ?)' % (
+                    table, table), [match],
+                '%r' % float(boost) if scored else None))
+        if not clauses:
+            return _Clause('0')
+        return self._any(clauses, scored)
+
+    def _equals(self, field, value, boost, scored):
+        params = []
+        where = '%s = ?' % self.path(field, params)
+        params.append(_json_value(value))
+        score = None
+        if scored:
+            score = '%r' % (float(boost) * self._idf(field, value))
+        return _Clause(where, params, score)
+
+    @staticmethod
+    def _single_field(params):
+        params = dict(params)
+        boost = params.pop('boost', 1.0)
+        if len(params) != 1:
+            raise _bad_request('query malformed, expected a single field')
+        (field, value), = params.items()
+        return field, value, boost
+
+    # Queries
+
+    def _q_match_all(self, params, scored):
+        return _Clause('1', (), '%r' % float(params.get('boost', 1.0)))
+
+    def _q_match(self, params, scored):
+        field, value, boost = self._single_field(params)
+        if isinstance(value, dict):
+            boost = value.get('boost', boost)
+            value = value['query']
+        if isinstance(value, str) and _column(field) in self.fields:
+            return self._fts(value, [(field, 1.0)], boost, scored)
+        return self._equals(field, value, boost, scored)
+
+    def _q_term(self, params, scored):
+        field, value, boost = self._single_field(params)
+        if isinstance(value, dict):
+            boost = value.get('boost', boost)
+            value = value['value']
+        return self._equals(field, value, boost, scored)
+
+    def _q_terms(self, params, scored):
+        field, values, boost = self._single_field(params)
+        if not values:
+            return _Clause('0')
+        where_params = []
+        path = self.path(field, where_params)
+        where_params.extend(_json_value(v) for v in values)
+        return _Clause('%s IN (%s)' % (path, ', '.join('?' * len(values))),
+                       where_params, '%r' % float(boost) if scored else None)
+
+    def _q_exists(self, params, scored):
+        where_params = []
+        return _Clause('%s IS NOT NULL' % self.path(params['field'],
+                                                    where_params),
+                       where_params, '1.0' if scored else None)
+
+    def _q_range(self, params, scored):
+        field, bounds, boost = self._single_field(params)
+        ops = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+        where, where_params = [], []
+        for op, value in bounds.items():
+            if op in ops:
+                where.append('%s %s ?' % (self.path(field, where_params),
+                                          ops[op]))
+                where_params.append(_json_value(value))
+        return _Clause(' AND '.join(where) or '1', where_params,
+                       '%r' % float(boost) if scored else None)
+
+    def _q_multi_match(self, params, scored):
+        mode = params.get('type', 'best_fields')
+        if mode not in ('best_fields', 'most_fields'):
+            raise _bad_request('multi_match type [%s] not supported' % mode)
+        fields = []
+        for field in params.get('fields') or [ALL_FIELD]:
+            boost = 1.0
+            if '^' in field:
+                field, boost = field.split('^', 1)
+                boost = float(boost)
+            fields.append((field, boost))
+        return self._fts(params['query'], fields, 1.0, scored, mode)
+
+    def _q_bool(self, params, scored):
+        must = [self.compile(q, scored) for q in as_list(params.get('must'))]
+        filters = [self.compile(q, False)
+                   for q in as_list(params.get('filter'))]
+        must_not = [self.compile(q, False)
+                    for q in as_list(params.get('must_not'))]
+        should = [self.compile(q, scored)
+                  for q in as_list(params.get('should'))]
+
+        minimum = params.get('minimum_should_match')
+        if minimum is None:
+            minimum = 0 if must or filters or not should else 1
+        try:
+            minimum = int(minimum)
+        except ValueError:
+            raise _bad_request('minimum_should_match [%s] not supported' %
+                               minimum)
+
+        where, where_params = [], []
+        for clause in must + filters:
+            where.append('(%s)' % clause.where)
+            where_params.extend(clause.params)
+        if minimum == 1:
+            where.append('(%s)' % ' OR '.join(
+                '(%s)' % c.where for c in should))
+            for clause in should:
+                where_params.extend(clause.params)
+        elif minimum > 1:
+            where.append('(%s) >= %d' % (' + '.join(
+                'CASE WHEN (%s) THEN 1 ELSE 0 END' % c.where
+                for c in should), minimum))
+            for clause in should:
+                where_params.extend(clause.params)
+        for clause in must_not:
+            where.append('NOT (%s)' % clause.where)
+            where_params.extend(clause.params)
+
+        if not scored:
+            return _Clause(' AND '.join(where) or '1', where_params)
+        score, score_params = [], []
+        for clause in must:
+            if clause.score is not None:
+                score.append(clause.score)
+                score_params.extend(clause.score_params)
+        for clause in should:
+            if clause.score is not None:
+                score.append('CASE WHEN (%s) THEN %s ELSE 0 END' % (
+                    clause.where, clause.score))
+                score_params.extend(clause.params + clause.score_params)
+        boost = float(params.get('boost', 1.0))
+        return _Clause(' AND '.join(where) or '1', where_params,
+                       '(%s) * %r' % (' + '.join(score) or '0', boost),
+                       score_params)
+
+
+class _Indices(object):
+    """Index management, mirroring `elasticsearch.client.IndicesClient`.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, index, body=None, **params):
+        if self.exists(index):
+            raise RequestError(400, 'index_already_exists_exception', {
+                'error': {'reason': 'index [%s] already exists' % index}})
+        self.backend._create_index(index)
+        return {'acknowledged': True}
+
+    def delete(self, index, **params):
+        if not self.exists(index):
+            raise NotFoundError(404, 'index_not_found_exception', {
+                'error': {'reason': 'no such index', 'index': index}})
+        conn = self.backend._conn()
+        with conn:
+            conn.execute('DELETE FROM docs WHERE idx = ?', (index,))
+            conn.execute('DELETE FROM indices WHERE name = ?', (index,))
+            conn.execute('DROP TABLE IF EXISTS %s' % _fts_table(index))
+        self.backend._mappings.pop(index, None)
+        return {'acknowledged': True}
+
+    def exists(self, index, **params):
+        return self.backend._conn().execute(
+            'SELECT 1 FROM indices WHERE name = ?', (index,)).fetchone() \
+            is not None
+
+    def put_mapping(self, doc_type=None, body=None, index=None, **params):
+        # Documents are stored as JSON; only keyword fields matter, as they
+        # are matched on their whole value instead of through the FTS table
+        fields, keywords = self.backend._mapping(index)
+        properties = body.get(doc_type, body).get('properties', {})
+        for path, spec in flatten_mapping(properties):
+            keyword = spec in (('keyword', None), ('text', 'keyword'))
+            if keyword and path not in keywords:
+                keywords.append(path)
+            elif not keyword and path in keywords:
+                keywords.remove(path)
+        conn = self.backend._conn()
+        with conn:
+            conn.execute('UPDATE indices SET keywords = ? WHERE name = ?',
+                         (json.dumps(keywords), index))
+        self.backend._mappings.pop(index, None)
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    flush = refresh
+
+    def stats(self, index=None, metric=None, **params):
+        conn = self.backend._conn()
+        row = conn.execute('SELECT version FROM indices WHERE name = ?',
+                           (index,)).fetchone()
+        if row is None:
+            raise NotFoundError(404, 'index_not_found_exception', {
+                'error': {'reason': 'no such index', 'index': index}})
+        docs, = conn.execute('SELECT COUNT(*) FROM docs WHERE idx = ?',
+                             (index,)).fetchone()
+        return index_stats(index, docs, row[0])
+
+
+class SqliteBackend(Backend):
+    """Search backend storing documents in a SQLite database.
+
+    Documents are stored as JSON, with expression indexes on the owner,
+    findability and timestamp fields of `ENABLED_SEARCHES`, and an FTS5
+    table per index over the kind's `q_fields` (or all text, for kinds
+    without `q_fields`). Full text queries are ranked with BM25, weighted
+    by the query's field boosts. Other matches compare values exactly.
+
+    Suits single node deployments with up to a few hundred thousand
+    documents. The database path is taken from `METASTORE_SQLITE_PATH`.
+    """
+
+    def __init__(self, path=None, searches=None):
+        if path is None:
+            path = os.environ.get('METASTORE_SQLITE_PATH', 'metastore.db')
+        if searches is None:
+            from ..models import ENABLED_SEARCHES as searches
+        self.path = path
+        self.searches = searches
+        self.indices = _Indices(self)
+        self._local = threading.local()
+        self._mappings = {}
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        # Databases created before indices had a version
+        columns = [row[1] for row in
+                   conn.execute('PRAGMA table_info(indices)')]
+        if 'version' not in columns:
+            with conn:
+                conn.execute('ALTER TABLE indices ADD COLUMN '
+                             'version INTEGER NOT NULL DEFAULT 0')
+
+    def _conn(self):
+        # One connection per thread, and never one opened before a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path)
+            self._local.pid = os.getpid()
+            if self.path != ':memory:':
+                conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _mapping(self, index):
+        """Return the FTS columns and the keyword fields of an index.
+        """
+        mapping = self._mappings.get(index)
+        if mapping is None:
+            row = self._conn().execute(
+                'SELECT fields, keywords FROM indices WHERE name = ?',
+                (index,)).fetchone()
+            if row is None:
+                raise NotFoundError(404, 'index_not_found_exception', {
+                    'error': {'reason': 'no such index', 'index': index}})
+            mapping = self._mappings[index] = (json.loads(row[0]),
+                                               json.loads(row[1]))
+        return mapping[0][:], mapping[1][:]
+
+    def _create_index(self, index):
+        kinds = [k for k in self.searches.values() if k['index'] == index]
+        fields = []
+        for kind in kinds:
+            for field in kind.get('q_fields', []):
+                if _column(field) not in fields:
+                    fields.append(_column(field))
+        fields = fields or [ALL_FIELD]
+        # Owners and findability are matched exactly until a mapping says
+        # otherwise
+        keywords = [kind[key] for kind in kinds
+                    for key in ('owner', 'findability') if kind.get(key)]
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT INTO indices (name, fields, keywords) '
+                         'VALUES (?, ?, ?)',
+                         (index, json.dumps(fields), json.dumps(keywords)))
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, "
+                "tokenize='porter unicode61')" % (
+                    _fts_table(index), ', '.join(fields)))
+            for kind in kinds:
+                for key in ('owner', 'findability', 'timestamp'):
+                    field = kind.get(key)
+                    if field and _SAFE_PATH.match(field):
+                        conn.execute(
+                            "CREATE INDEX IF NOT EXISTS \"docs_%s_%s\" ON "
+                            "docs (idx, doc_type, json_extract(source, "
+                            "'$.%s'))" % (index, field, field))
+
+    def load(self, index, doc_type, docs):
+        """Add or replace many `(id, source)` documents in one transaction.
+        """
+        if not self.indices.exists(index):
+            self._create_index(index)
+        fields, keywords = self._mapping(index)
+        table = _fts_table(index)
+        conn = self._conn()
+        count = 0
+        with conn:
+            for id, body in docs:
+                source = json.loads(_serializer.dumps(body))
+                if id is None:
+                    id = conn.execute(
+                        'SELECT COALESCE(MAX(id), 0) + 1 FROM docs'
+                    ).fetchone()[0]
+                row = conn.execute(
+                    'SELECT id FROM docs WHERE idx = ? AND doc_type = ? '
+                    'AND doc_id = ?', (index, doc_type, str(id))).fetchone()
+                if row is not None:
+                    conn.execute('DELETE FROM docs WHERE id = ?', row)
+                    conn.execute('DELETE FROM %s WHERE rowid = ?' % table,
+                                 row)
+                rowid = conn.execute(
+                    'INSERT INTO docs (idx, doc_type, doc_id, source) '
+                    'VALUES (?, ?, ?, ?)',
+                    (index, doc_type, str(id), json.dumps(source))).lastrowid
+                if fields == [ALL_FIELD]:
+                    texts = [_text(source)]
+                else:
+                    paths = [f.replace('__', '.') for f in fields]
+                    texts = [_text(_get_path(source, p))
+                             if p not in keywords else '' for p in paths]
+                conn.execute('INSERT INTO %s (rowid, %s) VALUES (?, %s)' % (
+                    table, ', '.join(fields), ', '.join('?' * len(fields))),
+                    [rowid] + texts)
+                count += 1
+            conn.execute('UPDATE indices SET version = version + ? '
+                         'WHERE name = ?', (count, index))
+        return count
+
+    def index(self, index, doc_type, body, id=None, **params):
+        if id is None:
+            id = 'doc%d' % (self._conn().execute(
+                'SELECT COALESCE(MAX(id), 0) + 1 FROM docs').fetchone()[0])
+        self.load(index, doc_type, [(id, body)])
+        return {
+            '_index': index,
+            '_type': doc_type,
+            '_id': str(id),
+            'result': 'created',
+        }
+
+    def _where(self, index, doc_type, query):
+        compiler = _Compiler(self, index, doc_type)
+        clause = compiler.compile(query or {'match_all': {}})
+        where = ['docs.idx = ?', '(%s)' % clause.where]
+        params = [index] + clause.params
+        if doc_type is not None:
+            where.insert(1, 'docs.doc_type = ?')
+            params.insert(1, doc_type)
+        return compiler, clause, ' AND '.join(where), params
+
+    def _sort(self, sort):
+        """Return [(expression, order)] for a sort option.
+
+        Expressions are on the columns of the scored subquery of `search`.
+        """
+        spec = []
+        for item in as_list(sort):
+            if isinstance(item, str):
+                field = item
+                order = 'desc' if field == '_score' else 'asc'
+            else:
+                (field, options), = item.items()
+                order = options.get('order', 'asc') \
+                    if isinstance(options, dict) else options
+            if field == '_score':
+                expression = 'score'
+            elif field == '_doc':
+                expression = 'id'
+            elif field == '_uid':
+                expression = "doc_type || '#' || doc_id"
+            elif _SAFE_PATH.match(field):
+                expression = "json_extract(source, '$.%s')" % field
+            else:
+                raise _bad_request('sort on [%s] not supported' % field)
+            spec.append((expression, order.lower()))
+        return spec
+
+    def search(self, index=None, doc_type=None, body=None, size=None,
+               from_=None, **params):
+        start = time.time()
+        if isinstance(body, (str, bytes)):
+            body = json.loads(body)
+        body = body or {}
+        size = int(size if size is not None else body.get('size', DEFAULT_SIZE))
+        from_ = int(from_ if from_ is not None else body.get('from', 0))
+        self._mapping(index)
+        conn = self._conn()
+
+        compiler, clause, where, where_params = \
+            self._where(index, doc_type, body.get('query'))
+        join = compiler.join or ''
+        join_params = compiler.join_params
+        score = clause.score or '1.0'
+
+        aggregations = None
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            aggregations = self._aggregate(compiler, aggs, join, join_params,
+                                           where, where_params)
+
+        if 'post_filter' in body:
+            post = compiler.compile(body['post_filter'], False)
+            where = '%s AND (%s)' % (where, post.where)
+            where_params = where_params + post.params
+
+        total, = conn.execute(
+            'SELECT COUNT(*) FROM docs %s WHERE %s' % (join, where),
+            join_params + where_params).fetchone()
+
+        # Matching documents are scored once in a subquery, then sorted and
+        # paged on its columns
+        field_sort = bool(body.get('sort'))
+        spec = self._sort(body.get('sort')) if field_sort \
+            else [('score', 'desc'), ('id', 'asc')]
+        page_where, page_params = '1', []
+        after = body.get('search_after')
+        if after is not None:
+            # Lexicographic "after" on the sort values
+            ors = []
+            for i, (expression, order) in enumerate(spec[:len(after)]):
+                ands = ['%s = ?' % e for e, _ in spec[:i]]
+                ands.append('%s %s ?' % (expression,
+                                         '<' if order == 'desc' else '>'))
+                ors.append('(%s)' % ' AND '.join(ands))
+                page_params.extend(after[:i + 1])
+            page_where = ' OR '.join(ors)
+        rows = conn.execute(
+            'SELECT doc_type, doc_id, source, score, %s FROM ('
+            'SELECT docs.id AS id, docs.doc_type AS doc_type, '
+            'docs.doc_id AS doc_id, docs.source AS source, %s AS score '
+            'FROM docs %s WHERE %s) WHERE %s ORDER BY %s LIMIT ? OFFSET ?' % (
+                ', '.join(e for e, _ in spec), score, join, where,
+                page_where,
+                ', '.join('%s %s' % (e, o.upper()) for e, o in spec)),
+            clause.score_params + join_params + where_params + page_params +
+            [size, from_]).fetchall()
+
+        includes, excludes = source_filter(body.get('_source'))
+        hits = []
+        for row in rows:
+            hit = {
+                '_index': index,
+                '_type': row[0],
+                '_id': row[1],
+                '_score': None if field_sort else row[3],
+            }
+            if includes is not None:
+                hit['_source'] = filter_source(json.loads(row[2]),
+                                               includes, excludes)
+            if field_sort:
+                hit['sort'] = list(row[4:])
+            hits.append(hit)
+
+        ret = {
+            'took': int((time.time() - start) * 1000),
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': total,
+                'max_score': None,
+                'hits': hits,
+            },
+        }
+        if aggregations is not None:
+            ret['aggregations'] = aggregations
+        return ret
+
+    def _aggregate(self, compiler, aggs, join, join_params, where,
+                   where_params):
+        conn = self._conn()
+        ret = {}
+        for name, agg in aggs.items():
+            agg_params = []
+            if 'sum' in agg:
+                path = compiler.path(agg['sum']['field'], agg_params)
+                value, = conn.execute(
+                    'SELECT TOTAL(%s) FROM docs %s WHERE %s' % (
+                        path, join, where),
+                    agg_params + join_params + where_params).fetchone()
+                ret[name] = {'value': value}
+            elif 'terms' in agg:
+                # Dynamic `.keyword` subfields hold the value of their field
+                field = agg['terms']['field']
+                if field.endswith('.keyword'):
+                    field = field[:-len('.keyword')]
+                path = compiler.path(field, agg_params)
+                size = int(agg['terms'].get('size', 10))
+                # Most frequent first, then by value
+                counts = conn.execute(
+                    'SELECT value, COUNT(*) AS count FROM ('
+                    'SELECT %s AS value FROM docs %s WHERE %s) '
+                    'WHERE value IS NOT NULL GROUP BY value '
+                    'ORDER BY count DESC, value' % (path, join, where),
+                    agg_params + join_params + where_params).fetchall()
+                ret[name] = {
+                    'doc_count_error_upper_bound': 0,
+                    'sum_other_doc_count': sum(n for _, n in counts[size:]),
+                    'buckets': [{'key': value, 'doc_count': count}
+                                for value, count in counts[:size]],
+                }
+            elif 'filter' in agg:
+                clause = compiler.compile(agg['filter'], False)
+                sub_where = '%s AND (%s)' % (where, clause.where)
+                sub_params = where_params + clause.params
+                count, = conn.execute(
+                    'SELECT COUNT(*) FROM docs %s WHERE %s' % (
+                        join, sub_where),
+                    join_params + sub_params).fetchone()
+                ret[name] = self._aggregate(compiler, agg.get('aggs', {}),
+                                            join, join_params, sub_where,
+                                            sub_params)
+                ret[name]['doc_count'] = count
+            else:
+                raise _bad_request('aggregation [%s] not supported' % name)
+        return ret
+
+    def scan(self, query=None, index=None, doc_type=None, **params):
+        query = dict(query or {})
+        slice_ = query.get('slice')
+        self._mapping(index)
+        compiler, clause, where, where_params = \
+            self._where(index, doc_type, query.get('query'))
+        if slice_:
+            where = '%s AND docs.id %% %d = %d' % (
+                where, int(slice_['max']), int(slice_['id']))
+        includes, excludes = source_filter(query.get('_source'))
+        rows = self._conn().execute(
+            'SELECT docs.doc_type, docs.doc_id, docs.source FROM docs %s '
+            'WHERE %s ORDER BY docs.id' % (compiler.join or '', where),
+            compiler.join_params + where_params)
+        for doc_type, doc_id, source in rows:
+            hit = {'_index': index, '_type': doc_type, '_id': doc_id,
+                   '_score': None}
+            if includes is not None:
+                hit['_source'] = filter_source(json.loads(source),
+                                               includes, excludes)
+            yield hit
+
+    def ping(self, **params):
+        self._conn().execute('SELECT 1')
+        return True
@@ -1,12 +1,38 @@
 import os
-import jwt
-from flask import Blueprint, abort, request
-from flask_jsonpify import jsonpify
+import logging
+from flask import Blueprint, Response, abort, request, stream_with_context
 
-from . import controllers
+from . import admission, controllers, metrics, querylog, serialize
+from .admission import AdmissionController, Rejected
+from .auth import TokenCache, is_admin
+from .models import ENABLED_SEARCHES
 
 PRIVATE_KEY = os.environ.get('PRIVATE_KEY')
 
+# Admin endpoints require it in the `X-Admin-Token` header, and are closed
+# when it is not set
+ADMIN_TOKEN = os.environ.get('METASTORE_ADMIN_TOKEN')
+
+# Verified tokens, so that clients resending a token skip the signature check
+_tokens = TokenCache(
+    maxsize=os.environ.get('METASTORE_TOKEN_CACHE_SIZE', 10000),
+    ttl=os.environ.get('METASTORE_TOKEN_CACHE_TTL', 300))
+
+# Request parameters that are not query filters: JSONP callback, jQuery's
+# cache buster and token
+RESERVED_PARAMS = ('callback', '_', 'jwt')
+
+# Seconds shared caches (e.g. a CDN) may serve anonymous search results for
+MAX_AGE = int(os.environ.get('METASTORE_HTTP_MAX_AGE', 5))
+
+# Proxies in front of the app (None if unknown, see `admission.proxy_count`)
+PROXY_COUNT = admission.proxy_count()
+
+# Bounds the requests searching concurrently in this process, out of the
+# threads of a gunicorn worker
+_admission = AdmissionController(**admission.options(
+    threads=os.environ.get('METASTORE_THREADS', 4)))
+
 
 def create():
     """Create blueprint.
@@ -17,26 +43,173 @@ def create():
 
     # Controller Proxies
     search_controller = controllers.search
+    prepare_controller = controllers.prepare
+    etag_controller = controllers.etag
+    multi_search_controller = controllers.multi_search
+    export_controller = controllers.export
+    ready_controller = controllers.ready
 
-    def search(kind='dataset'):
+    def get_userid():
         token = request.headers.get('auth-token') or request.values.get('jwt')
-        userid = None
+        if token is None:
+            return None
+        return _tokens.get_userid(token, PRIVATE_KEY)
+
+    def get_args():
+        args = request.args.to_dict(flat=False)
+        for param in RESERVED_PARAMS:
+            args.pop(param, None)
+        return args
+
+    def respond(data, status=200):
+        # JSON (or JSONP, with a `callback` parameter), compressed if the
+        # client accepts it
+        body, mimetype = serialize.jsonp(data, request.args.get('callback'))
+        body, encoding = serialize.compress(
+            body, request.headers.get('Accept-Encoding'))
+        response = Response(body, status=status, mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    def cacheable(response, etag, userid):
+        # Anonymous results are the same for everyone, others are private
+        response.set_etag(etag, weak=True)
+        if userid is None:
+            response.cache_control.public = True
+            response.cache_control.max_age = MAX_AGE
+        else:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        # CORS headers echo the request's Origin
+        response.vary.add('Auth-Token')
+        response.vary.add('Origin')
+        return response
+
+    def get_client(userid):
+        # Authenticated users are limited per userid, others per address,
+        # once addresses are known to be the clients' (see `metastore.create`)
+        if userid is not None:
+            return 'user:%s' % userid, True
+        if PROXY_COUNT is None:
+            return None, False
+        return 'addr:%s' % request.remote_addr, False
+
+    def rejected(e):
+        response = respond({'error': 'Too many concurrent requests'}, 429)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    def search(kind='dataset'):
+        if kind not in ENABLED_SEARCHES:
+            abort(400)
+        with metrics.REQUEST_SECONDS.time(kind=kind):
+            with metrics.STAGE_SECONDS.time(kind=kind, stage='token'):
+                userid = get_userid()
+            args = get_args()
+            # The query is built once, for its ETag and its search
+            prepared = prepare_controller(kind, userid, args)
+            # Unchanged results are neither searched for nor serialized
+            etag = None
+            if prepared is not None:
+                with metrics.STAGE_SECONDS.time(kind=kind, stage='etag'):
+                    etag = etag_controller(prepared)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                metrics.NOT_MODIFIED.inc(kind=kind)
+                return cacheable(Response(status=304), etag, userid)
+            with _admission.admit(*get_client(userid)):
+                ret = search_controller(kind, userid, args, prepared)
+            if ret is None:
+                abort(400)
+            with metrics.STAGE_SECONDS.time(kind=kind, stage='serialize'):
+                response = respond(ret)
+            if etag is not None and 'error' not in ret and \
+                    not ret.get('stale'):
+                cacheable(response, etag, userid)
+            metrics.RESPONSE_BYTES.observe(response.content_length or 0,
+                                           kind=kind)
+        return response
+
+    def queries_view():
+        if not is_admin(request.headers.get('X-Admin-Token'), ADMIN_TOKEN):
+            abort(403)
         try:
-            if token is not None:
-                token = jwt.decode(token, PRIVATE_KEY)
-                userid = token.get('userid')
-        except jwt.InvalidTokenError:
-            pass
-        ret = search_controller(kind, userid, request.args)
+            entries = querylog.stats.top(int(request.args.get('top', 10)),
+                                         request.args.get('order', 'total'))
+        except ValueError:
+            abort(400)
+        return respond({'queries': entries})
+
+    def metrics_view():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    def multi_search():
+        userid = get_userid()
+        queries = request.get_json(force=True, silent=True)
+        with _admission.admit(*get_client(userid)):
+            ret = multi_search_controller(userid, queries)
         if ret is None:
             abort(400)
-        return jsonpify(ret)
+        return respond({'responses': ret})
+
+    def export(kind='dataset'):
+        userid = get_userid()
+        client = get_client(userid)
+        # Exports are admitted until their response is closed
+        _admission.acquire(*client)
+        try:
+            docs = export_controller(kind, userid, get_args())
+            if docs is None:
+                abort(400)
+            response = Response(stream_with_context(export_lines(docs)),
+                                mimetype='application/x-ndjson')
+        except Exception:
+            _admission.release(*client)
+            raise
+        response.call_on_close(lambda: _admission.release(*client))
+        return response
+
+    def export_lines(docs):
+        try:
+            for doc in docs:
+                yield serialize.dumps(doc) + b'\n'
+        except Exception as e:
+            # The 200 is already sent: end with an error record, so that
+            # clients can tell a failed export from a complete one
+            logging.error("export: %r", e)
+            yield serialize.dumps({'error': str(e)}) + b'\n'
+
+    def live():
+        return respond({'status': 'ok'})
+
+    def ready():
+        if not ready_controller():
+            return respond({'status': 'warming up'}, 503)
+        return respond({'status': 'ok'})
+
+    # Register error handlers
+    blueprint.register_error_handler(Rejected, rejected)
 
     # Register routes
     blueprint.add_url_rule(
         'search', 'search', search, methods=['GET'])
     blueprint.add_url_rule(
         'search/<kind>', 'events', search, methods=['GET'])
+    blueprint.add_url_rule(
+        'metrics', 'metrics', metrics_view, methods=['GET'])
+    blueprint.add_url_rule(
+        'admin/queries', 'queries', queries_view, methods=['GET'])
+    blueprint.add_url_rule(
+        'msearch', 'msearch', multi_search, methods=['POST'])
+    blueprint.add_url_rule(
+        'export', 'export', export, methods=['GET'])
+    blueprint.add_url_rule(
+        'export/<kind>', 'export_kind', export, methods=['GET'])
+    blueprint.add_url_rule(
+        'health/live', 'live', live, methods=['GET'])
+    blueprint.add_url_rule(
+        'health/ready', 'ready', ready, methods=['GET'])
 
     # Return blueprint
     return blueprint
@@ -0,0 +1,88 @@
+import time
+import threading
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from . import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(ElasticsearchException):
+    """Raised instead of calling a search engine that keeps failing.
+    """
+
+
+class CircuitBreaker(object):
+    """Fail fast while a search engine keeps failing.
+
+    The circuit opens after `threshold` consecutive calls fail (as decided by
+    `is_failure`), and calls then raise `CircuitOpenError` right away. After
+    `reset_timeout` seconds a single call is let through as a probe (the
+    circuit is half open): the circuit closes if it succeeds, and opens
+    again if it fails.
+
+    A `threshold` of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, is_failure=None):
+        self.threshold = int(threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.is_failure = is_failure or (lambda e: True)
+        self.state = CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        self.state = state
+        metrics.CIRCUIT_TRANSITIONS.inc(state=state)
+
+    def acquire(self):
+        """Raise `CircuitOpenError` unless a call may go through.
+        """
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and \
+                    time.monotonic() - self._opened >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError('Search engine unavailable, circuit is open')
+
+    def record(self, error=None):
+        """Record the outcome of a call let through by `acquire`.
+        """
+        if self.threshold <= 0:
+            return
+        failed = error is not None and self.is_failure(error)
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self._failures = 0
+                if self.state != CLOSED:
+                    self._transition(CLOSED)
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.threshold:
+                self._opened = time.monotonic()
+                if self.state != OPEN:
+                    self._transition(OPEN)
+
+    def call(self, fn, *args, **kwargs):
+        self.acquire()
+        try:
+            ret = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(e)
+            raise
+        self.record()
+        return ret
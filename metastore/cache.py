@@ -0,0 +1,75 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """Bounded in-process cache with LRU eviction and per-entry expiry.
+
+    A cache with `maxsize` or `ttl` of 0 is disabled: `get` always misses and
+    `set` is a no-op.
+    """
+
+    def __init__(self, maxsize=1024, ttl=10):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict(self, predicate):
+        """Delete the entries whose key matches `predicate`.
+        """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self._data)
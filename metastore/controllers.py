@@ -1,17 +1,116 @@
 import elasticsearch
 
-from .models import query
+from . import metrics, models
+from .models import query, multi_query, export as export_query, \
+    ENABLED_SEARCHES
 
+# Max number of queries in a single multi search
+MAX_MULTI_SEARCH = 20
 
-def search(kind, userid, args={}):
+
+def prepare(kind, userid, args={}):
+    """Build an elasticsearch query once, for its ETag and its result (see
+    `models.prepare`)
+
+    Returns None for unknown kinds and invalid queries.
+    """
+    if kind not in ENABLED_SEARCHES:
+        return None
+    try:
+        return models.prepare(kind, userid, **args)
+    except ValueError:
+        return None
+
+
+def search(kind, userid, args={}, prepared=None):
     """Initiate an elasticsearch query
+
+    `prepared` is the query built from the same arguments, if there is one
+    (see `prepare`). Returns None for unknown kinds.
     """
+    if kind not in ENABLED_SEARCHES:
+        return None
     try:
-        res = query(kind, userid, **args)
+        if prepared is not None:
+            res = models.query_prepared(prepared)
+        else:
+            res = query(kind, userid, **args)
+        if 'error' in res:
+            metrics.SEARCH_ERRORS.inc(kind=kind)
+        else:
+            metrics.RESULTS.observe(len(res['results']), kind=kind)
         return res
     except elasticsearch.exceptions.ElasticsearchException as e:
+        metrics.SEARCH_ERRORS.inc(kind=kind)
         return {
             'total': 0,
             'results': [],
             'error': str(e)
         }
+
+
+def etag(prepared):
+    """Return an ETag for the result of a prepared search (see
+    `models.etag_prepared`)
+    """
+    return models.etag_prepared(prepared)
+
+
+def parse_multi_search(queries):
+    """Return the `(kind, params)` pairs of a multi search batch.
+
+    Returns None if the batch is malformed.
+    """
+    if not isinstance(queries, list) or len(queries) > MAX_MULTI_SEARCH:
+        return None
+    parsed = []
+    for entry in queries:
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get('params', {}), dict):
+            return None
+        params = {}
+        for k, v in entry.get('params', {}).items():
+            params[k] = v if isinstance(v, list) else [v]
+        parsed.append((entry.get('kind', 'dataset'), params))
+    return parsed
+
+
+def multi_search(userid, queries):
+    """Run a batch of elasticsearch queries in one round trip
+
+    `queries` is a list of `{"kind": ..., "params": {...}}` entries. Param
+    values may be given as a single value or as a list of values.
+    Returns None if the batch is malformed.
+    """
+    parsed = parse_multi_search(queries)
+    if parsed is None:
+        return None
+    try:
+        return multi_query(userid, parsed)
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        return [{
+            'total': 0,
+            'results': [],
+            'error': str(e)
+        } for _ in parsed]
+
+
+def export(kind, userid, args={}):
+    """Stream every document matching an elasticsearch query
+
+    Returns None if the query can not be built.
+    """
+    if kind not in ENABLED_SEARCHES:
+        return None
+    try:
+        return export_query(kind, userid, **args)
+    except (ValueError, TypeError):
+        return None
+
+
+def ready():
+    """Return True once this process is warmed up (see `models.warm_up`).
+
+    Processes that are not warmed up yet try again.
+    """
+    return models.ready() or models.warm_up()
@@ -0,0 +1,91 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import metrics
+
+
+class Hedger(object):
+    """Hedged calls, to cut tail latency.
+
+    A call that hasn't returned after the `percentile` of recent latencies
+    gets a duplicate (the hedge), and whichever answer arrives first is used;
+    the other one is left to finish and discarded. At most a `budget` share
+    of the last `window` calls are hedged, so a slow backend doesn't get
+    twice the load. Calls are not hedged until `min_samples` latencies have
+    been seen.
+
+    Calls run on a pool of `threads` threads.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, window=1000,
+                 min_samples=100, threads=64):
+        self.percentile = float(percentile)
+        self.budget = float(budget)
+        self.min_samples = int(min_samples)
+        self._latencies = deque(maxlen=int(window))
+        self._hedged = deque(maxlen=int(window))
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(int(threads))
+
+    def delay(self):
+        """Seconds after which a call is hedged (None before `min_samples`).
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _admit(self):
+        # Count a call that is due for a hedge, and whether the budget
+        # allows it
+        with self._lock:
+            allowed = sum(self._hedged) + 1 <= \
+                self.budget * (len(self._hedged) + 1)
+            self._hedged.append(allowed)
+        return allowed
+
+    def _record(self, latency, counted=False):
+        with self._lock:
+            self._latencies.append(latency)
+            if not counted:
+                self._hedged.append(False)
+
+    def do(self, kind, fn, hedge_fn):
+        """Return `fn()`, or `hedge_fn()` if that returns first.
+        """
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay is None:
+            ret = fn()
+            self._record(time.perf_counter() - start)
+            return ret
+
+        primary = self._pool.submit(fn)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            ret = primary.result()
+            self._record(time.perf_counter() - start)
+            return ret
+        if not self._admit():
+            metrics.HEDGES.inc(kind=kind, result='over_budget')
+            ret = primary.result()
+            self._record(time.perf_counter() - start, counted=True)
+            return ret
+
+        metrics.HEDGES.inc(kind=kind, result='sent')
+        hedge = self._pool.submit(hedge_fn)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in (primary, hedge):
+                if future in done and future.exception() is None:
+                    metrics.HEDGES.inc(kind=kind, result='primary_won'
+                                       if future is primary else 'hedge_won')
+                    self._record(time.perf_counter() - start, counted=True)
+                    return future.result()
+        # Both failed
+        return primary.result()
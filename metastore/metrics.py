@@ -0,0 +1,197 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in pairs)
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, doc, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(key, value)
+                         for key, value in series)
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic counter.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, key, value):
+        return '%s%s %s' % (
+            self.name, _format_labels(self.labelnames, key), value)
+
+
+class Histogram(_Metric):
+    """Histogram of observed values, with cumulative buckets on rendering.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        super(Histogram, self).__init__(name, doc, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def _render_series(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (
+                self.name,
+                _format_labels(self.labelnames, key, [('le', bound)]),
+                cumulative))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, total))
+        lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return '\n'.join(lines)
+
+
+def render(registry=REGISTRY):
+    """Render metrics in the Prometheus text exposition format.
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+def clear(registry=REGISTRY):
+    for metric in registry:
+        metric.clear()
+
+
+# Search hot path metrics. Metrics are kept per worker process.
+
+REQUEST_SECONDS = Histogram(
+    'metastore_request_seconds',
+    'Time to serve a search request, per kind',
+    ['kind'])
+
+STAGE_SECONDS = Histogram(
+    'metastore_stage_seconds',
+    'Time spent in each stage of a search request '
+    '(token, build_dsl, es, extract, serialize)',
+    ['kind', 'stage'])
+
+ES_TOOK_SECONDS = Histogram(
+    'metastore_es_took_seconds',
+    'Search time reported by elasticsearch (took)',
+    ['kind'])
+
+RESULTS = Histogram(
+    'metastore_results',
+    'Number of results returned per search',
+    ['kind'], buckets=(0, 1, 5, 10, 25, 50, 100))
+
+RESPONSE_BYTES = Histogram(
+    'metastore_response_bytes',
+    'Size of serialized search responses',
+    ['kind'], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
+SEARCH_ERRORS = Counter(
+    'metastore_search_errors_total',
+    'Searches answered with an error',
+    ['kind'])
+
+CACHE_REQUESTS = Counter(
+    'metastore_cache_requests_total',
+    'Result cache lookups (result is hit or miss)',
+    ['kind', 'result'])
+
+HEDGES = Counter(
+    'metastore_search_hedges_total',
+    'Hedged searches (result is sent, primary_won, hedge_won or '
+    'over_budget)',
+    ['kind', 'result'])
+
+CIRCUIT_TRANSITIONS = Counter(
+    'metastore_circuit_transitions_total',
+    'Search engine circuit breaker transitions, by the state entered',
+    ['state'])
+
+STALE_RESPONSES = Counter(
+    'metastore_stale_responses_total',
+    'Last known good results served while the search engine is failing',
+    ['kind'])
+
+ADMISSIONS = Counter(
+    'metastore_admissions_total',
+    'Search requests admitted or rejected (result is admitted, queue_full '
+    'or timeout)',
+    ['result'])
+
+NOT_MODIFIED = Counter(
+    'metastore_not_modified_total',
+    'Conditional searches answered with 304 Not Modified',
+    ['kind'])
@@ -1,22 +1,92 @@
 import os
 import json
+import time
+import base64
+import random
+import hashlib
 import logging
+from collections import namedtuple
 
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import (ElasticsearchException, NotFoundError,
+                                      TransportError)
 
+from . import backends, metrics, querylog
+from .breaker import CircuitBreaker
+from .cache import ResultCache
+from .hedge import Hedger
+from .singleflight import SingleFlight
 
 logging.root.setLevel(logging.INFO)
-logging.getLogger('elasticsearch').setLevel(logging.DEBUG)
 
 _engine = None
 
+# Set once `warm_up` has reached the search engine
+_ready = False
+
+# Results of recent queries, keyed on the serialized request. Kinds can opt
+# out with `'cache': False` in ENABLED_SEARCHES.
+_cache = ResultCache(
+    maxsize=os.environ.get('METASTORE_CACHE_SIZE', 1024),
+    ttl=os.environ.get('METASTORE_CACHE_TTL', 10))
+
+# Last good result of each query, served (flagged as stale) while the search
+# engine is failing
+_stale = ResultCache(
+    maxsize=os.environ.get('METASTORE_STALE_CACHE_SIZE', 1024),
+    ttl=os.environ.get('METASTORE_STALE_TTL', 3600))
+
+# Change markers of indices (see `index_version`), and the last one seen
+_versions = ResultCache(
+    maxsize=64, ttl=os.environ.get('METASTORE_INDEX_VERSION_TTL', 1))
+_last_versions = {}
+
+# Identical searches running concurrently share one Elasticsearch call.
+_flight = SingleFlight()
+
+# Opt-in hedging: searches slower than this percentile of recent searches get
+# a duplicate, on another node and shard copies, and the first answer is used
+_hedger = None
+if os.environ.get('METASTORE_HEDGE_PERCENTILE'):
+    _hedger = Hedger(
+        percentile=os.environ['METASTORE_HEDGE_PERCENTILE'],
+        budget=os.environ.get('METASTORE_HEDGE_BUDGET', 0.05),
+        min_samples=os.environ.get('METASTORE_HEDGE_MIN_SAMPLES', 100),
+        threads=os.environ.get('METASTORE_HEDGE_THREADS', 64))
+
+
+def _engine_failure(e):
+    """Whether an error is the search engine failing, rather than the query.
+    """
+    if isinstance(e, TransportError) and isinstance(e.status_code, int):
+        # Bad requests and missing indices get an answer
+        return e.status_code >= 500 or e.status_code == 429
+    # Connection errors and timeouts (and an open circuit)
+    return isinstance(e, ElasticsearchException)
+
+
+# Searches fail fast after consecutive engine failures, instead of each
+# waiting for the client timeout
+_breaker = CircuitBreaker(
+    threshold=os.environ.get('METASTORE_BREAKER_THRESHOLD', 5),
+    reset_timeout=os.environ.get('METASTORE_BREAKER_RESET', 30),
+    is_failure=_engine_failure)
+
+# Kinds may set default `fields` (included) and `exclude` (excluded) lists of
+# source fields to return; requests override them with the same parameters.
+# A `timeout` (in seconds) bounds how long their searches may take, and
+# `total_bytes` is the field summed in the `totalBytes` of their summaries.
 ENABLED_SEARCHES = {
     'dataset': {
         'index': 'datahub',
         'doc_type': 'dataset',
         'owner': 'datahub.ownerid',
         'findability': 'datahub.findability',
+        'total_bytes': 'datahub.stats.bytes',
+        'facets': {
+            'datahub.ownerid': 'datahub.ownerid',
+            'datahub.owner': 'datahub.owner',
+            'datahub.findability': 'datahub.findability',
+        },
         'q_fields': [
             'title',
             'datahub.owner',
@@ -30,10 +100,30 @@ ENABLED_SEARCHES = {
         'owner': 'ownerid',
         'findability': 'findability',
         'timestamp': 'timestamp',
+        'facets': {
+            'event_entity': 'event_entity.keyword',
+            'event_action': 'event_action.keyword',
+            'status': 'status.keyword',
+            'findability': 'findability.keyword',
+        },
         'q_fields': []
     }
 }
 
+# Facets map filterable fields to the keyword field their values are
+# counted on: elasticsearch can't aggregate text fields, and strings mapped
+# dynamically are text with a `.keyword` subfield
+
+# Number of values counted for each facet
+FACET_SIZE = 10
+
+# Summaries of results: total and totalBytes, total only, or none
+SUMMARY_MODES = ('full', 'count', 'none')
+
+# Scroll settings for exports
+EXPORT_SCROLL = '2m'
+EXPORT_BATCH_SIZE = 500
+
 BOOSTS = {
     'title': '^5',
     'datahub.owner': '^2',
@@ -45,18 +135,63 @@ BOOSTS = {
 def _get_engine():
     global _engine
     if _engine is None:
-        es_host = os.environ['DATAHUB_ELASTICSEARCH_ADDRESS']
-        _engine = Elasticsearch(hosts=[es_host], use_ssl='https' in es_host)
+        _engine = backends.create()
 
     return _engine
 
 
-def build_dsl(kind_params, userid, kw, kind=None):
+def warm_up():
+    """Prepare this process to serve searches.
+
+    Creates the search engine client, builds a query of every kind, so that
+    the first requests don't pay for it, and pings the engine. Returns
+    whether the engine answered.
+    """
+    global _ready
+    engine = _get_engine()
+    for kind, kind_params in ENABLED_SEARCHES.items():
+        _prepare(kind_params, None, 50, {}, kind=kind)
+        _prepare(kind_params, 'warm-up', 50, {'q': ['"warm up"']}, kind=kind)
+    try:
+        _ready = bool(engine.ping())
+    except Exception as e:
+        logging.error("warm_up: %r", e)
+        _ready = False
+    return _ready
+
+
+def ready():
+    return _ready
+
+
+def encode_cursor(sort_values):
+    """Encode the sort values of a hit as an opaque pagination cursor.
+    """
+    raw = json.dumps(sort_values, separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor created by `encode_cursor`. Raises ValueError.
+    """
+    raw = base64.urlsafe_b64decode(cursor.strip('"').encode('ascii'))
+    sort_values = json.loads(raw.decode('utf8'))
+    if not isinstance(sort_values, list):
+        raise ValueError('Invalid cursor %r' % cursor)
+    return sort_values
+
+
+def build_dsl(kind_params, userid, kw, kind=None, summary='full'):
+    # Visibility and exact-match filters don't affect ranking, so they go in
+    # filter context where they are not scored and elasticsearch can cache
+    # them across requests. Only the full text query, the core boost and the
+    # user's own documents are scored.
     dsl = {'bool': {
+        'filter': [],
         'should': [],
-        'must': [], 'minimum_should_match': 1}}
-    # All Datasets:
-    all_datasets = {
+        'must': []}}
+    # Published documents (and the user's own, below)
+    visible = {
         'bool': {
             'should': [{'match': {kind_params['findability']: 'published'}}],
             'minimum_should_match': 1
@@ -69,20 +204,48 @@ def build_dsl(kind_params, userid, kw, kind=None):
             'minimum_should_match': 1
         }
     }
-    dsl['bool']['should'].append(all_datasets)
+    dsl['bool']['filter'].append(visible)
     dsl['bool']['should'].append(boost_core)
 
     # User datasets
     if userid is not None:
-        user_datasets = \
-            {'bool': {'must': {'match': {kind_params['owner']: userid}}}}
+        user_datasets = {'match': {kind_params['owner']: userid}}
+        visible['bool']['should'].append(user_datasets)
+        # Ranked above other published ones
         dsl['bool']['should'].append(user_datasets)
 
+    # Scoring explanations, for debugging relevance only
+    debug = kw.pop('debug', ['false'])[0].replace('"', '').lower() in \
+        ('1', 'true', 'yes')
+
     # Allow sorting event results
     sort_by = kw.pop('sort', ['desc'])[0].replace('"', '')
     sort = []
     if kind_params.get('timestamp'):
-        sort.append({'timestamp': {'order' : sort_by}})
+        sort.append({kind_params['timestamp']: {'order' : sort_by}})
+        # Tiebreaker, so that `search_after` cursors are unambiguous
+        sort.append({'_uid': {'order': sort_by}})
+
+    # Source filtering, defaulting to the kind's configured projection
+    source = {}
+    for param, key in (('fields', 'includes'), ('exclude', 'excludes')):
+        values = kw.pop(param, None)
+        if values is not None:
+            values = [f.strip() for v in values
+                      for f in v.replace('"', '').split(',') if f.strip()]
+        else:
+            values = kind_params.get(param)
+        if values:
+            source[key] = values
+
+    # Facets, counting the values of some of the kind's fields
+    facets = kw.pop('facets', None)
+    if facets is not None:
+        facets = [f.strip() for v in facets
+                  for f in v.replace('"', '').split(',') if f.strip()]
+        for facet in facets:
+            if facet not in kind_params.get('facets', {}):
+                raise ValueError('Invalid facet %r' % facet)
 
     # Query parameters (for not to mess with other parameters we should pop)
     q = kw.pop('q', None)
@@ -95,14 +258,21 @@ def build_dsl(kind_params, userid, kw, kind=None):
                 }
             })
     match_or_term = 'term' if kind == 'events' else 'match'
-    for k, v_arr in kw.items():
-        dsl['bool']['must'].append({
+    # Filters on faceted fields are applied after the facets are counted
+    # (post_filter), so that selecting a value doesn't hide the others
+    facet_filters = {}
+    for k, v_arr in sorted(kw.items()):
+        clause = {
                 'bool': {
                     'should': [{match_or_term: {k: json.loads(v)}}
                                for v in v_arr],
                     'minimum_should_match': 1
                 }
-           })
+           }
+        if facets and k in facets:
+            facet_filters[k] = clause
+        else:
+            dsl['bool']['filter'].append(clause)
 
     if len(dsl['bool']['must']) == 0:
         del dsl['bool']['must']
@@ -111,64 +281,521 @@ def build_dsl(kind_params, userid, kw, kind=None):
     if len(dsl) == 0:
         dsl = {}
     else:
-        dsl = {'query': dsl, 'explain': True, 'sort': sort}
+        dsl = {'query': dsl, 'sort': sort}
+        if debug:
+            dsl['explain'] = True
+    if source:
+        dsl['_source'] = source
 
-    aggs = { 'total_bytes': { 'sum': { 'field': 'datahub.stats.bytes' } } }
-    dsl['aggs'] = aggs
+    aggs = {}
+    if summary == 'full' and kind_params.get('total_bytes'):
+        aggs['total_bytes'] = {'sum': {'field': kind_params['total_bytes']}}
+    if facet_filters:
+        post_filter = {'bool': {'filter': [
+            facet_filters[k] for k in sorted(facet_filters)]}}
+        dsl['post_filter'] = post_filter
+        # Aggregations run before the post_filter: totals apply it
+        if aggs:
+            aggs = {'total_bytes': {'filter': post_filter, 'aggs': aggs}}
+    for facet in facets or []:
+        # Each facet is counted with the filters on the other facets
+        others = [facet_filters[k] for k in sorted(facet_filters)
+                  if k != facet]
+        aggs['facet:' + facet] = {
+            'filter': {'bool': {'filter': others}} if others
+            else {'match_all': {}},
+            'aggs': {'values': {'terms': {
+                'field': kind_params['facets'][facet],
+                'size': FACET_SIZE}}}
+        }
+    if aggs:
+        dsl['aggs'] = aggs
 
     return dsl
 
 
+def _summary_mode(kw):
+    """Pop the summary mode of a query from its parameters.
+    """
+    summary = kw.pop('summary', ['full'])[0].replace('"', '')
+    if summary not in SUMMARY_MODES:
+        raise ValueError('Invalid summary %r' % summary)
+    return summary
+
+
+def _summarize(res, summary):
+    """Return a query result with the summary of the given mode.
+    """
+    if summary == 'full' or 'summary' not in res:
+        return res
+    res = dict(res)
+    if summary == 'count':
+        res['summary'] = {'total': res['summary']['total']}
+    else:
+        del res['summary']
+    return res
+
+
+def _prepare(kind_params, userid, size, kw, kind=None, summary='full'):
+    """Build the search api parameters for a query.
+
+    Returns the api parameters, with a serialized body. The page size is in
+    their `size`.
+    """
+    # Arguments received from a network request come in kw, as a mapping
+    # between param_name and a list of received values.
+    # If size was provided by the user, it will be a list, so we take its
+    # first item.
+    if type(size) is list:
+        size = size[0]
+        if int(size) > 100:
+            size = 100
+    size = int(size)
+
+    from_ = int(kw.pop('from', [0])[0])
+
+    # Cursor pagination (search_after) for timestamped kinds
+    cursor = kw.pop('cursor', None)
+    if cursor is not None:
+        if not kind_params.get('timestamp'):
+            raise ValueError('cursor is not supported for %s' % kind)
+        cursor = decode_cursor(cursor[0])
+        from_ = 0
+
+    api_params = dict([
+        ('index', kind_params['index']),
+        ('doc_type', kind_params['doc_type']),
+        ('size', size),
+        ('from_', from_),
+        ('search_type', 'dfs_query_then_fetch')
+    ])
+    if kind_params.get('timeout'):
+        api_params['request_timeout'] = kind_params['timeout']
+
+    body = build_dsl(kind_params, userid, kw, kind=kind, summary=summary)
+    if cursor is not None:
+        body['search_after'] = cursor
+    # Keys are sorted so that equivalent queries serialize identically
+    # and can share a cache entry. The body carries the owner clause, so
+    # different users never share results.
+    api_params['body'] = json.dumps(body, sort_keys=True)
+    return api_params
+
+
+def _cache_key(kind, api_params):
+    return (kind, api_params['body'],
+            str(api_params['size']), api_params['from_'])
+
+
+def _extract(kind_params, ret, size):
+    """Convert an elasticsearch response to a query result.
+    """
+    next_cursor = None
+    if ret.get('hits') is not None:
+        hits = ret['hits']['hits']
+        results = [hit['_source'] for hit in hits]
+        total = ret['hits']['total']
+        # Kinds without a `total_bytes` field, and summaries without it,
+        # have no aggregation
+        aggs = ret.get('aggregations') or {}
+        bytes_agg = aggs.get('total_bytes') or {}
+        # Under a post_filter, the sum is nested in a filter aggregation
+        bytes_agg = bytes_agg.get('total_bytes', bytes_agg)
+        total_bytes = bytes_agg.get('value') or 0
+        facets = dict(
+            (name[len('facet:'):],
+             [{'value': bucket['key'], 'count': bucket['doc_count']}
+              for bucket in agg['values']['buckets']])
+            for name, agg in sorted(aggs.items())
+            if name.startswith('facet:'))
+        # A full page may be followed by more results
+        if kind_params.get('timestamp') and hits and \
+                len(hits) >= int(size) and 'sort' in hits[-1]:
+            next_cursor = encode_cursor(hits[-1]['sort'])
+    else:
+        hits = []
+        results = []
+        total = 0
+        total_bytes = 0
+        facets = {}
+    res = {
+        'results': results,
+        'summary': {
+            "total": total,
+            "totalBytes": total_bytes
+        }
+    }
+    if kind_params.get('timestamp'):
+        res['next'] = next_cursor
+    if facets:
+        res['facets'] = facets
+    if hits and '_explanation' in hits[0]:
+        res['explanations'] = [hit.get('_explanation') for hit in hits]
+    return res
+
+
+def _error(e):
+    return {
+        'results': [],
+        'summary': {
+            "total": 0,
+            "totalBytes": 0
+        },
+        'error': str(e)
+    }
+
+
+# A query's kind, summary mode, search api parameters and cache key
+Prepared = namedtuple('Prepared',
+                      ['kind', 'kind_params', 'summary', 'api_params', 'key'])
+
+
+def prepare(kind, userid, size=50, **kw):
+    """Build a query, once for both its ETag and its result (see
+    `etag_prepared` and `query_prepared`).
+
+    Raises ValueError if the query is invalid.
+    """
+    kind_params = ENABLED_SEARCHES[kind]
+    summary = _summary_mode(kw)
+    with metrics.STAGE_SECONDS.time(kind=kind, stage='build_dsl'):
+        api_params = _prepare(kind_params, userid, size, kw, kind=kind,
+                              summary=summary)
+    return Prepared(kind, kind_params, summary, api_params,
+                    _cache_key(kind, api_params))
+
+
+def _lookup(prepared):
+    """Look up the result of a query.
+
+    Returns whether the kind is cached and the cached result (None if there
+    is none).
+    """
+    use_cache = prepared.kind_params.get('cache', True)
+    cached = None
+    if use_cache:
+        cached = _cache.get(prepared.key)
+        metrics.CACHE_REQUESTS.inc(
+            kind=prepared.kind, result='miss' if cached is None else 'hit')
+    return use_cache, cached
+
+
+def _complete(kind, kind_params, api_params, key, use_cache, ret, latency):
+    """Record a search response and convert it to a query result.
+    """
+    metrics.STAGE_SECONDS.observe(latency, kind=kind, stage='es')
+    if 'took' in ret:
+        metrics.ES_TOOK_SECONDS.observe(ret['took'] / 1000., kind=kind)
+    querylog.log_query(kind, api_params['body'], ret, latency)
+    with metrics.STAGE_SECONDS.time(kind=kind, stage='extract'):
+        res = _extract(kind_params, ret, api_params['size'])
+    if use_cache:
+        _cache.set(key, res)
+        _stale.set(key, res)
+    return res
+
+
+def _search_params(kind, api_params, use_cache):
+    """Return the api parameters to search with, leaving out aggregations
+    whose result is cached, the cache key of the aggregations and their
+    cached result (None if there is none).
+
+    Aggregations only depend on the query (visibility and filters), so
+    their result is shared by every page and sort order.
+    """
+    if not use_cache or '"aggs"' not in api_params['body']:
+        return api_params, None, None
+    body = json.loads(api_params['body'])
+    aggs_key = (kind, 'aggs',
+                json.dumps([body.get('query'), body['aggs']], sort_keys=True))
+    aggs = _cache.get(aggs_key)
+    if aggs is not None:
+        del body['aggs']
+        api_params = dict(api_params, body=json.dumps(body, sort_keys=True))
+    return api_params, aggs_key, aggs
+
+
+def _merge_aggs(ret, aggs_key, aggs):
+    """Add cached aggregation results to a search response, or cache those
+    of the response.
+    """
+    if aggs is not None:
+        return dict(ret, aggregations=aggs)
+    if aggs_key is not None and ret.get('aggregations') is not None:
+        _cache.set(aggs_key, ret['aggregations'])
+    return ret
+
+
+def _fallback(kind, key, e):
+    """Return the last good result of a query, flagged as stale, if the
+    search engine failed with `e` (None if there is none).
+    """
+    if not _engine_failure(e):
+        return None
+    res = _stale.get(key)
+    if res is None:
+        return None
+    metrics.STALE_RESPONSES.inc(kind=kind)
+    return dict(res, stale=True)
+
+
+def _search(kind, api_params):
+    engine = _get_engine()
+    if _hedger is None:
+        return engine.search(**api_params)
+    # The client sends each request to the next node, and a random
+    # preference has the hedge search randomly chosen copies of the shards
+    return _hedger.do(
+        kind, lambda: engine.search(**api_params),
+        lambda: engine.search(
+            preference='hedge-%08x' % random.getrandbits(32), **api_params))
+
+
+def _version_marker(stats):
+    # Documents are searchable once refreshed, and refreshes only happen
+    # after changes
+    primaries = stats['_all']['primaries']
+    return '%d.%d.%d' % (primaries['indexing']['index_total'],
+                         primaries['indexing']['delete_total'],
+                         primaries['refresh']['total'])
+
+
+def _observe_version(index, version):
+    """Remember the change marker of an index, and drop the cached results
+    of its kinds when it changed.
+    """
+    _versions.set(index, version)
+    previous = _last_versions.get(index)
+    _last_versions[index] = version
+    if previous is not None and previous != version:
+        kinds = set(kind for kind, kind_params in ENABLED_SEARCHES.items()
+                    if kind_params['index'] == index)
+        _cache.evict(lambda key: key[0] in kinds)
+
+
+def index_version(index):
+    """Return a marker of the state of an index, which changes when the
+    documents its searches see may have (None if unknown).
+
+    Markers come from the index's stats and are kept for a second.
+    """
+    version = _versions.get(index)
+    if version is None:
+        try:
+            stats = _breaker.call(_get_engine().indices.stats, index=index,
+                                  metric='indexing,refresh')
+            version = _version_marker(stats)
+        except (ElasticsearchException, KeyError) as e:
+            logging.error("index_version: %r", e)
+            return None
+        _observe_version(index, version)
+    return version
+
+
+def _etag(prepared, version):
+    key = json.dumps([prepared.key, prepared.summary, version])
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def etag_prepared(prepared):
+    """Return an ETag for the result of a prepared query: a hash of the
+    query and of the change marker of its index.
+
+    Returns None if the marker is unknown.
+    """
+    version = index_version(prepared.kind_params['index'])
+    if version is None:
+        return None
+    return _etag(prepared, version)
+
+
+def etag(kind, userid, size=50, **kw):
+    """`etag_prepared` of a query.
+
+    Returns None if the marker is unknown or the query is invalid.
+    """
+    try:
+        prepared = prepare(kind, userid, size, **kw)
+    except ValueError:
+        return None
+    return etag_prepared(prepared)
+
+
 def query(kind, userid, size=50, **kw):
-    kind_params = ENABLED_SEARCHES.get(kind)
     try:
-        # Arguments received from a network request come in kw, as a mapping
-        # between param_name and a list of received values.
-        # If size was provided by the user, it will be a list, so we take its
-        # first item.
-        if type(size) is list:
-            size = size[0]
-            if int(size) > 100:
-                size = 100
-
-        from_ = int(kw.pop('from', [0])[0])
-
-        api_params = dict([
-            ('index', kind_params['index']),
-            ('doc_type', kind_params['doc_type']),
-            ('size', size),
-            ('from_', from_),
-            ('search_type', 'dfs_query_then_fetch')
-        ])
-
-        body = build_dsl(kind_params, userid, kw, kind=kind)
-        api_params['body'] = json.dumps(body)
-        ret = _get_engine().search(**api_params)
-        logging.info('Performing query %r', kind_params)
-        logging.info('api_params %r', api_params)
-        logging.info('ret %r', ret)
-        if ret.get('hits') is not None:
-            results = [hit['_source'] for hit in ret['hits']['hits']]
-            total = ret['hits']['total']
-            total_bytes = ret.get('aggregations')['total_bytes']['value']
-        else:
-            results = []
-            total = 0
-            total_bytes = 0
-        return {
-            'results': results,
-            'summary': {
-                "total": total,
-                "totalBytes": total_bytes
-            }
-        }
+        prepared = prepare(kind, userid, size, **kw)
+    except ValueError as e:
+        logging.error("query: %r", e)
+        return _error(e)
+    return query_prepared(prepared)
+
+
+def query_prepared(prepared):
+    """`query`, of a prepared query.
+    """
+    kind, kind_params, summary, api_params, key = prepared
+    try:
+        use_cache, cached = _lookup(prepared)
+        if cached is not None:
+            return _summarize(cached, summary)
+        search_params, aggs_key, aggs = _search_params(
+            kind, api_params, use_cache)
+        start = time.perf_counter()
+        try:
+            # Searches leaving out cached aggregations are not shared with
+            # those that need them
+            ret = _flight.do((key, search_params['body']), _breaker.call,
+                             _search, kind, search_params)
+        except ElasticsearchException as e:
+            res = _fallback(kind, key, e)
+            if res is None:
+                raise
+            return _summarize(res, summary)
+        ret = _merge_aggs(ret, aggs_key, aggs)
+        return _summarize(
+            _complete(kind, kind_params, api_params, key, use_cache, ret,
+                      time.perf_counter() - start), summary)
     except (NotFoundError, json.decoder.JSONDecodeError, ValueError) as e:
-        logging.error("query: %r" % e)
-        return {
-            'results': [],
-            'summary': {
-                "total": 0,
-                "totalBytes": 0
-            },
-            'error': str(e)
+        logging.error("query: %r", e)
+        return _error(e)
+
+
+def _plan_multi(userid, queries):
+    """Prepare the queries of a multi query.
+
+    Returns the responses, with cached results and errors filled in, the
+    `(index, kind, kind_params, api_params, key, use_cache, summary)` of the
+    queries left to search, and their _msearch body (None if there are
+    none).
+    """
+    responses = [None] * len(queries)
+    pending = []
+    for i, (kind, params) in enumerate(queries):
+        kind_params = ENABLED_SEARCHES.get(kind)
+        if kind_params is None:
+            responses[i] = _error('Unknown kind %r' % kind)
+            continue
+        params = dict(params)
+        try:
+            prepared = prepare(kind, userid, params.pop('size', 50),
+                               **params)
+        except ValueError as e:
+            responses[i] = _error(e)
+            continue
+        use_cache, cached = _lookup(prepared)
+        if cached is not None:
+            responses[i] = _summarize(cached, prepared.summary)
+            continue
+        pending.append((i, kind, kind_params, prepared.api_params,
+                        prepared.key, use_cache, prepared.summary))
+
+    if not pending:
+        return responses, pending, None
+    lines = []
+    for _, _, _, api_params, _, _, _ in pending:
+        header = {
+            'index': api_params['index'],
+            'type': api_params['doc_type'],
+            'search_type': api_params['search_type'],
         }
+        body = json.loads(api_params['body'])
+        body['size'] = api_params['size']
+        body['from'] = api_params['from_']
+        lines.append(json.dumps(header))
+        lines.append(json.dumps(body, sort_keys=True))
+    return responses, pending, '\n'.join(lines) + '\n'
+
+
+def _complete_multi(responses, pending, ret, latency):
+    """Fill in the responses of a multi query from an _msearch response.
+    """
+    metrics.STAGE_SECONDS.observe(latency, kind='msearch', stage='es')
+    if 'took' in ret:
+        metrics.ES_TOOK_SECONDS.observe(ret['took'] / 1000., kind='msearch')
+    for (i, kind, kind_params, api_params, key, use_cache, summary), sub in \
+            zip(pending, ret['responses']):
+        if 'error' in sub:
+            error = sub['error']
+            if isinstance(error, dict):
+                error = error.get('reason', error)
+            logging.error("multi_query: %r", error)
+            responses[i] = _error(error)
+            continue
+        querylog.log_query(kind, api_params['body'], sub, latency)
+        res = _extract(kind_params, sub, api_params['size'])
+        if use_cache:
+            _cache.set(key, res)
+            _stale.set(key, res)
+        responses[i] = _summarize(res, summary)
+    return responses
+
+
+def _fail_multi(responses, pending, e):
+    """Fill in the responses of a failed multi query, with the last good
+    results of its queries or errors.
+    """
+    for i, kind, _, _, key, _, summary in pending:
+        responses[i] = _summarize(_fallback(kind, key, e) or _error(e),
+                                  summary)
+    return responses
+
+
+def multi_query(userid, queries):
+    """Run several queries in a single _msearch round trip.
+
+    `queries` is a list of `(kind, params)` pairs, `params` being the same
+    mapping `query` receives as keyword arguments. Returns one result per
+    query, in order; a query that fails gets an error result of its own
+    without affecting the others.
+    """
+    responses, pending, body = _plan_multi(userid, queries)
+    if body is None:
+        return responses
+    start = time.perf_counter()
+    try:
+        ret = _breaker.call(_get_engine().msearch, body=body)
+    except ElasticsearchException as e:
+        logging.error("multi_query: %r", e)
+        return _fail_multi(responses, pending, e)
+    return _complete_multi(responses, pending, ret,
+                           time.perf_counter() - start)
+
+
+def _export_query(kind, userid, kw):
+    """Return the kind parameters and query DSL of an export.
+    """
+    kind_params = ENABLED_SEARCHES[kind]
+    for param in ('size', 'from', 'sort', 'cursor', 'summary', 'facets'):
+        kw.pop(param, None)
+    slice_ = kw.pop('slice', None)
+
+    body = build_dsl(kind_params, userid, kw, kind=kind)
+    for param in ('aggs', 'explain', 'sort'):
+        body.pop(param, None)
+    if slice_ is not None:
+        slice_id, slice_max = slice_[0].replace('"', '').split('/')
+        slice_id, slice_max = int(slice_id), int(slice_max)
+        # Elasticsearch rejects slices out of range, and a single one
+        if slice_max < 2 or not 0 <= slice_id < slice_max:
+            raise ValueError('Invalid slice %r' % slice_[0])
+        body['slice'] = {'id': slice_id, 'max': slice_max}
+    return kind_params, body
+
+
+def export(kind, userid, **kw):
+    """Return an iterator over the source of every matching document.
+
+    The query is built (and validated) eagerly, so bad parameters raise here
+    rather than halfway through a response. Documents are then fetched lazily
+    with the scroll API, one batch at a time and in index order.
+
+    A `slice` parameter of the form `<id>/<max>` restricts the export to one
+    slice of a sliced scroll, so clients can fetch slices in parallel. `max`
+    must be at least 2, and `id` in [0, max).
+    """
+    kind_params, body = _export_query(kind, userid, kw)
+    hits = _get_engine().scan(query=body,
+                              index=kind_params['index'],
+                              doc_type=kind_params['doc_type'],
+                              scroll=EXPORT_SCROLL, size=EXPORT_BATCH_SIZE)
+    return (hit['_source'] for hit in hits)
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('metastore.query')
+
+# Share of queries logged with their full request and response
+SAMPLE_RATE = float(os.environ.get('METASTORE_QUERY_LOG_SAMPLE', 0.01))
+
+# Queries slower than this (in milliseconds) are always logged in full
+SLOW_QUERY_MS = float(os.environ.get('METASTORE_SLOW_QUERY_MS', 1000))
+
+
+def _shape(node):
+    if isinstance(node, dict):
+        return dict((k, _shape(v)) for k, v in node.items())
+    if isinstance(node, list):
+        # Several values for the same filter share a fingerprint with one
+        shapes = []
+        for item in node:
+            item = _shape(item)
+            if item not in shapes:
+                shapes.append(item)
+        return shapes
+    return '?'
+
+
+def normalize(body):
+    """Serialize the shape of a query DSL.
+
+    Literal values (filter values, `q` text, the userid, sort order, cursors)
+    are stripped, so queries that only differ in those share a shape.
+    """
+    if not isinstance(body, dict):
+        body = json.loads(body)
+    return json.dumps(_shape(body), sort_keys=True, separators=(',', ':'))
+
+
+def fingerprint(body):
+    """Fingerprint the shape of a query DSL (see `normalize`).
+    """
+    return _hash(normalize(body))
+
+
+def _hash(shape):
+    return hashlib.sha1(shape.encode('utf8')).hexdigest()[:16]
+
+
+class QueryStats(object):
+    """Running latency stats per query fingerprint.
+
+    At most `maxsize` fingerprints are tracked; the least recently seen one
+    is dropped to make room for a new one.
+    """
+
+    ORDERS = ('total', 'count', 'mean', 'max', 'slow')
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, kind, shape, latency, slow=False, key=None):
+        if key is None:
+            key = _hash(shape)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                entry = self._stats[key] = {
+                    'fingerprint': key,
+                    'kind': kind,
+                    'shape': shape,
+                    'count': 0,
+                    'slow': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                }
+                while len(self._stats) > self.maxsize:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(key)
+                entry['shape'] = entry['shape'] or shape
+            entry['count'] += 1
+            entry['slow'] += int(slow)
+            entry['total'] += latency
+            entry['max'] = max(entry['max'], latency)
+        return key
+
+    def top(self, n=10, order='total'):
+        """Return the `n` fingerprints with the highest `order` stat.
+
+        Latencies are reported in milliseconds.
+        """
+        if order not in self.ORDERS:
+            raise ValueError('order must be one of %s' % ', '.join(self.ORDERS))
+        with self._lock:
+            entries = [dict(e) for e in self._stats.values()]
+        for entry in entries:
+            entry['mean'] = entry['total'] / entry['count']
+            for stat in ('total', 'mean', 'max'):
+                entry[stat] = round(entry[stat] * 1000, 3)
+        entries.sort(key=lambda e: e[order], reverse=True)
+        return entries[:n]
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+stats = QueryStats()
+
+
+class _Entry(object):
+    """A query log entry, only formatted if it is emitted.
+    """
+
+    def __init__(self, kind, key, body, ret, latency, full):
+        self.kind = kind
+        self.key = key
+        self.body = body
+        self.ret = ret
+        self.latency = latency
+        self.full = full
+
+    def __str__(self):
+        hits = self.ret.get('hits') or {}
+        entry = {
+            'kind': self.kind,
+            'fingerprint': self.key,
+            'hits': hits.get('total'),
+            'took': self.ret.get('took'),
+            'latency_ms': round(self.latency * 1000, 3),
+        }
+        if self.full:
+            entry['request'] = json.loads(self.body)
+            entry['response'] = self.ret
+        return json.dumps(entry, sort_keys=True)
+
+
+def log_query(kind, body, ret, latency):
+    """Log a query that was sent to elasticsearch.
+
+    `body` is the serialized DSL, `ret` the response and `latency` the time
+    the call took, in seconds. Every query gets a one line summary at INFO;
+    slow queries (at WARNING) and a sample of the rest include the full
+    request and response.
+
+    Latency is also recorded in `stats` under the query's fingerprint.
+    """
+    slow = latency * 1000 >= SLOW_QUERY_MS
+    key = stats.record(kind, normalize(body), latency, slow)
+    if slow:
+        logger.warning('%s', _Entry(kind, key, body, ret, latency, True))
+    elif logger.isEnabledFor(logging.INFO):
+        full = SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+        logger.info('%s', _Entry(kind, key, body, ret, latency, full))
+
+
+def read_log(path):
+    """Aggregate query stats from a file of query log lines.
+    """
+    log_stats = QueryStats(maxsize=sys.maxsize)
+    with open(path) as f:
+        for line in f:
+            start = line.find('{')
+            if start < 0:
+                continue
+            try:
+                entry = json.loads(line[start:])
+            except ValueError:
+                continue
+            if 'fingerprint' not in entry or 'latency_ms' not in entry:
+                continue
+            # Only full entries carry the request to take the shape from
+            shape = None
+            if 'request' in entry:
+                shape = normalize(entry['request'])
+            log_stats.record(entry.get('kind'), shape,
+                             entry['latency_ms'] / 1000.,
+                             entry['latency_ms'] >= SLOW_QUERY_MS,
+                             key=entry['fingerprint'])
+    return log_stats
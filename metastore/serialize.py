@@ -0,0 +1,119 @@
+"""Response serialization and compression.
+
+JSON is encoded with the fastest encoder available (`orjson`, then `ujson`,
+then the standard library), or the one named by `METASTORE_JSON`. Bodies of
+at least `METASTORE_COMPRESS_MIN_SIZE` bytes (0 never) are compressed with
+brotli (with the `brotli` package) or gzip, as the client accepts.
+"""
+import os
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf8')
+
+
+def _ujson_dumps(data):
+    return ujson.dumps(data, ensure_ascii=False,
+                       escape_forward_slashes=False).encode('utf8')
+
+
+# Encoders of data to JSON bytes, by name
+SERIALIZERS = {'json': _json_dumps}
+if ujson is not None:
+    SERIALIZERS['ujson'] = _ujson_dumps
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson.dumps
+
+# Compression: min body size, and levels favouring speed over size
+COMPRESS_MIN_SIZE = int(os.environ.get('METASTORE_COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('METASTORE_GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('METASTORE_BROTLI_QUALITY', 4))
+
+
+def _default_serializer():
+    name = os.environ.get('METASTORE_JSON')
+    if name:
+        return SERIALIZERS[name]
+    for name in ('orjson', 'ujson', 'json'):
+        if name in SERIALIZERS:
+            return SERIALIZERS[name]
+
+
+dumps = _default_serializer()
+
+
+def jsonp(data, callback=None):
+    """Return the JSON of `data`, wrapped in a call to `callback` if given
+    (JSONP), and its content type.
+    """
+    body = dumps(data)
+    if callback:
+        return (b''.join([callback.encode('utf8'), b'(', body, b');']),
+                'application/javascript')
+    return body, 'application/json'
+
+
+def encoding_qualities(header):
+    """Return {content coding: quality} of an Accept-Encoding `header`,
+    including the codings it refuses (with a quality of 0).
+    """
+    qualities = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if coding.strip():
+            qualities[coding.strip().lower()] = quality
+    return qualities
+
+
+def accepted_encodings(header):
+    """Return the content codings an Accept-Encoding `header` accepts.
+    """
+    return set(coding for coding, quality
+               in encoding_qualities(header).items() if quality > 0)
+
+
+def _accepts(qualities, coding):
+    # A coding named explicitly (even with q=0) overrides the wildcard
+    quality = qualities.get(coding)
+    if quality is None:
+        quality = qualities.get('*', 0)
+    return quality > 0
+
+
+def compress(body, accept_encoding):
+    """Compress `body` as the Accept-Encoding header `accept_encoding`
+    allows, if it is large enough to be worth it.
+
+    Returns the body and its content coding (None if not compressed).
+    """
+    if COMPRESS_MIN_SIZE <= 0 or len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+    qualities = encoding_qualities(accept_encoding)
+    if brotli is not None and qualities.get('br', 0) > 0:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if _accepts(qualities, 'gzip'):
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+    return body, None
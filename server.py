@@ -9,7 +9,7 @@ app = metastore.create()
 port = os.environ.get('PORT') or 5000
 
 # Debug mode flag
-debug = True
+debug = app.config['DEBUG']
 
 # Run application
 if __name__ == '__main__':
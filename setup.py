@@ -20,7 +20,6 @@ NAME = 'metastore'
 INSTALL_REQUIRES = [
     'flask',
     'flask-cors',
-    'flask-jsonpify',
     'pyyaml',
     'requests',
     'pyjwt',
@@ -35,6 +34,16 @@ TESTS_REQUIRE = [
     'coveralls',
     'tox'
 ]
+SERVER_REQUIRE = [
+    'gunicorn',
+]
+ASYNC_REQUIRE = [
+    'aiohttp>=3.0',
+]
+SPEEDUPS_REQUIRE = [
+    'orjson',
+    'brotli',
+]
 README = read('README.md')
 VERSION = read(PACKAGE, 'VERSION')
 PACKAGES = find_packages(exclude=['examples', 'tests'])
@@ -48,7 +57,12 @@ setup(
     include_package_data=True,
     install_requires=INSTALL_REQUIRES,
     tests_require=TESTS_REQUIRE,
-    extras_require={'develop': TESTS_REQUIRE},
+    extras_require={
+        'develop': TESTS_REQUIRE,
+        'server': SERVER_REQUIRE,
+        'async': ASYNC_REQUIRE,
+        'speedups': SPEEDUPS_REQUIRE,
+    },
     zip_safe=False,
     long_description=README,
     description='{{ DESCRIPTION }}',
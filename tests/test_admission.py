@@ -0,0 +1,117 @@
+import os
+import asyncio
+import threading
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+module = import_module('metastore.admission')
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.admission = module.AdmissionController(
+            limit=3, per_client=2, reserved=1, queue=1, wait=0.05)
+
+    # Tests
+
+    def test_per_client_limit(self):
+        self.admission.acquire('a', True)
+        self.admission.acquire('a', True)
+        with self.assertRaises(module.Rejected) as cm:
+            self.admission.acquire('a', True)
+        self.assertEqual(cm.exception.reason, 'timeout')
+        self.admission.acquire('b', True)
+
+    def test_reserved_for_authenticated(self):
+        self.admission.acquire('a', False)
+        self.admission.acquire('b', False)
+        with self.assertRaises(module.Rejected):
+            self.admission.acquire('c', False)
+        self.admission.acquire('user', True)
+        self.assertEqual(self.admission.active, 3)
+
+    def test_queue_full(self):
+        for client in 'abc':
+            self.admission.acquire(client, True)
+        waiter = threading.Thread(target=self.assertRaises, args=(
+            module.Rejected, self.admission.acquire, 'd', True))
+        waiter.start()
+        while not self.admission.waiting:
+            pass
+        with self.assertRaises(module.Rejected) as cm:
+            self.admission.acquire('e', True)
+        self.assertEqual(cm.exception.reason, 'queue_full')
+        waiter.join()
+
+    def test_waiting_request_admitted_on_release(self):
+        for client in 'abc':
+            self.admission.acquire(client, True)
+        self.admission.wait = 5
+        timer = threading.Timer(0.01, self.admission.release, ('a', True))
+        timer.start()
+        with self.admission.admit('d', True):
+            self.assertEqual(self.admission.active, 3)
+        self.assertEqual(self.admission.active, 2)
+
+    def test_options_for_threads(self):
+        options = module.options(threads=4)
+        self.assertEqual(options['limit'], 4)
+        self.assertEqual(options['per_client'], 1)
+        self.assertEqual(options['reserved'], 1)
+        self.assertEqual(options['queue'], 0)
+        with patch.dict(os.environ, {'METASTORE_MAX_CONCURRENCY': '32'}):
+            self.assertEqual(module.options(threads=4)['limit'], 4)
+            self.assertEqual(module.options()['limit'], 32)
+
+    def test_unknown_clients_limited_in_total(self):
+        self.admission.acquire(None, False)
+        self.admission.acquire(None, False)
+        with self.assertRaises(module.Rejected):
+            self.admission.acquire(None, False)
+        self.admission.release(None, False)
+        self.assertEqual(self.admission.active, 1)
+
+    def test_proxy_count(self):
+        with patch.dict(os.environ, {'METASTORE_PROXY_COUNT': ''}):
+            self.assertIsNone(module.proxy_count())
+        with patch.dict(os.environ, {'METASTORE_PROXY_COUNT': '0'}):
+            self.assertEqual(module.proxy_count(), 0)
+
+    def test_disabled(self):
+        admission = module.AdmissionController(limit=0)
+        for _ in range(10):
+            admission.acquire('a')
+        self.assertEqual(admission.active, 0)
+
+
+class AsyncAdmissionControllerTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.admission = module.AsyncAdmissionController(
+            limit=1, queue=1, wait=1)
+
+    # Tests
+
+    def test_acquire(self):
+        async def scenario():
+            await self.admission.acquire('a', True)
+            waiter = asyncio.ensure_future(
+                self.admission.acquire('b', True))
+            await asyncio.sleep(0)
+            with self.assertRaises(module.Rejected) as cm:
+                await self.admission.acquire('c', True)
+            self.assertEqual(cm.exception.reason, 'queue_full')
+            await self.admission.release('a', True)
+            await waiter
+            self.assertEqual(self.admission.active, 1)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(scenario())
@@ -0,0 +1,192 @@
+import json
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+from elasticsearch import NotFoundError
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import (AioHTTPTestCase, TestServer,
+                                    make_mocked_request)
+    module = import_module('metastore.aio')
+except ImportError:
+    AioHTTPTestCase = unittest.TestCase
+    module = None
+models = import_module('metastore.models')
+memory = import_module('metastore.backends.memory')
+
+
+@unittest.skipIf(module is None, 'aiohttp is not installed')
+class AppTest(AioHTTPTestCase):
+
+    # Actions
+
+    async def get_application(self):
+        models._cache.clear()
+        models._versions.clear()
+        backend = memory.MemoryBackend()
+        backend.indices.create('datahub')
+        for name, title in (('a', 'gdp per country'), ('b', 'co2 levels')):
+            backend.index('datahub', 'dataset', {
+                'name': name,
+                'title': title,
+                'datahub': {'findability': 'published', 'ownerid': 'core',
+                            'stats': {'bytes': 5}},
+            }, id=name)
+        return module.create(module.ThreadedBackend(backend))
+
+    # Tests
+
+    async def test_search(self):
+        res = await self.client.get('/metastore/search',
+                                    params={'q': '"gdp"'})
+        self.assertEqual(res.status, 200)
+        ret = await res.json()
+        self.assertEqual([r['name'] for r in ret['results']], ['a'])
+        self.assertEqual(ret['summary'], {'total': 1, 'totalBytes': 5})
+
+    async def test_search_unknown_kind(self):
+        res = await self.client.get('/metastore/search/nope')
+        self.assertEqual(res.status, 400)
+
+    async def test_search_jsonp(self):
+        res = await self.client.get('/metastore/search',
+                                    params={'callback': 'cb', '_': '1'})
+        body = await res.text()
+        self.assertTrue(body.startswith('cb({'))
+        ret = json.loads(body[3:-2])
+        self.assertNotIn('error', ret)
+        self.assertEqual(ret['summary']['total'], 2)
+
+    async def test_msearch(self):
+        res = await self.client.post('/metastore/msearch', json=[
+            {'params': {'q': '"co2"'}}, {'kind': 'nope'}])
+        first, unknown = (await res.json())['responses']
+        self.assertEqual([r['name'] for r in first['results']], ['b'])
+        self.assertIn('error', unknown)
+        res = await self.client.post('/metastore/msearch', data='nope')
+        self.assertEqual(res.status, 400)
+
+    async def test_export(self):
+        res = await self.client.get('/metastore/export')
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        names = [json.loads(line)['name']
+                 for line in (await res.text()).splitlines()]
+        self.assertEqual(sorted(names), ['a', 'b'])
+        res = await self.client.get('/metastore/export?slice=2/2')
+        self.assertEqual(res.status, 400)
+
+    async def test_export_fails_midstream(self):
+        async def scan(**params):
+            yield {'_source': {'name': 'a'}}
+            raise NotFoundError(404, 'index_not_found_exception')
+        with patch.object(self.app[module.ENGINE], 'scan', scan):
+            res = await self.client.get('/metastore/export')
+            self.assertEqual(res.status, 200)
+            lines = [json.loads(line)
+                     for line in (await res.text()).splitlines()]
+        self.assertEqual(lines[0], {'name': 'a'})
+        self.assertIn('error', lines[1])
+
+    async def test_search_not_modified(self):
+        res = await self.client.get('/metastore/search')
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        res = await self.client.get('/metastore/search',
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(res.status, 304)
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=5')
+        self.assertIn('Origin', res.headers['Vary'])
+
+    async def test_remote_behind_proxies(self):
+        request = make_mocked_request('GET', '/', headers={
+            'X-Forwarded-For': '10.1.1.1, 10.0.0.1, 10.2.2.2'})
+        with patch.object(module, 'PROXY_COUNT', 2):
+            self.assertEqual(module._remote(request), '10.0.0.1')
+        with patch.object(module, 'PROXY_COUNT', 4):
+            self.assertEqual(module._remote(request), request.remote)
+
+    async def test_admin_queries_token(self):
+        res = await self.client.get('/metastore/admin/queries')
+        self.assertEqual(res.status, 403)
+        with patch.object(module, 'ADMIN_TOKEN', 'secret'):
+            res = await self.client.get('/metastore/admin/queries',
+                                        headers={'X-Admin-Token': 'wrong'})
+            self.assertEqual(res.status, 403)
+            res = await self.client.get('/metastore/admin/queries',
+                                        headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(res.status, 200)
+
+    async def test_health_and_cors(self):
+        res = await self.client.get('/metastore/health/ready',
+                                    headers={'Origin': 'http://a.b'})
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'],
+                         'http://a.b')
+
+
+@unittest.skipIf(module is None, 'aiohttp is not installed')
+class AsyncElasticsearchTest(unittest.IsolatedAsyncioTestCase):
+
+    # Actions
+
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def handler(request):
+            body = await request.text()
+            self.requests.append((request.method, request.path,
+                                  dict(request.query), body))
+            if request.path.startswith('/nope'):
+                return web.json_response({'error': {
+                    'type': 'index_not_found_exception'}}, status=404)
+            if request.path == '/_search/scroll':
+                return web.json_response({'hits': {'hits': []}})
+            return web.json_response({'_scroll_id': 's', 'hits': {
+                'total': 1, 'hits': [{'_source': {'a': 1}}]}})
+
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.es = module.AsyncElasticsearch(
+            str(self.server.make_url('')))
+
+    async def asyncTearDown(self):
+        await self.es.close()
+        await self.server.close()
+
+    # Tests
+
+    async def test_search(self):
+        ret = await self.es.search(index='datahub', doc_type='dataset',
+                                   body='{}', size=5, from_=0,
+                                   search_type='dfs_query_then_fetch')
+        self.assertEqual(ret['hits']['total'], 1)
+        self.assertEqual(self.requests, [(
+            'POST', '/datahub/dataset/_search',
+            {'size': '5', 'from': '0',
+             'search_type': 'dfs_query_then_fetch'}, '{}')])
+
+    async def test_errors(self):
+        with self.assertRaises(NotFoundError) as cm:
+            await self.es.search(index='nope', body='{}')
+        self.assertEqual(cm.exception.error, 'index_not_found_exception')
+
+    async def test_scan_clears_scroll(self):
+        hits = [hit async for hit in self.es.scan(
+            query={}, index='datahub', scroll='1m', size=10)]
+        self.assertEqual(hits, [{'_source': {'a': 1}}])
+        self.assertEqual([r[:2] for r in self.requests], [
+            ('POST', '/datahub/_search'), ('POST', '/_search/scroll'),
+            ('DELETE', '/_search/scroll')])
+
+    async def test_ping(self):
+        self.assertTrue(await self.es.ping())
+
+    async def test_index_stats(self):
+        await self.es.index_stats('datahub', metric='indexing,refresh')
+        self.assertEqual(self.requests[0][:2],
+                         ('GET', '/datahub/_stats/indexing,refresh'))
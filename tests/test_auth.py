@@ -0,0 +1,72 @@
+import time
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+module = import_module('metastore.auth')
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        self.decode = patch.object(module.jwt, 'decode').start()
+        self.decode.return_value = {'userid': 'owner1'}
+        self.tokens = module.TokenCache()
+
+    # Tests
+
+    def test_valid_token_is_verified_once(self):
+        self.assertEqual(self.tokens.get_userid('token', 'key'), 'owner1')
+        self.assertEqual(self.tokens.get_userid('token', 'key'), 'owner1')
+        self.assertEqual(self.decode.call_count, 1)
+
+    def test_invalid_token_is_negatively_cached(self):
+        self.decode.side_effect = module.jwt.InvalidTokenError
+        self.assertIsNone(self.tokens.get_userid('bad', 'key'))
+        self.assertIsNone(self.tokens.get_userid('bad', 'key'))
+        self.assertEqual(self.decode.call_count, 1)
+
+    def test_expired_token_is_not_cached(self):
+        self.decode.return_value = {'userid': 'owner1',
+                                    'exp': time.time() - 1}
+        self.tokens.get_userid('token', 'key')
+        self.tokens.get_userid('token', 'key')
+        self.assertEqual(self.decode.call_count, 2)
+
+    def test_entry_evicted_at_exp(self):
+        self.decode.return_value = {'userid': 'owner1',
+                                    'exp': time.time() + 0.05}
+        self.tokens.get_userid('token', 'key')
+        time.sleep(0.1)
+        self.tokens.get_userid('token', 'key')
+        self.assertEqual(self.decode.call_count, 2)
+
+    def test_key_rotation_clears_cache(self):
+        self.tokens.get_userid('token', 'key')
+        self.tokens.get_userid('token', 'new-key')
+        self.assertEqual(self.decode.call_count, 2)
+        self.decode.assert_called_with('token', 'new-key')
+
+
+class IsAdminTest(unittest.TestCase):
+
+    # Tests
+
+    def test_admin_token(self):
+        self.assertTrue(module.is_admin('secret', 'secret'))
+        self.assertFalse(module.is_admin('wrong', 'secret'))
+        self.assertFalse(module.is_admin(None, 'secret'))
+
+    def test_closed_without_admin_token(self):
+        self.assertFalse(module.is_admin('', None))
+        self.assertFalse(module.is_admin('', ''))
+        self.assertFalse(module.is_admin('anything', None))
+
+    def test_non_ascii_token(self):
+        self.assertFalse(module.is_admin('s\xe9cret', 'secret'))
+        self.assertTrue(module.is_admin('s\xe9cret', 's\xe9cret'))
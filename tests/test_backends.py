@@ -0,0 +1,293 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+from elasticsearch import NotFoundError, RequestError
+module = import_module('metastore.backends')
+memory = import_module('metastore.backends.memory')
+elastic = import_module('metastore.backends.elastic')
+sqlite = import_module('metastore.backends.sqlite')
+analysis = import_module('metastore.backends.analysis')
+cli = import_module('metastore.__main__')
+
+
+class CreateTest(unittest.TestCase):
+
+    # Tests
+
+    def test_create(self):
+        self.assertIsInstance(module.create('memory'), memory.MemoryBackend)
+
+    def test_create_unknown(self):
+        with self.assertRaises(ValueError):
+            module.create('nope')
+
+
+class ElasticsearchBackendTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        patch.dict(os.environ, {
+            'DATAHUB_ELASTICSEARCH_ADDRESS': 'http://a:9200, https://b:9200',
+            'METASTORE_ES_POOL_SIZE': '8',
+            'METASTORE_ES_SNIFF': 'yes',
+        }).start()
+
+    # Tests
+
+    def test_client_options(self):
+        self.assertEqual(elastic.hosts(), ['http://a:9200', 'https://b:9200'])
+        options = elastic.client_options()
+        self.assertEqual(options['maxsize'], 8)
+        self.assertTrue(options['retry_on_timeout'])
+        self.assertTrue(options['sniff_on_connection_fail'])
+
+    def test_client_created_lazily_per_process(self):
+        client = patch.object(elastic, 'Elasticsearch').start()
+        backend = elastic.ElasticsearchBackend()
+        client.assert_not_called()
+        first = backend.client
+        self.assertIs(backend.client, first)
+        self.assertEqual(client.call_count, 1)
+        with patch.object(os, 'getpid', return_value=-1):
+            backend.client
+        self.assertEqual(client.call_count, 2)
+        client.assert_called_with(['http://a:9200', 'https://b:9200'],
+                                  **elastic.client_options())
+
+
+class AnalysisTest(unittest.TestCase):
+
+    # Tests
+
+    def test_english(self):
+        self.assertEqual(analysis.english("The list of all countries' codes"),
+                         ['list', 'all', 'countri', 'code'])
+
+    def test_standard(self):
+        self.assertEqual(analysis.standard('co2-PPM test2.com'),
+                         ['co2', 'ppm', 'test2.com'])
+
+
+class MemoryBackendTest(unittest.TestCase):
+
+    # Whether text fields can be aggregated on (by their whole value)
+    TEXT_AGGREGATIONS = False
+
+    # Actions
+
+    def setUp(self):
+        self.backend = memory.MemoryBackend()
+        self.backend.indices.create('events')
+        self.backend.indices.put_mapping(doc_type='event', index='events',
+                                         body={'event': {'properties': {
+                                             'timestamp': {'type': 'date'},
+                                             'owner': {'type': 'keyword'},
+                                         }}})
+        for i in range(5):
+            self.backend.index('events', 'event', {
+                'timestamp': '200%d-01-01T00:00:00' % i,
+                'owner': 'owner%d' % (i % 2),
+                'title': 'event number %d' % i,
+                'stats': {'bytes': i, 'rows': 2},
+            })
+
+    # Helpers
+
+    def search(self, body, **params):
+        return self.backend.search(index='events', doc_type='event',
+                                   body=body, **params)
+
+    # Tests
+
+    def test_bool_filter_and_sum(self):
+        ret = self.search({
+            'query': {'bool': {'filter': [{'term': {'owner': 'owner0'}}]}},
+            'aggs': {'bytes': {'sum': {'field': 'stats.bytes'}}},
+        })
+        self.assertEqual(ret['hits']['total'], 3)
+        self.assertEqual(ret['aggregations']['bytes']['value'], 6)
+
+    def test_terms_and_filter_aggregations(self):
+        ret = self.search({
+            'query': {'bool': {'filter': [{'range': {'stats.bytes': {
+                'gte': 1}}}]}},
+            'aggs': {
+                'owners': {'terms': {'field': 'owner', 'size': 1}},
+                'owner0': {'filter': {'term': {'owner': 'owner0'}},
+                           'aggs': {'bytes': {'sum': {
+                               'field': 'stats.bytes'}}}},
+            },
+        })
+        owners = ret['aggregations']['owners']
+        self.assertEqual(owners['buckets'],
+                         [{'key': 'owner0', 'doc_count': 2}])
+        self.assertEqual(owners['sum_other_doc_count'], 2)
+        owner0 = ret['aggregations']['owner0']
+        self.assertEqual(owner0['doc_count'], 2)
+        self.assertEqual(owner0['bytes']['value'], 6)
+
+    def test_terms_aggregation_on_keyword_subfield(self):
+        ret = self.search({'aggs': {'titles': {'terms': {
+            'field': 'title.keyword', 'size': 1}}}})
+        self.assertEqual(ret['aggregations']['titles']['buckets'],
+                         [{'key': 'event number 0', 'doc_count': 1}])
+
+    def test_terms_aggregation_on_text_field(self):
+        body = {'aggs': {'titles': {'terms': {'field': 'title'}}}}
+        if not self.TEXT_AGGREGATIONS:
+            with self.assertRaises(RequestError):
+                self.search(body)
+            return
+        buckets = self.search(body)['aggregations']['titles']['buckets']
+        self.assertEqual([(b['key'], b['doc_count']) for b in buckets],
+                         [('event number %d' % i, 1) for i in range(5)])
+
+    def test_sort_and_search_after(self):
+        body = {'sort': [{'timestamp': {'order': 'desc'}},
+                         {'_uid': {'order': 'desc'}}]}
+        ret = self.search(body, size=2)
+        hits = ret['hits']['hits']
+        self.assertEqual([h['_source']['timestamp'][:4] for h in hits],
+                         ['2004', '2003'])
+        ret = self.search(dict(body, search_after=hits[-1]['sort']), size=2)
+        self.assertEqual([h['_source']['timestamp'][:4]
+                          for h in ret['hits']['hits']], ['2002', '2001'])
+        self.assertEqual(ret['hits']['total'], 5)
+
+    def test_empty_sort_is_by_score(self):
+        hit = self.search({'sort': []})['hits']['hits'][0]
+        self.assertIsInstance(hit['_score'], float)
+        self.assertNotIn('sort', hit)
+
+    def test_multi_match_scoring(self):
+        ret = self.search({'query': {'multi_match': {
+            'query': 'number 3', 'fields': ['title^2', 'owner'],
+            'type': 'most_fields'}}})
+        self.assertEqual(ret['hits']['hits'][0]['_source']['title'],
+                         'event number 3')
+
+    def test_source_filtering(self):
+        ret = self.search({'_source': {'includes': ['stats', 'owner'],
+                                       'excludes': ['stats.rows']}}, size=1)
+        self.assertEqual(ret['hits']['hits'][0]['_source'],
+                         {'owner': 'owner0', 'stats': {'bytes': 0}})
+
+    def test_msearch_errors_are_per_query(self):
+        ret = self.backend.msearch([
+            {'index': 'events'}, {'query': {'match_all': {}}},
+            {'index': 'nope'}, {'query': {'match_all': {}}},
+            {'index': 'events'}, {'query': {'nope': {}}},
+        ])
+        first, missing, bad = ret['responses']
+        self.assertEqual(first['hits']['total'], 5)
+        self.assertEqual(missing['status'], 404)
+        self.assertEqual(bad['status'], 400)
+
+    def test_scan_slices(self):
+        hits = [list(self.backend.scan(query={'slice': {'id': i, 'max': 2}},
+                                       index='events'))
+                for i in range(2)]
+        self.assertEqual(len(hits[0]) + len(hits[1]), 5)
+
+    def test_missing_index(self):
+        with self.assertRaises(NotFoundError):
+            self.backend.search(index='nope', body={})
+
+    def test_stats(self):
+        stats = self.backend.indices.stats(index='events')
+        primaries = stats['_all']['primaries']
+        self.assertEqual(primaries['docs']['count'], 5)
+        before = primaries['indexing']['index_total']
+        self.backend.index('events', 'event', {'title': 'x'}, id='new')
+        stats = self.backend.indices.stats(index='events')
+        self.assertGreater(
+            stats['_all']['primaries']['indexing']['index_total'], before)
+        with self.assertRaises(NotFoundError):
+            self.backend.indices.stats(index='nope')
+
+
+class SqliteBackendTest(MemoryBackendTest):
+
+    # Mappings are not kept, any field can be aggregated on
+    TEXT_AGGREGATIONS = True
+
+    # Actions
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.backend = sqlite.SqliteBackend(
+            os.path.join(self.tmp, 'test.db'), searches={'event': {
+                'index': 'events',
+                'doc_type': 'event',
+                'owner': 'owner',
+                'timestamp': 'timestamp',
+                'q_fields': ['title', 'owner'],
+            }})
+        self.backend.indices.create('events')
+        self.backend.load('events', 'event', (
+            ('doc%d' % i, {
+                'timestamp': '200%d-01-01T00:00:00' % i,
+                'owner': 'owner%d' % (i % 2),
+                'title': 'event number %d' % i,
+                'stats': {'bytes': i, 'rows': 2},
+            }) for i in range(5)))
+
+    # Tests
+
+    def test_create(self):
+        os.environ['METASTORE_SQLITE_PATH'] = os.path.join(self.tmp, 'x.db')
+        self.addCleanup(os.environ.pop, 'METASTORE_SQLITE_PATH')
+        self.assertIsInstance(module.create('sqlite'), sqlite.SqliteBackend)
+
+    def test_persists(self):
+        backend = sqlite.SqliteBackend(self.backend.path,
+                                       searches=self.backend.searches)
+        ret = backend.search(index='events', doc_type='event', body={
+            'query': {'match': {'title': 'numbers'}}})
+        self.assertEqual(ret['hits']['total'], 5)
+
+    def test_replace(self):
+        self.backend.index('events', 'event', {'title': 'replaced'},
+                           id='doc0')
+        ret = self.search({'query': {'match': {'title': 'replaced'}}})
+        self.assertEqual([h['_id'] for h in ret['hits']['hits']], ['doc0'])
+        self.assertEqual(self.search({})['hits']['total'], 5)
+
+    def test_filters_and_post_filter(self):
+        ret = self.search({
+            'query': {'bool': {
+                'filter': [{'range': {'stats.bytes': {'gte': 1}}}],
+                'must_not': [{'terms': {'owner': ['owner1']}}],
+            }},
+            'post_filter': {'term': {'stats.bytes': 4}},
+            'aggs': {'bytes': {'sum': {'field': 'stats.bytes'}}},
+        })
+        self.assertEqual(ret['aggregations']['bytes']['value'], 6)
+        self.assertEqual([h['_id'] for h in ret['hits']['hits']], ['doc4'])
+
+    def test_read_documents(self):
+        hit = {'_id': 'x', '_source': {'a': 1}}
+        self.assertEqual(list(cli.read_documents(io.StringIO(
+            '{"a": 1}\n%s\n' % json.dumps(hit)))),
+            [(None, {'a': 1}), ('x', {'a': 1})])
+        self.assertEqual(list(cli.read_documents(io.StringIO(json.dumps(
+            {'hits': {'total': 1, 'hits': [hit]}}, indent=2)))),
+            [('x', {'a': 1})])
+        self.assertEqual(list(cli.read_documents(io.StringIO('\n'))), [])
+
+    def test_read_documents_streams_lines(self):
+        docs = cli.read_documents(io.StringIO('\n{"a": 1}\nnope\n'))
+        self.assertEqual(next(docs), (None, {'a': 1}))
+        with self.assertRaises(ValueError):
+            next(docs)
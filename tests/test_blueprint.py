@@ -1,10 +1,18 @@
+import gzip
+import json
+import threading
 import unittest
 try:
     from unittest.mock import Mock, patch
 except ImportError:
     from mock import Mock, patch
 from importlib import import_module
+from elasticsearch import TransportError
+from flask import Flask
 module = import_module('metastore.blueprint')
+admission = import_module('metastore.admission')
+models = import_module('metastore.models')
+memory = import_module('metastore.backends.memory')
 
 
 class createTest(unittest.TestCase):
@@ -14,8 +22,266 @@ class createTest(unittest.TestCase):
     def setUp(self):
         self.addCleanup(patch.stopall)
         self.controllers = patch.object(module, 'controllers').start()
+        self.controllers.etag.return_value = None
+        patch.object(module, '_admission', module.AdmissionController(
+            **admission.options(threads=4))).start()
+        app = Flask('test')
+        app.register_blueprint(module.create(), url_prefix='/metastore/')
+        self.client = app.test_client()
 
     # Tests
 
     def test(self):
         self.assertTrue(module.create())
+
+    def test_search_passes_all_values(self):
+        self.controllers.search.return_value = {'results': [], 'summary': {}}
+        res = self.client.get('/metastore/search/events?owner="a"&owner="b"')
+        self.assertEqual(res.status_code, 200)
+        self.controllers.prepare.assert_called_with(
+            'events', None, {'owner': ['"a"', '"b"']})
+        self.controllers.search.assert_called_with(
+            'events', None, {'owner': ['"a"', '"b"']},
+            self.controllers.prepare.return_value)
+
+    def test_export_streams_ndjson(self):
+        self.controllers.export.return_value = iter([{'a': 1}, {'b': 2}])
+        res = self.client.get('/metastore/export/events')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'a': 1}, {'b': 2}])
+
+    def test_export_fails_midstream(self):
+        def docs():
+            yield {'a': 1}
+            raise TransportError(500, 'boom')
+        self.controllers.export.return_value = docs()
+        res = self.client.get('/metastore/export/events')
+        self.assertEqual(res.status_code, 200)
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(lines[0]), {'a': 1})
+        self.assertIn('error', json.loads(lines[-1]))
+        self.assertEqual(len(lines), 2)
+
+    def test_export_bad_request(self):
+        self.controllers.export.return_value = None
+        res = self.client.get('/metastore/export/unknown')
+        self.assertEqual(res.status_code, 400)
+
+    def test_multi_search(self):
+        self.controllers.multi_search.return_value = [{'results': []}]
+        res = self.client.post('/metastore/msearch', data=json.dumps(
+            [{'kind': 'events', 'params': {'owner': '"a"'}}]))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {'responses': [{'results': []}]})
+
+    def test_multi_search_bad_request(self):
+        self.controllers.multi_search.return_value = None
+        res = self.client.post('/metastore/msearch', data='nope')
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_unknown_kind(self):
+        res = self.client.get('/metastore/search/unknown')
+        self.assertEqual(res.status_code, 400)
+        self.controllers.search.assert_not_called()
+
+    def test_metrics(self):
+        self.controllers.search.return_value = {'results': [], 'summary': {}}
+        self.client.get('/metastore/search/events')
+        res = self.client.get('/metastore/metrics')
+        self.assertEqual(res.status_code, 200)
+        text = res.get_data(as_text=True)
+        self.assertIn('metastore_request_seconds_count{kind="events"}', text)
+        self.assertIn(
+            'metastore_stage_seconds_count{kind="events",stage="serialize"}',
+            text)
+
+    def test_admin_queries(self):
+        headers = {'X-Admin-Token': 'secret'}
+        with patch.object(module, 'ADMIN_TOKEN', 'secret'):
+            res = self.client.get('/metastore/admin/queries?top=5',
+                                  headers=headers)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('queries', res.get_json())
+            res = self.client.get('/metastore/admin/queries?order=nope',
+                                  headers=headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_admin_queries_token(self):
+        with patch.object(module, 'ADMIN_TOKEN', 'secret'):
+            res = self.client.get('/metastore/admin/queries')
+            self.assertEqual(res.status_code, 403)
+            res = self.client.get('/metastore/admin/queries',
+                                  headers={'X-Admin-Token': 's\xe9cret'})
+            self.assertEqual(res.status_code, 403)
+            res = self.client.get('/metastore/admin/queries',
+                                  headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(res.status_code, 200)
+
+    def test_admin_queries_closed_without_token(self):
+        with patch.object(module, 'ADMIN_TOKEN', None):
+            res = self.client.get('/metastore/admin/queries')
+            self.assertEqual(res.status_code, 403)
+            res = self.client.get('/metastore/admin/queries',
+                                  headers={'X-Admin-Token': ''})
+            self.assertEqual(res.status_code, 403)
+
+    def test_health(self):
+        self.assertEqual(self.client.get('/metastore/health/live').status_code,
+                         200)
+        self.controllers.ready.return_value = False
+        self.assertEqual(
+            self.client.get('/metastore/health/ready').status_code, 503)
+        self.controllers.ready.return_value = True
+        self.assertEqual(
+            self.client.get('/metastore/health/ready').status_code, 200)
+
+    def test_search_rejected(self):
+        patch.object(module, '_admission', module.AdmissionController(
+            limit=1, reserved=0, queue=0)).start()
+        module._admission.acquire('addr:127.0.0.1')
+        res = self.client.get('/metastore/search/events')
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.controllers.search.assert_not_called()
+
+    def test_threads_reserved_for_authenticated(self):
+        # As a gunicorn worker with the default 4 threads
+        patch.object(module, '_admission', module.AdmissionController(
+            **admission.options(threads=4))).start()
+        tokens = patch.object(module, '_tokens').start()
+        tokens.get_userid.return_value = 'user1'
+        searching = threading.Semaphore(0)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def search(kind, userid, args, prepared):
+            if userid is None:
+                searching.release()
+                release.wait(5)
+            return {'results': []}
+        self.controllers.search.side_effect = search
+
+        def get(address):
+            return self.client.get('/metastore/search/events',
+                                   environ_base={'REMOTE_ADDR': address})
+        anonymous = [threading.Thread(target=get, args=('10.0.0.%d' % i,))
+                     for i in range(3)]
+        for thread in anonymous:
+            thread.start()
+        for _ in anonymous:
+            searching.acquire()
+        self.assertEqual(get('10.0.0.9').status_code, 429)
+        res = self.client.get('/metastore/search/events',
+                              headers={'Auth-Token': 'token'})
+        self.assertEqual(res.status_code, 200)
+        release.set()
+        for thread in anonymous:
+            thread.join()
+        self.assertEqual(module._admission.active, 0)
+
+    def test_export_admitted_until_closed(self):
+        self.controllers.export.return_value = iter([{'a': 1}])
+        res = self.client.get('/metastore/export/events')
+        self.assertEqual(module._admission.active, 1)
+        res.close()
+        self.assertEqual(module._admission.active, 0)
+
+    def test_search_compressed(self):
+        results = [{'name': 'x' * 100} for _ in range(20)]
+        self.controllers.search.return_value = {'results': results}
+        res = self.client.get('/metastore/search/events?callback=cb',
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.mimetype, 'application/javascript')
+        body = gzip.decompress(res.get_data()).decode('utf8')
+        self.assertTrue(body.startswith('cb({'))
+        self.assertEqual(json.loads(body[3:-2]), {'results': results})
+
+    def test_search_not_modified(self):
+        self.controllers.etag.return_value = 'abc'
+        self.controllers.search.return_value = {'results': [], 'summary': {}}
+        res = self.client.get('/metastore/search/events')
+        self.assertEqual(res.headers['ETag'], 'W/"abc"')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=5')
+        res = self.client.get('/metastore/search/events',
+                              headers={'If-None-Match': 'W/"abc"'})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.controllers.search.call_count, 1)
+
+    def test_search_private_results(self):
+        self.controllers.etag.return_value = 'abc'
+        self.controllers.search.return_value = {'results': [], 'summary': {}}
+        with patch.object(module._tokens, 'get_userid',
+                          return_value='owner1'):
+            res = self.client.get('/metastore/search/events',
+                                  headers={'Auth-Token': 'token'})
+        self.assertIn('private', res.headers['Cache-Control'])
+        self.assertIn('Auth-Token', res.headers['Vary'])
+        self.assertIn('Origin', res.headers['Vary'])
+        self.controllers.search.return_value = {'results': [], 'error': 'x'}
+        res = self.client.get('/metastore/search/events')
+        self.assertNotIn('ETag', res.headers)
+
+
+class SearchTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        models._cache.clear()
+        models._versions.clear()
+        patch.dict(models._last_versions, clear=True).start()
+        backend = memory.MemoryBackend()
+        backend.index('events', 'event', {
+            'event_action': 'finished', 'findability': 'published',
+            'timestamp': '2000-01-01T00:00:00'}, id='a')
+        patch.object(models, '_get_engine', return_value=backend).start()
+        patch.object(module, '_admission', module.AdmissionController(
+            **admission.options(threads=4))).start()
+        self.client = import_module('metastore').create().test_client()
+
+    # Tests
+
+    def test_search_varies_on_origin(self):
+        res = self.client.get('/metastore/search/events',
+                              headers={'Origin': 'http://a.b'})
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'],
+                         'http://a.b')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=5')
+        self.assertIn('Origin', res.headers['Vary'])
+
+    def test_anonymous_limited_per_forwarded_address(self):
+        patch.object(module, 'PROXY_COUNT', 1).start()
+        client = import_module('metastore').create().test_client()
+        module._admission.acquire('addr:10.0.0.1')
+
+        def get(address):
+            # The first address is the client's own claim, not trusted
+            return client.get('/metastore/search/events', headers={
+                'X-Forwarded-For': '10.1.1.1, %s' % address})
+        self.assertEqual(get('10.0.0.1').status_code, 429)
+        self.assertEqual(get('10.0.0.2').status_code, 200)
+
+    def test_anonymous_not_limited_per_unknown_address(self):
+        module._admission.acquire(None)
+        self.assertEqual(
+            self.client.get('/metastore/search/events').status_code, 200)
+
+    def test_search_jsonp(self):
+        res = self.client.get('/metastore/search/events?callback=cb&_=1')
+        body = res.get_data(as_text=True)
+        self.assertTrue(body.startswith('cb({'))
+        ret = json.loads(body[3:-2])
+        self.assertNotIn('error', ret)
+        self.assertEqual(ret['summary']['total'], 1)
+
+    def test_export_ignores_token(self):
+        res = self.client.get('/metastore/export/events?jwt=x&_=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_data(as_text=True).splitlines()), 1)
+        res.close()
@@ -0,0 +1,75 @@
+import unittest
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+from importlib import import_module
+module = import_module('metastore.breaker')
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        self.now = patch.object(module.time, 'monotonic').start()
+        self.now.return_value = 100
+        self.breaker = module.CircuitBreaker(
+            threshold=2, reset_timeout=10,
+            is_failure=lambda e: not isinstance(e, KeyError))
+
+    # Helpers
+
+    def fail(self, error=ValueError):
+        with self.assertRaises(error):
+            self.breaker.call(Mock(side_effect=error()))
+
+    # Tests
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        self.assertEqual(self.breaker.call(lambda: 'a'), 'a')
+        self.fail()
+        self.assertEqual(self.breaker.state, module.CLOSED)
+        self.fail()
+        self.assertEqual(self.breaker.state, module.OPEN)
+        fn = Mock()
+        with self.assertRaises(module.CircuitOpenError):
+            self.breaker.call(fn)
+        fn.assert_not_called()
+
+    def test_ignored_errors(self):
+        for _ in range(3):
+            self.fail(KeyError)
+        self.assertEqual(self.breaker.state, module.CLOSED)
+
+    def test_half_open_probe(self):
+        self.fail()
+        self.fail()
+        self.now.return_value = 110
+        self.breaker.acquire()
+        self.assertEqual(self.breaker.state, module.HALF_OPEN)
+        # A single probe at a time
+        with self.assertRaises(module.CircuitOpenError):
+            self.breaker.acquire()
+        self.breaker.record()
+        self.assertEqual(self.breaker.state, module.CLOSED)
+        self.assertEqual(self.breaker.call(lambda: 'a'), 'a')
+
+    def test_failed_probe_reopens(self):
+        self.fail()
+        self.fail()
+        self.now.return_value = 110
+        self.fail()
+        self.assertEqual(self.breaker.state, module.OPEN)
+        self.now.return_value = 115
+        with self.assertRaises(module.CircuitOpenError):
+            self.breaker.acquire()
+
+    def test_disabled(self):
+        breaker = module.CircuitBreaker(threshold=0)
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                breaker.call(Mock(side_effect=ValueError()))
+        self.assertEqual(breaker.call(lambda: 'a'), 'a')
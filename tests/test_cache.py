@@ -0,0 +1,47 @@
+import time
+import unittest
+from importlib import import_module
+module = import_module('metastore.cache')
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    # Tests
+
+    def test_get_set(self):
+        cache = module.ResultCache(maxsize=2, ttl=10)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        cache = module.ResultCache(maxsize=2, ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        cache = module.ResultCache(maxsize=2, ttl=10)
+        cache.set('a', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_evict(self):
+        cache = module.ResultCache(maxsize=3, ttl=10)
+        for key in (('a', 1), ('a', 2), ('b', 1)):
+            cache.set(key, 1)
+        cache.evict(lambda key: key[0] == 'a')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(('b', 1)), 1)
+
+    def test_disabled(self):
+        cache = module.ResultCache(maxsize=0, ttl=10)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
@@ -1,11 +1,15 @@
+import os
 import datetime
 import unittest
 from importlib import import_module
-from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch import NotFoundError
 
-LOCAL_ELASTICSEARCH = 'localhost:9200'
+# Run against the in-memory backend unless told otherwise
+# (METASTORE_BACKEND=elasticsearch uses DATAHUB_ELASTICSEARCH_ADDRESS)
+os.environ.setdefault('METASTORE_BACKEND', 'memory')
 
 module = import_module('metastore.controllers')
+models = import_module('metastore.models')
 
 class SearchTest(unittest.TestCase):
 
@@ -74,8 +78,11 @@ class SearchTest(unittest.TestCase):
 
     def setUp(self):
 
+        # Results must not leak between tests
+        models._cache.clear()
+
         # Clean index
-        self.es = Elasticsearch(hosts=[LOCAL_ELASTICSEARCH])
+        self.es = models._get_engine()
         try:
             self.es.indices.delete(index='datahub')
             self.es.indices.delete(index='events')
@@ -437,6 +444,13 @@ class SearchTest(unittest.TestCase):
                                   })
         self.assertEquals(len(recs), 6)
 
+    def test___search___authenticated_search_ranks_own_first(self):
+        self.indexSomePrivateRecords()
+        recs, _ = self.search('dataset', 'owner2')
+        self.assertEqual(len(recs), 6)
+        self.assertEqual([r['datahub']['ownerid'] for r in recs[:4]],
+                         ['owner2'] * 4)
+
     def test___search___q_param_anonymous_search(self):
         self.indexSomePrivateRecords()
         recs, _ = self.search('dataset', None, {'q': ['"cat"']})
@@ -552,6 +566,29 @@ class SearchTest(unittest.TestCase):
         self.assertEquals(recs[1]['title'], 'Country and Continent Codes List')
 
 
+    def test___search___dataset_facets(self):
+        self.indexMultipleUserRecords()
+        ret = module.search('dataset', 'core', {
+            'facets': ['"datahub.findability,datahub.owner"'],
+            'datahub.findability': ['"published"'],
+        })
+        self.assertEqual(ret['summary']['total'], 4)
+        self.assertEqual(
+            sorted((v['value'], v['count'])
+                   for v in ret['facets']['datahub.findability']),
+            [('private', 1), ('published', 4), ('unlisted', 1)])
+        self.assertEqual(ret['facets']['datahub.owner'],
+                         [{'value': 'Example', 'count': 4}])
+
+    def test___search___summary_modes_and_debug(self):
+        self.indexSomeRecords(2)
+        ret = module.search('dataset', None, {'summary': ['count']})
+        self.assertEqual(ret['summary'], {'total': 2})
+        self.assertNotIn('explanations', ret)
+        ret = module.search('dataset', None, {'debug': ['true']})
+        self.assertEqual(ret['summary']['totalBytes'], 20)
+        self.assertEqual(len(ret['explanations']), 2)
+
     # Tests Events
     def test___search___all_events_are_empty(self):
         self.assertEquals(self.search('events', None), ([], {'total': 0, 'totalBytes': 0.0}))
@@ -589,6 +626,51 @@ class SearchTest(unittest.TestCase):
         })
         self.assertEquals(len(res), 4)
 
+    def test___search___event_facets(self):
+        self.indexSomeEventRecords(10)
+        ret = module.search('events', 'datahubid', {
+            'facets': ['"event_entity,event_action"'],
+            'event_action': ['"finished"'],
+        })
+        self.assertEqual(len(ret['results']), 7)
+        self.assertEqual(ret['summary']['total'], 7)
+        self.assertEqual(ret['facets'], {
+            'event_action': [{'value': 'finished', 'count': 7},
+                             {'value': 'deleted', 'count': 3}],
+            'event_entity': [{'value': 'flow', 'count': 4},
+                             {'value': 'login', 'count': 3}],
+        })
+        ret = module.search('events', None, {'facets': ['"ownerid"']})
+        self.assertIn('error', ret)
+
+    def test___search___event_findability_facet(self):
+        self.indexSomeEventRecords(10)
+        ret = module.search('events', 'datahubid', {
+            'facets': ['"findability,status"'],
+            'findability': ['"unlisted"'],
+        })
+        self.assertEqual(ret['summary']['total'], 5)
+        self.assertEqual(
+            sorted((v['value'], v['count'])
+                   for v in ret['facets']['findability']),
+            [('published', 5), ('unlisted', 5)])
+        self.assertEqual(ret['facets']['status'], [{'value': 'OK', 'count': 5}])
+
+    def test___search___event_facets_with_two_selections(self):
+        self.indexSomeEventRecords(10)
+        ret = module.search('events', 'datahubid', {
+            'facets': ['"event_action,event_entity"'],
+            'event_action': ['"finished"'],
+            'event_entity': ['"flow"'],
+        })
+        self.assertEqual(ret['summary']['total'], 4)
+        self.assertEqual(ret['facets'], {
+            'event_action': [{'value': 'finished', 'count': 4},
+                             {'value': 'deleted', 'count': 2}],
+            'event_entity': [{'value': 'flow', 'count': 4},
+                             {'value': 'login', 'count': 3}],
+        })
+
     def test___search___all_event_sorts_with_timestamp(self):
         self.indexSomeEventRecords(10)
         res, _ = self.search('events', 'datahubid')
@@ -0,0 +1,65 @@
+import time
+import threading
+import unittest
+from importlib import import_module
+module = import_module('metastore.hedge')
+metrics = import_module('metastore.metrics')
+
+
+class HedgerTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        metrics.HEDGES.clear()
+        self.hedger = module.Hedger(percentile=50, budget=0.5, window=10,
+                                    min_samples=4, threads=4)
+        # Recent searches took 10ms
+        for _ in range(4):
+            self.hedger._record(0.01)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    # Helpers
+
+    def slow(self):
+        self.release.wait(5)
+        return 'primary'
+
+    # Tests
+
+    def test_not_hedged_before_min_samples(self):
+        hedger = module.Hedger(min_samples=4)
+        self.assertIsNone(hedger.delay())
+        self.assertEqual(hedger.do('dataset', lambda: 'a', None), 'a')
+
+    def test_fast_call_not_hedged(self):
+        self.assertEqual(self.hedger.do('dataset', lambda: 'primary',
+                                        lambda: 'hedge'), 'primary')
+        self.assertEqual(metrics.HEDGES.get(kind='dataset', result='sent'), 0)
+
+    def test_hedge_wins(self):
+        ret = self.hedger.do('dataset', self.slow, lambda: 'hedge')
+        self.assertEqual(ret, 'hedge')
+        self.assertEqual(metrics.HEDGES.get(kind='dataset', result='sent'), 1)
+        self.assertEqual(
+            metrics.HEDGES.get(kind='dataset', result='hedge_won'), 1)
+
+    def test_failed_hedge_waits_for_primary(self):
+        def fail():
+            raise ValueError()
+        threading.Timer(0.2, self.release.set).start()
+        self.assertEqual(self.hedger.do('dataset', self.slow, fail),
+                         'primary')
+        self.assertEqual(
+            metrics.HEDGES.get(kind='dataset', result='primary_won'), 1)
+
+    def test_budget(self):
+        self.hedger.budget = 0.1
+        threading.Timer(0.2, self.release.set).start()
+        start = time.perf_counter()
+        self.assertEqual(self.hedger.do('dataset', self.slow, lambda: 'h'),
+                         'primary')
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        self.assertEqual(
+            metrics.HEDGES.get(kind='dataset', result='over_budget'), 1)
@@ -0,0 +1,41 @@
+import unittest
+from importlib import import_module
+module = import_module('metastore.metrics')
+
+
+class MetricsTest(unittest.TestCase):
+
+    # Tests
+
+    def test_counter(self):
+        registry = []
+        counter = module.Counter('c_total', 'A counter', ['kind'], registry)
+        counter.inc(kind='dataset')
+        counter.inc(2, kind='dataset')
+        self.assertEqual(counter.get(kind='dataset'), 3)
+        self.assertEqual(module.render(registry),
+                         '# HELP c_total A counter\n'
+                         '# TYPE c_total counter\n'
+                         'c_total{kind="dataset"} 3\n')
+
+    def test_histogram(self):
+        registry = []
+        hist = module.Histogram('h', 'A histogram', buckets=(1, 5),
+                                registry=registry)
+        hist.observe(0.5)
+        hist.observe(3)
+        hist.observe(10)
+        self.assertEqual(module.render(registry),
+                         '# HELP h A histogram\n'
+                         '# TYPE h histogram\n'
+                         'h_bucket{le="1"} 1\n'
+                         'h_bucket{le="5"} 2\n'
+                         'h_bucket{le="+Inf"} 3\n'
+                         'h_sum 13.5\n'
+                         'h_count 3\n')
+
+    def test_histogram_time(self):
+        hist = module.Histogram('h', 'A histogram', ['stage'], registry=None)
+        with hist.time(stage='es'):
+            pass
+        self.assertEqual(hist.count(stage='es'), 1)
@@ -0,0 +1,453 @@
+import threading
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+from elasticsearch import exceptions as es_exceptions
+module = import_module('metastore.models')
+memory = import_module('metastore.backends.memory')
+CircuitOpenError = import_module('metastore.breaker').CircuitOpenError
+
+
+def es_response(sources=(), total_bytes=0):
+    return {
+        'took': 1,
+        'hits': {
+            'total': len(sources),
+            'hits': [{'_source': s} for s in sources]
+        },
+        'aggregations': {'total_bytes': {'value': total_bytes}}
+    }
+
+
+class QueryTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        module._cache.clear()
+        self.engine = patch.object(module, '_get_engine').start().return_value
+        self.engine.search.return_value = es_response([{'name': 'a'}], 10)
+
+    # Tests
+
+    def test_query(self):
+        ret = module.query('dataset', None)
+        self.assertEqual(ret['results'], [{'name': 'a'}])
+        self.assertEqual(ret['summary'], {'total': 1, 'totalBytes': 10})
+
+    def test_query_kind_timeout(self):
+        with patch.dict(module.ENABLED_SEARCHES['dataset'], timeout=2):
+            module.query('dataset', None)
+        self.assertEqual(
+            self.engine.search.call_args[1]['request_timeout'], 2)
+
+    def test_query_cached(self):
+        module.query('dataset', None, q=['"x"'])
+        module.query('dataset', None, q=['"x"'])
+        self.assertEqual(self.engine.search.call_count, 1)
+        self.assertEqual(module._cache.hits, 1)
+
+    def test_query_cache_respects_paging(self):
+        module.query('dataset', None, size=['10'])
+        module.query('dataset', None, size=['20'])
+        module.query('dataset', None, **{'from': ['10']})
+        self.assertEqual(self.engine.search.call_count, 3)
+
+    def test_query_cache_not_shared_between_users(self):
+        module.query('dataset', None)
+        module.query('dataset', 'owner1')
+        module.query('dataset', 'owner2')
+        self.assertEqual(self.engine.search.call_count, 3)
+
+    def test_query_summary(self):
+        ret = module.query('dataset', None, summary=['count'])
+        self.assertEqual(ret['summary'], {'total': 1})
+        body = module.json.loads(self.engine.search.call_args[1]['body'])
+        self.assertNotIn('aggs', body)
+        ret = module.query('dataset', None, summary=['"none"'])
+        self.assertNotIn('summary', ret)
+        self.assertIn('error', module.query('dataset', None, summary=['x']))
+
+    def test_query_aggregations_cached(self):
+        module.query('dataset', None, q=['"x"'])
+        ret = module.query('dataset', None, q=['"x"'], **{'from': ['50']})
+        self.assertEqual(ret['summary']['totalBytes'], 10)
+        body = module.json.loads(self.engine.search.call_args[1]['body'])
+        self.assertNotIn('aggs', body)
+        module.query('dataset', None, q=['"y"'])
+        body = module.json.loads(self.engine.search.call_args[1]['body'])
+        self.assertIn('aggs', body)
+
+    def test_query_not_shared_with_search_without_aggregations(self):
+        module.query('dataset', None, q=['"x"'])
+        searching = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def search(**params):
+            if '"aggs"' in params['body']:
+                return es_response([{'name': 'a'}], 10)
+            # Aggregations were cached
+            searching.set()
+            release.wait(5)
+            ret = es_response([{'name': 'a'}], 10)
+            del ret['aggregations']
+            return ret
+        self.engine.search.side_effect = search
+        leader = threading.Thread(target=module.query, args=(
+            'dataset', None), kwargs={'q': ['"x"'], 'from': ['50']})
+        leader.start()
+        searching.wait(5)
+        module._cache.evict(lambda key: key[1] == 'aggs')
+        threading.Timer(0.5, release.set).start()
+        ret = module.query('dataset', None, q=['"x"'], **{'from': ['50']})
+        self.assertEqual(ret['summary']['totalBytes'], 10)
+        self.assertFalse(release.is_set())
+        release.set()
+        leader.join()
+
+    def test_query_cache_opt_out(self):
+        with patch.dict(module.ENABLED_SEARCHES['events'], cache=False):
+            module.query('events', None)
+            module.query('events', None)
+        self.assertEqual(self.engine.search.call_count, 2)
+
+
+class FallbackTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        module._cache.clear()
+        module._stale.clear()
+        patch.object(module, '_breaker', module.CircuitBreaker(
+            threshold=2, is_failure=module._engine_failure)).start()
+        self.engine = patch.object(module, '_get_engine').start().return_value
+        self.engine.search.return_value = es_response([{'name': 'a'}], 10)
+
+    # Tests
+
+    def test_stale_result_while_failing(self):
+        module.query('dataset', None)
+        module._cache.clear()
+        self.engine.search.side_effect = es_exceptions.ConnectionTimeout(
+            'TIMEOUT', 'x', 0)
+        ret = module.query('dataset', None)
+        self.assertEqual(ret['results'], [{'name': 'a'}])
+        self.assertTrue(ret['stale'])
+        module.query('dataset', None)
+        # The circuit is open
+        ret = module.query('dataset', None)
+        self.assertTrue(ret['stale'])
+        self.assertEqual(self.engine.search.call_count, 3)
+        with self.assertRaises(CircuitOpenError):
+            module.query('dataset', 'owner1')
+
+    def test_query_errors_not_counted(self):
+        self.engine.search.side_effect = es_exceptions.NotFoundError(
+            404, 'x', {})
+        for _ in range(3):
+            self.assertIn('error', module.query('dataset', None))
+        self.assertEqual(module._breaker.state, 'closed')
+
+    def test_multi_query_stale_result(self):
+        module.query('dataset', None)
+        module._cache.clear()
+        self.engine.msearch.side_effect = es_exceptions.ConnectionError(
+            'N/A', 'x', 0)
+        first, second = module.multi_query(
+            None, [('dataset', {}), ('dataset', {'q': ['"b"']})])
+        self.assertTrue(first['stale'])
+        self.assertIn('error', second)
+
+
+class EtagTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        module._cache.clear()
+        module._versions.clear()
+        patch.dict(module._last_versions, clear=True).start()
+        self.backend = memory.MemoryBackend()
+        self.add('a')
+        patch.object(module, '_get_engine', return_value=self.backend).start()
+
+    # Helpers
+
+    def add(self, name):
+        self.backend.index('datahub', 'dataset', {
+            'name': name,
+            'datahub': {'findability': 'published', 'ownerid': 'core'},
+        }, id=name)
+
+    # Tests
+
+    def test_etag(self):
+        etag = module.etag('dataset', None, q=['"a"'])
+        self.assertEqual(module.etag('dataset', None, q=['"a"']), etag)
+        self.assertNotEqual(module.etag('dataset', None, q=['"b"']), etag)
+        self.assertNotEqual(module.etag('dataset', 'owner1', q=['"a"']),
+                            etag)
+        self.assertIsNone(module.etag('dataset', None, title=['nope']))
+
+    def test_etag_changes_with_index(self):
+        etag = module.etag('dataset', None)
+        self.assertEqual(len(module.query('dataset', None)['results']), 1)
+        self.add('b')
+        # Markers are kept briefly
+        self.assertEqual(module.etag('dataset', None), etag)
+        module._versions.clear()
+        self.assertNotEqual(module.etag('dataset', None), etag)
+        # Cached results of the index are dropped
+        self.assertEqual(len(module.query('dataset', None)['results']), 2)
+
+    def test_etag_unknown_index_version(self):
+        self.backend.indices.delete('datahub')
+        self.assertIsNone(module.etag('dataset', None))
+
+
+class CursorTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        module._cache.clear()
+        self.engine = patch.object(module, '_get_engine').start().return_value
+
+    # Tests
+
+    def test_cursor_round_trip(self):
+        cursor = module.encode_cursor([946684800000, 'event#1'])
+        self.assertEqual(module.decode_cursor(cursor),
+                         [946684800000, 'event#1'])
+
+    def test_next_cursor_on_full_page(self):
+        hits = [{'_source': {'n': i}, 'sort': [i, 'event#%d' % i]}
+                for i in range(2)]
+        self.engine.search.return_value = {
+            'hits': {'total': 5, 'hits': hits},
+            'aggregations': {'total_bytes': {'value': 0}}
+        }
+        ret = module.query('events', None, size=['2'])
+        self.assertEqual(module.decode_cursor(ret['next']), [1, 'event#1'])
+
+        ret = module.query('events', None, size=['2'],
+                           cursor=[ret['next']], **{'from': ['4']})
+        params = self.engine.search.call_args[1]
+        body = module.json.loads(params['body'])
+        self.assertEqual(body['search_after'], [1, 'event#1'])
+        self.assertEqual(params['from_'], 0)
+        self.assertNotIn('cursor', params['body'])
+
+    def test_no_next_cursor_on_last_page(self):
+        self.engine.search.return_value = {
+            'hits': {'total': 1, 'hits': [{'_source': {}, 'sort': [1, 'a']}]},
+            'aggregations': {'total_bytes': {'value': 0}}
+        }
+        ret = module.query('events', None, size=['2'])
+        self.assertIsNone(ret['next'])
+
+    def test_cursor_not_supported_for_datasets(self):
+        ret = module.query('dataset', None, cursor=['WzFd'])
+        self.assertIn('error', ret)
+        self.engine.search.assert_not_called()
+
+
+class ExportTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        self.engine = patch.object(module, '_get_engine').start().return_value
+        self.scan = self.engine.scan
+        self.scan.return_value = iter([{'_source': {'n': 1}},
+                                       {'_source': {'n': 2}}])
+
+    # Tests
+
+    def test_export(self):
+        docs = module.export('events', 'owner1', size=['5'],
+                             slice=['1/4'], dataset=['"x"'])
+        self.assertEqual(list(docs), [{'n': 1}, {'n': 2}])
+        body = self.scan.call_args[1]['query']
+        self.assertNotIn('aggs', body)
+        self.assertNotIn('explain', body)
+        self.assertEqual(body['slice'], {'id': 1, 'max': 4})
+        self.assertIn('owner1', module.json.dumps(body))
+        self.assertIn('dataset', module.json.dumps(body))
+
+    def test_export_bad_value(self):
+        with self.assertRaises(ValueError):
+            module.export('events', None, dataset=['x'])
+
+    def test_export_bad_slice(self):
+        for slice_ in ('4/4', '-1/4', '0/1', 'x/4', '1', '1/2/3'):
+            with self.assertRaises(ValueError):
+                module.export('events', None, slice=[slice_])
+        self.scan.assert_not_called()
+
+
+class MultiQueryTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        module._cache.clear()
+        self.engine = patch.object(module, '_get_engine').start().return_value
+
+    # Tests
+
+    def test_multi_query(self):
+        self.engine.msearch.return_value = {'responses': [
+            es_response([{'name': 'a'}], 10),
+            {'error': {'type': 'query_shard_exception', 'reason': 'bad'}},
+        ]}
+        ret = module.multi_query('owner1', [
+            ('dataset', {'q': ['"a"'], 'size': ['5']}),
+            ('events', {'dataset': ['"b"']}),
+            ('dataset', {'title': ['not json']}),
+            ('unknown', {}),
+        ])
+        self.assertEqual(self.engine.msearch.call_count, 1)
+        self.assertEqual(ret[0]['results'], [{'name': 'a'}])
+        self.assertEqual(ret[1]['error'], 'bad')
+        self.assertIn('error', ret[2])
+        self.assertIn('error', ret[3])
+
+        lines = self.engine.msearch.call_args[1]['body'].splitlines()
+        self.assertEqual(len(lines), 4)
+        header, body = module.json.loads(lines[0]), module.json.loads(lines[1])
+        self.assertEqual(header['index'], 'datahub')
+        self.assertEqual(body['size'], 5)
+        self.assertEqual(module.json.loads(lines[2])['index'], 'events')
+
+    def test_multi_query_uses_cache(self):
+        self.engine.search.return_value = es_response([{'name': 'a'}])
+        module.query('dataset', None)
+        ret = module.multi_query(None, [('dataset', {})])
+        self.engine.msearch.assert_not_called()
+        self.assertEqual(ret[0]['results'], [{'name': 'a'}])
+
+
+class WarmUpTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        patch.object(module, '_ready', False).start()
+        self.engine = patch.object(module, '_get_engine').start().return_value
+
+    # Tests
+
+    def test_warm_up(self):
+        self.engine.ping.return_value = True
+        self.assertFalse(module.ready())
+        self.assertTrue(module.warm_up())
+        self.assertTrue(module.ready())
+        self.engine.search.assert_not_called()
+
+    def test_warm_up_unreachable(self):
+        self.engine.ping.side_effect = ConnectionError()
+        self.assertFalse(module.warm_up())
+        self.assertFalse(module.ready())
+
+
+class BuildDslTest(unittest.TestCase):
+
+    # Tests
+
+    def test_filters_are_not_scored(self):
+        kw = {'q': ['"gdp"'], 'license': ['"odc-pddl"']}
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['dataset'],
+                               'owner1', kw, kind='dataset')
+        query = dsl['query']['bool']
+        visible, license = query['filter']
+        self.assertEqual(visible['bool']['should'], [
+            {'match': {'datahub.findability': 'published'}},
+            {'match': {'datahub.ownerid': 'owner1'}},
+        ])
+        self.assertEqual(license['bool']['should'],
+                         [{'match': {'license': 'odc-pddl'}}])
+        self.assertEqual(len(query['must']), 1)
+        self.assertIn('multi_match', query['must'][0])
+        self.assertIn('core', module.json.dumps(query['should']))
+        self.assertIn({'match': {'datahub.ownerid': 'owner1'}},
+                      query['should'])
+
+    def test_source_filtering(self):
+        kw = {'fields': ['"title,datahub.owner"'], 'exclude': ['datahub.x'],
+              'license': ['"odc-pddl"']}
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['dataset'],
+                               None, kw, kind='dataset')
+        self.assertEqual(dsl['_source'], {
+            'includes': ['title', 'datahub.owner'],
+            'excludes': ['datahub.x'],
+        })
+        self.assertNotIn('fields', module.json.dumps(dsl['query']))
+        self.assertNotIn('exclude', module.json.dumps(dsl['query']))
+
+    def test_summary_and_debug(self):
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['dataset'], None,
+                               {'q': ['"x"']}, kind='dataset')
+        self.assertEqual(dsl['aggs'], {'total_bytes': {
+            'sum': {'field': 'datahub.stats.bytes'}}})
+        self.assertNotIn('explain', dsl)
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['dataset'], None,
+                               {'debug': ['true']}, kind='dataset',
+                               summary='count')
+        self.assertNotIn('aggs', dsl)
+        self.assertTrue(dsl['explain'])
+        self.assertNotIn('debug', module.json.dumps(dsl['query']))
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['events'], None, {},
+                               kind='events')
+        self.assertNotIn('aggs', dsl)
+
+    def test_facets(self):
+        kw = {'facets': ['"event_entity,event_action"'],
+              'event_action': ['"finished"'], 'dataset': ['"a"']}
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['events'], None, kw,
+                               kind='events')
+        action = {'bool': {'should': [{'term': {'event_action': 'finished'}}],
+                           'minimum_should_match': 1}}
+        # Filters on faceted fields apply to the hits only
+        self.assertNotIn('event_action', module.json.dumps(dsl['query']))
+        self.assertIn('dataset', module.json.dumps(dsl['query']))
+        self.assertEqual(dsl['post_filter'], {'bool': {'filter': [action]}})
+        self.assertEqual(dsl['aggs']['facet:event_action']['filter'],
+                         {'match_all': {}})
+        self.assertEqual(dsl['aggs']['facet:event_entity']['filter'],
+                         {'bool': {'filter': [action]}})
+        self.assertEqual(
+            dsl['aggs']['facet:event_entity']['aggs']['values']['terms'],
+            {'field': 'event_entity.keyword', 'size': module.FACET_SIZE})
+        # Totals are of the filtered hits
+        dsl = module.build_dsl(module.ENABLED_SEARCHES['dataset'], None,
+                               {'facets': ['"datahub.ownerid"'],
+                                'datahub.ownerid': ['"core"']},
+                               kind='dataset')
+        self.assertEqual(dsl['aggs']['total_bytes']['filter'],
+                         dsl['post_filter'])
+        with self.assertRaises(ValueError):
+            module.build_dsl(module.ENABLED_SEARCHES['events'], None,
+                             {'facets': ['"payload"']}, kind='events')
+
+    def test_source_filtering_defaults(self):
+        kind_params = dict(module.ENABLED_SEARCHES['dataset'],
+                           exclude=['datapackage.readme'])
+        dsl = module.build_dsl(kind_params, None, {}, kind='dataset')
+        self.assertEqual(dsl['_source'],
+                         {'excludes': ['datapackage.readme']})
+        dsl = module.build_dsl(kind_params, None, {'exclude': ['""']},
+                               kind='dataset')
+        self.assertNotIn('_source', dsl)
@@ -0,0 +1,112 @@
+import json
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+module = import_module('metastore.querylog')
+models = import_module('metastore.models')
+
+RESPONSE = {'took': 3, 'hits': {'total': 1, 'hits': [{'_source': {}}]}}
+
+
+class FingerprintTest(unittest.TestCase):
+
+    # Helpers
+
+    def fingerprint(self, kind, userid, kw):
+        body = models.build_dsl(models.ENABLED_SEARCHES[kind], userid,
+                                kw, kind=kind)
+        return module.fingerprint(json.dumps(body))
+
+    # Tests
+
+    def test_literals_are_stripped(self):
+        self.assertEqual(
+            self.fingerprint('dataset', 'a', {'q': ['"gdp"'], 'x': ['"1"']}),
+            self.fingerprint('dataset', 'b', {'q': ['"co2"'],
+                                              'x': ['"2"', '"3"']}))
+
+    def test_shape_is_kept(self):
+        self.assertNotEqual(self.fingerprint('dataset', None, {}),
+                            self.fingerprint('dataset', 'a', {}))
+        self.assertNotEqual(self.fingerprint('dataset', None, {'x': ['1']}),
+                            self.fingerprint('dataset', None, {'y': ['1']}))
+        self.assertNotEqual(self.fingerprint('dataset', None, {}),
+                            self.fingerprint('events', None, {}))
+
+
+class LogQueryTest(unittest.TestCase):
+
+    # Tests
+
+    def test_summary(self):
+        with self.assertLogs('metastore.query', 'INFO') as logs, \
+                patch.object(module, 'SAMPLE_RATE', 0):
+            module.log_query('dataset', '{"query": {}}', RESPONSE, 0.01)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['kind'], 'dataset')
+        self.assertEqual(entry['hits'], 1)
+        self.assertEqual(entry['took'], 3)
+        self.assertEqual(entry['latency_ms'], 10)
+        self.assertNotIn('response', entry)
+
+    def test_sampled(self):
+        with self.assertLogs('metastore.query', 'INFO') as logs, \
+                patch.object(module, 'SAMPLE_RATE', 1):
+            module.log_query('dataset', '{"query": {}}', RESPONSE, 0.01)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['request'], {'query': {}})
+        self.assertEqual(entry['response'], RESPONSE)
+
+    def test_slow(self):
+        with self.assertLogs('metastore.query', 'WARNING') as logs, \
+                patch.object(module, 'SAMPLE_RATE', 0):
+            module.log_query('dataset', '{"query": {}}', RESPONSE, 5)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['response'], RESPONSE)
+
+    def test_lazy(self):
+        with patch.object(module._Entry, '__str__') as format_entry:
+            module.logger.disabled = True
+            try:
+                module.log_query('dataset', '{}', RESPONSE, 0.01)
+            finally:
+                module.logger.disabled = False
+        format_entry.assert_not_called()
+
+
+class QueryStatsTest(unittest.TestCase):
+
+    # Tests
+
+    def test_top(self):
+        stats = module.QueryStats()
+        for latency in (0.1, 0.3):
+            stats.record('dataset', '{"a":"?"}', latency)
+        stats.record('events', '{"b":"?"}', 0.35, slow=True)
+        top = stats.top(order='total')
+        self.assertEqual([e['kind'] for e in top], ['dataset', 'events'])
+        self.assertEqual(top[0]['count'], 2)
+        self.assertEqual(top[0]['mean'], 200)
+        self.assertEqual(top[0]['max'], 300)
+        self.assertEqual(top[0]['shape'], '{"a":"?"}')
+        self.assertEqual(stats.top(1, order='max')[0]['kind'], 'events')
+        self.assertEqual(stats.top(1, order='slow')[0]['slow'], 1)
+
+    def test_bounded(self):
+        stats = module.QueryStats(maxsize=2)
+        for shape in ('a', 'b', 'c'):
+            stats.record('dataset', shape, 0.1)
+        self.assertEqual(len(stats.top()), 2)
+
+    def test_bad_order(self):
+        with self.assertRaises(ValueError):
+            module.QueryStats().top(order='nope')
+
+    def test_log_query_records_stats(self):
+        module.stats.clear()
+        module.log_query('dataset', '{"query": {"x": 1}}', RESPONSE, 0.01)
+        module.log_query('dataset', '{"query": {"x": 2}}', RESPONSE, 0.01)
+        self.assertEqual(module.stats.top()[0]['count'], 2)
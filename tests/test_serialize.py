@@ -0,0 +1,71 @@
+import gzip
+import json
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from importlib import import_module
+module = import_module('metastore.serialize')
+
+
+class SerializeTest(unittest.TestCase):
+
+    # Actions
+
+    def setUp(self):
+        self.addCleanup(patch.stopall)
+        patch.object(module, 'COMPRESS_MIN_SIZE', 10).start()
+
+    # Tests
+
+    def test_serializers_agree(self):
+        data = {'results': [{'title': 'café / "x"', 'n': 1.5}],
+                'summary': {'total': 1, 'totalBytes': None}}
+        for name, dumps in module.SERIALIZERS.items():
+            self.assertEqual(json.loads(dumps(data).decode('utf8')), data,
+                             name)
+
+    def test_jsonp(self):
+        self.assertEqual(module.jsonp({'a': 1}),
+                         (b'{"a":1}', 'application/json'))
+        self.assertEqual(module.jsonp({'a': 1}, 'cb'),
+                         (b'cb({"a":1});', 'application/javascript'))
+
+    def test_accepted_encodings(self):
+        self.assertEqual(
+            module.accepted_encodings('gzip;q=0.5, br;q=0, Deflate'),
+            {'gzip', 'deflate'})
+        self.assertEqual(module.accepted_encodings(None), set())
+
+    def test_encoding_qualities(self):
+        self.assertEqual(module.encoding_qualities('gzip;q=0, *'),
+                         {'gzip': 0, '*': 1.0})
+        self.assertEqual(module.encoding_qualities(None), {})
+
+    def test_compress(self):
+        body = b'{"a":"' + b'x' * 100 + b'"}'
+        self.assertEqual(module.compress(body, None), (body, None))
+        self.assertEqual(module.compress(b'{}', 'gzip'), (b'{}', None))
+        compressed, encoding = module.compress(body, 'gzip')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(compressed), body)
+        self.assertEqual(module.compress(body, '*')[1], 'gzip')
+
+    def test_compress_refused_coding(self):
+        body = b'x' * 100
+        self.assertEqual(module.compress(body, 'gzip;q=0, *'), (body, None))
+        self.assertEqual(module.compress(body, '*, gzip;q=0'), (body, None))
+        self.assertEqual(module.compress(body, '*;q=0'), (body, None))
+        with patch.object(module, 'brotli', None):
+            self.assertEqual(module.compress(body, 'br, *;q=0'), (body, None))
+
+    def test_compress_brotli(self):
+        if module.brotli is None:
+            self.skipTest('brotli is not installed')
+        body = b'x' * 100
+        compressed, encoding = module.compress(body, 'gzip, br')
+        self.assertEqual(encoding, 'br')
+        self.assertEqual(module.brotli.decompress(compressed), body)
+        with patch.object(module, 'brotli', None):
+            self.assertEqual(module.compress(body, 'gzip, br')[1], 'gzip')
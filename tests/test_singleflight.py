@@ -0,0 +1,83 @@
+import time
+import asyncio
+import threading
+import unittest
+from importlib import import_module
+module = import_module('metastore.singleflight')
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    # Tests
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = module.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'hits': 1}
+
+        results = []
+
+        def worker():
+            results.append(flight.do('key', fn))
+
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=worker) for _ in range(5)]
+        for t in followers:
+            t.start()
+        for _ in range(500):
+            if flight.shared == 5:
+                break
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'hits': 1}] * 6)
+
+    def test_sequential_calls_are_not_shared(self):
+        flight = module.SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+        self.assertEqual(flight.shared, 0)
+
+    def test_error_is_raised(self):
+        flight = module.SingleFlight()
+
+        def fn():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', fn)
+
+
+class AsyncSingleFlightTest(unittest.TestCase):
+
+    # Tests
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = module.AsyncSingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'hits': 1}
+
+        async def main():
+            return await asyncio.gather(*[flight.do('key', fn)
+                                          for _ in range(3)])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(main()), [{'hits': 1}] * 3)
+        self.assertEqual(calls, [1])
+        self.assertEqual(flight.shared, 2)